@@ -0,0 +1,78 @@
+"""covering indexes, jsonb
+
+Revision ID: bd9121e9e840
+Revises: d2c3f219bc90
+Create Date: 2026-10-19 10:12:41.503118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'bd9121e9e840'
+down_revision: Union[str, Sequence[str], None] = 'd2c3f219bc90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (table, column) moved from json to jsonb
+JSONB_COLUMNS = [
+    ('player_activity', 'value'),
+    ('beatmapsets', 'tags'),
+    ('beatmaps', 'extra_metadata'),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # rewrites the tables, run it while the workers are stopped
+    for table, column in JSONB_COLUMNS:
+        op.alter_column(
+            table, column,
+            type_=postgresql.JSONB(astext_type=sa.Text()),
+            existing_type=sa.JSON(),
+            postgresql_using=f'{column}::jsonb',
+        )
+
+    op.create_index(
+        'ix_player_activity_player_created', 'player_activity', ['player_id', 'created_at'],
+        unique=False, postgresql_include=['type', 'map_id', 'mapset_id'],
+    )
+    # leading column of both the unique index and the one above
+    op.drop_index(op.f('ix_player_activity_player_id'), table_name='player_activity')
+
+    op.create_index(
+        'ix_beatmaps_id_beatmapset', 'beatmaps', ['id'],
+        unique=False, postgresql_include=['beatmapset_id'],
+    )
+    op.create_index(
+        'ix_beatmapsets_tags', 'beatmapsets', ['tags'],
+        unique=False, postgresql_using='gin', postgresql_ops={'tags': 'jsonb_path_ops'},
+    )
+    op.create_index(
+        'ix_players_synced_main_mode', 'players', ['last_synced_at'],
+        unique=False, postgresql_include=['id'], postgresql_where=sa.text('main_mode IS NOT NULL'),
+    )
+    op.create_index('ix_user_groups_user', 'user_groups', ['user_id', 'group_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_user_groups_user', table_name='user_groups')
+    op.drop_index('ix_players_synced_main_mode', table_name='players', postgresql_where=sa.text('main_mode IS NOT NULL'))
+    op.drop_index('ix_beatmapsets_tags', table_name='beatmapsets', postgresql_using='gin')
+    op.drop_index('ix_beatmaps_id_beatmapset', table_name='beatmaps')
+
+    op.create_index(op.f('ix_player_activity_player_id'), 'player_activity', ['player_id'], unique=False)
+    op.drop_index('ix_player_activity_player_created', table_name='player_activity')
+
+    for table, column in JSONB_COLUMNS:
+        op.alter_column(
+            table, column,
+            type_=sa.JSON(),
+            existing_type=postgresql.JSONB(astext_type=sa.Text()),
+            postgresql_using=f'{column}::json',
+        )
@@ -0,0 +1,108 @@
+"""partition player_activity
+
+Revision ID: dcc2bb6acae0
+Revises: bd9121e9e840
+Create Date: 2026-10-19 13:40:07.218664
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'dcc2bb6acae0'
+down_revision: Union[str, Sequence[str], None] = 'bd9121e9e840'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# frozen here, app.database.players.ACTIVITY_PARTITIONS may change later
+PARTITIONS = 16
+
+COLUMNS = 'player_id, type, map_id, mapset_id, value, created_at'
+
+
+def create_indexes(nulls_not_distinct: bool) -> None:
+    op.create_index(
+        'ix_player_activity_player_type_map_mapset', 'player_activity',
+        ['player_id', 'type', 'map_id', 'mapset_id'],
+        unique=True, postgresql_nulls_not_distinct=nulls_not_distinct,
+    )
+    op.create_index(
+        'ix_player_activity_player_created', 'player_activity', ['player_id', 'created_at'],
+        unique=False, postgresql_include=['type', 'map_id', 'mapset_id'],
+    )
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # copies the whole table, run it while the workers are stopped
+    op.rename_table('player_activity', 'player_activity_old')
+    op.drop_index('ix_player_activity_player_type_map_mapset', table_name='player_activity_old')
+    op.drop_index('ix_player_activity_player_created', table_name='player_activity_old')
+    op.execute('ALTER TABLE player_activity_old RENAME CONSTRAINT player_activity_pkey TO player_activity_old_pkey')
+    op.execute('ALTER SEQUENCE player_activity_id_seq RENAME TO player_activity_old_id_seq')
+
+    op.execute("""
+        CREATE TABLE player_activity (
+            id BIGSERIAL NOT NULL,
+            player_id BIGINT NOT NULL,
+            type playeractivitytype,
+            map_id BIGINT,
+            mapset_id BIGINT,
+            value JSONB,
+            created_at TIMESTAMP WITHOUT TIME ZONE,
+            PRIMARY KEY (player_id, id),
+            FOREIGN KEY (player_id) REFERENCES players (id) ON DELETE CASCADE
+        ) PARTITION BY HASH (player_id)
+    """)
+    for remainder in range(PARTITIONS):
+        op.execute(
+            f'CREATE TABLE player_activity_p{remainder:02d} PARTITION OF player_activity '
+            f'FOR VALUES WITH (MODULUS {PARTITIONS}, REMAINDER {remainder})'
+        )
+
+    # the old unique index let rows with a NULL map_id or mapset_id through on
+    # every sync, keep the most recent of each
+    op.execute(f"""
+        INSERT INTO player_activity ({COLUMNS})
+        SELECT DISTINCT ON (player_id, type, map_id, mapset_id) {COLUMNS}
+        FROM player_activity_old
+        WHERE player_id IS NOT NULL
+        ORDER BY player_id, type, map_id, mapset_id, created_at DESC NULLS LAST, id DESC
+    """)
+
+    # building them after the copy is much cheaper than maintaining them during it
+    create_indexes(nulls_not_distinct=True)
+
+    op.drop_table('player_activity_old')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.rename_table('player_activity', 'player_activity_new')
+    op.drop_index('ix_player_activity_player_type_map_mapset', table_name='player_activity_new')
+    op.drop_index('ix_player_activity_player_created', table_name='player_activity_new')
+    op.execute('ALTER TABLE player_activity_new RENAME CONSTRAINT player_activity_pkey TO player_activity_new_pkey')
+    op.execute('ALTER SEQUENCE player_activity_id_seq RENAME TO player_activity_new_id_seq')
+
+    op.execute("""
+        CREATE TABLE player_activity (
+            id BIGSERIAL NOT NULL,
+            player_id BIGINT,
+            type playeractivitytype,
+            map_id BIGINT,
+            mapset_id BIGINT,
+            value JSONB,
+            created_at TIMESTAMP WITHOUT TIME ZONE,
+            PRIMARY KEY (id),
+            FOREIGN KEY (player_id) REFERENCES players (id) ON DELETE CASCADE
+        )
+    """)
+    op.execute(f'INSERT INTO player_activity ({COLUMNS}) SELECT {COLUMNS} FROM player_activity_new')
+
+    create_indexes(nulls_not_distinct=False)
+
+    # dropping the parent drops the partitions with it
+    op.drop_table('player_activity_new')
@@ -0,0 +1,51 @@
+"""resolve activity mapsets
+
+Revision ID: e073a5159669
+Revises: dcc2bb6acae0
+Create Date: 2026-10-19 15:02:53.871240
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e073a5159669'
+down_revision: Union[str, Sequence[str], None] = 'dcc2bb6acae0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # readers stopped resolving map_id -> mapset_id themselves, fill in every
+    # row whose beatmap is already known. rows that would collide with an
+    # already resolved copy of themselves are duplicates, drop those first
+    op.execute("""
+        DELETE FROM player_activity a
+        USING beatmaps b
+        WHERE a.mapset_id IS NULL AND b.id = a.map_id AND EXISTS (
+            SELECT 1 FROM player_activity r
+            WHERE r.player_id = a.player_id AND r.type = a.type
+              AND r.map_id = a.map_id AND r.mapset_id = b.beatmapset_id
+        )
+    """)
+    op.execute("""
+        UPDATE player_activity a
+        SET mapset_id = b.beatmapset_id
+        FROM beatmaps b
+        WHERE a.mapset_id IS NULL AND b.id = a.map_id
+    """)
+
+    op.create_index(
+        'ix_player_activity_unresolved', 'player_activity', ['map_id'],
+        unique=False, postgresql_where=sa.text('mapset_id IS NULL'),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # the resolved mapset ids are correct either way, only the index goes
+    op.drop_index('ix_player_activity_unresolved', table_name='player_activity', postgresql_where=sa.text('mapset_id IS NULL'))
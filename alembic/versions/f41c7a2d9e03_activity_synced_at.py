@@ -0,0 +1,31 @@
+"""activity synced_at
+
+Revision ID: f41c7a2d9e03
+Revises: e073a5159669
+Create Date: 2026-10-19 18:21:40.512093
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f41c7a2d9e03'
+down_revision: Union[str, Sequence[str], None] = 'e073a5159669'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # created_at was overwritten by every sync, so until now it was the sync
+    # time. it becomes the play time, scores pick theirs up on the next sync
+    op.add_column('player_activity', sa.Column('synced_at', sa.TIMESTAMP(), nullable=True))
+    op.execute('UPDATE player_activity SET synced_at = created_at')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('player_activity', 'synced_at')
@@ -1,15 +1,47 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from .beatmaps import router as beatmaps_router
 from .oauth import router as oauth_router
 from .discovery import router as discovery_router
+from .health import router as health_router
+from .admin import router as admin_router
+from .state import APIState
+from app.logger import setup_logging
+from app.util.profiling import ProfilingMiddleware
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # initialize clients and warm their pools before uvicorn starts
+    # accepting traffic, so the first request doesn't pay for it
+    setup_logging()
+    state = APIState()
+    await state.init()
+    problems = await state.check_ready()
+
+    if problems:
+        await state.close()
+        raise RuntimeError(
+            "backing services are not ready (did you run `python main.py bootstrap`?): "
+            + "; ".join(problems)
+        )
+
+    state.start_replica_monitor()
+    app.state.api = state
+    yield
+
+    await state.close()
 
 def init() -> FastAPI:
-    app = FastAPI()
+    app = FastAPI(lifespan=lifespan)
 
     app.include_router(beatmaps_router)
     app.include_router(oauth_router)
     app.include_router(discovery_router)
+    app.include_router(health_router)
+    app.include_router(admin_router)
+
+    app.add_middleware(ProfilingMiddleware)
 
     return app
 
-app = init()
\ No newline at end of file
+app = init()
@@ -0,0 +1,101 @@
+from fastapi import APIRouter, HTTPException, Query, Depends
+from .state import APIState, get_state
+from .models import QueueItemsRequest
+from app.database.groups import Permissions
+from app.util.api import get_current_user
+from app.util.auth import Principal
+from app.util.profiling import load_slow_requests
+from app.util.queues import QUEUES, bump, enqueue, queue_status, worker_status
+
+router = APIRouter(prefix="/admin")
+
+# what it takes to push items onto each queue
+QUEUE_PERMISSIONS = {
+    "beatmaps": Permissions.MANAGE_MAPSETS,
+    "players": Permissions.MANAGE_PLAYERS,
+    "feeds": Permissions.MANAGE_PLAYERS,
+}
+
+# reading queue and worker state takes any of these
+OPERATOR_PERMISSIONS = Permissions.MANAGE_USERS | Permissions.MANAGE_MAPSETS | Permissions.MANAGE_PLAYERS
+
+def require_permission(permission: Permissions):
+    async def dependency(user: Principal = Depends(get_current_user)) -> Principal:
+        if not (user.effective_permissions & permission):
+            raise HTTPException(403, "insufficient permissions")
+        return user
+
+    return dependency
+
+def get_queue(name: str, user: Principal) -> str:
+    if name not in QUEUES:
+        raise HTTPException(404, "unknown queue")
+
+    if not (user.effective_permissions & QUEUE_PERMISSIONS[name]):
+        raise HTTPException(403, "insufficient permissions")
+
+    return QUEUES[name]
+
+@router.get("/slow-requests")
+async def get_slow_requests(
+    state: APIState = Depends(get_state),
+    user: Principal = Depends(require_permission(Permissions.MANAGE_USERS)),
+
+    limit: int = Query(20, ge=1, le=1000)
+):
+    """
+    The most recent requests slower than SLOW_REQUEST_THRESHOLD, newest first,
+    with the stacks sampled while they ran (see `app.util.profiling`).
+    """
+    return {"success": True, "data": await load_slow_requests(state.redis, limit)}
+
+@router.get("/queues")
+async def get_queues(
+    state: APIState = Depends(get_state),
+    user: Principal = Depends(require_permission(OPERATOR_PERMISSIONS))
+):
+    """
+    Every worker queue: depth, age of the oldest waiting item, the items
+    workers have in flight and enqueue/dequeue/ok/failed rates per minute,
+    averaged over the last 1, 15 and 60 complete minutes.
+    """
+    return {"success": True, "data": {name: await queue_status(state.redis, queue) for name, queue in QUEUES.items()}}
+
+@router.get("/workers")
+async def get_workers(
+    state: APIState = Depends(get_state),
+    user: Principal = Depends(require_permission(OPERATOR_PERMISSIONS))
+):
+    """
+    Every worker seen recently with its throughput, how busy it is and its
+    last error. `stale` workers missed their heartbeats, they're gone or
+    their process is stuck, and the items they had in flight are requeued.
+    """
+    return {"success": True, "data": await worker_status(state.redis)}
+
+@router.post("/queues/{name}/enqueue")
+async def enqueue_items(
+    name: str,
+    body: QueueItemsRequest,
+    state: APIState = Depends(get_state),
+    user: Principal = Depends(get_current_user)
+):
+    """Queue `ids` that aren't already waiting, e.g. a backfill of mapsets."""
+    queue = get_queue(name, user)
+    added = await enqueue(state.redis, queue, dict.fromkeys(body.ids), front=body.front)
+    return {"success": True, "data": {"added": added, "already_queued": len(set(body.ids)) - added}}
+
+@router.post("/queues/{name}/bump")
+async def bump_items(
+    name: str,
+    body: QueueItemsRequest,
+    state: APIState = Depends(get_state),
+    user: Principal = Depends(get_current_user)
+):
+    """Move `ids` to the head of the queue in order, queueing the ones that weren't waiting."""
+    queue = get_queue(name, user)
+    if len(body.ids) > 100:
+        raise HTTPException(400, "bump at most 100 ids, use enqueue with front for bulk loads")
+
+    moved, added = await bump(state.redis, queue, dict.fromkeys(body.ids))
+    return {"success": True, "data": {"moved": moved, "added": added}}
@@ -1,260 +1,445 @@
 import numpy
-import math
+from itertools import chain, repeat
 from fastapi import APIRouter, HTTPException, Query, Depends
-from .state import APIState, get_state
-from qdrant_client.models import Filter,FieldCondition,Range,MatchValue
+from .state import APIState, get_state, get_read_session
+from .models import (
+    MapsetListResponse, SimilarBatchRequest, SimilarBatchResponse, FIELDS_QUERY,
+    parse_fields, mapsets_response, serialize_mapsets, orjson_response
+)
+from qdrant_client.models import Filter,FieldCondition,MatchValue,QueryRequest
+from qdrant_client.http.exceptions import UnexpectedResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from app.database.beatmaps import Beatmap, BeatmapSet
+from app.database.beatmaps import Beatmap, BeatmapSet, fetch_mapsets
+from app.database.embeddings import (
+    BEATMAP_COLLECTION, BEATMAPSET_COLLECTION, SIMILARITY_PAYLOAD_FIELDS, backfill_beatmapset_embedding
+)
+from app.util.api import get_optional_user
+from app.util.auth import Principal
+from app.util.metrics import timed
+from app.util.search import SearchProfile, search_profile
+from app.util.seen import SeenSet, get_seen
 
 router = APIRouter()
 
 ALPHA_TAGS = 0.65      # tag overlap weight
 BETA_META = 0.25       # metadata similarity weight
-CANDIDATE_LIMIT = 1000  # candidacy limit for vectors
+TAG_BOOST = 2          # exponent applied to the tag overlap
+CANDIDATE_LIMIT = 1000  # candidacy limit for vectors (batch lookups)
+CANDIDATE_GROUPS = 250  # distinct mapsets considered per lookup
+GROUP_SIZE = 2          # difficulties kept per candidate mapset for re-ranking
+EXCLUDE_OVERFETCH = 4   # set-level over-fetch when exclusions can't be pushed down
+EXCLUDE_MAX_PAGES = 4   # pages fetched before giving up on filling `limit`
 
 # -----------------------
-# tags
-def compute_tag_score(orig_payload, cand_payload, alpha):
-    orig_tags_counts = orig_payload.get("user_tags", {})
-    cand_tags_counts = cand_payload.get("user_tags", {})
+# scoring
+#
+# every candidate is scored against the original beatmap of its group in one
+# pass, `groups[i]` is the index into `origs` for `candidates[i]`. a single
+# lookup is just one group.
+
+def payload_column(payloads, key, groups=None):
+    values = numpy.array([float(p.get(key) or 0) for p in payloads])
+    return values if groups is None else values[groups]
+
+def tag_scores(origs, candidates, groups, alpha=TAG_BOOST):
+    # weighted overlap is the sum of minimum counts over the original's tags,
+    # so only those tags need columns
+    vocab: dict[str, int] = {}
+    orig_counts = []
+    for orig in origs:
+        counts = {}
+        for tag, count in (orig.get("user_tags") or {}).items():
+            counts[vocab.setdefault(tag, len(vocab))] = count
+        orig_counts.append(counts)
+
+    orig_matrix = numpy.zeros((len(origs), max(len(vocab), 1)))
+    for row, counts in enumerate(orig_counts):
+        for column, count in counts.items():
+            orig_matrix[row, column] = count
+
+    # flatten every candidate's tags into (row, column, count) triples
+    cand_tags = [cand.get("user_tags") or {} for cand in candidates]
+    lengths = numpy.fromiter(map(len, cand_tags), dtype=numpy.intp, count=len(cand_tags))
+    rows = numpy.repeat(numpy.arange(len(cand_tags)), lengths)
+    columns = numpy.fromiter(
+        map(vocab.get, chain.from_iterable(cand_tags), repeat(-1)), dtype=numpy.intp, count=len(rows)
+    )
+    values = numpy.fromiter(
+        chain.from_iterable(tags.values() for tags in cand_tags), dtype=float, count=len(rows)
+    )
 
-    orig_tags = set(orig_tags_counts.keys())
-    cand_tags = set(cand_tags_counts.keys())
+    cand_totals = numpy.bincount(rows, weights=values, minlength=len(candidates))
 
-    overlap_tags = orig_tags & cand_tags
-    # weighted overlap: sum of minimum counts
-    overlap_weight = sum(min(orig_tags_counts[t], cand_tags_counts[t]) for t in overlap_tags)
+    known = columns >= 0
+    rows, columns, values = rows[known], columns[known], values[known]
 
-    # total weight: sum of all counts minus overlapping to avoid double-count
-    total_weight = sum(orig_tags_counts.values()) + sum(cand_tags_counts.values()) - overlap_weight
+    overlap = numpy.bincount(
+        rows, weights=numpy.minimum(values, orig_matrix[groups[rows], columns]), minlength=len(candidates)
+    )
 
-    if total_weight == 0:
-        return 0.0
+    # total weight: sum of all counts minus overlapping to avoid double-count
+    total = orig_matrix.sum(axis=1)[groups] + cand_totals - overlap
 
-    # apply exponential boost to overlap
-    score = (overlap_weight ** alpha) / total_weight
-    return min(score, 1.0)  # cap at 1.0
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        scores = numpy.where(total > 0, overlap ** alpha / total, 0.0)
 
+    return numpy.minimum(scores, 1.0)
 
-# -----------------------
-# metadata
+def meta_scores(origs, candidates, groups):
+    def same(key):
+        orig = numpy.array([o.get(key) for o in origs], dtype=object)[groups]
+        cand = numpy.array([c.get(key) for c in candidates], dtype=object)
+        return (orig == cand).astype(float)
 
-def star_bonus(sr1, sr2):
-    diff = abs(sr1 - sr2)
-    return math.exp(-diff * 1.5)
+    def decay(key, scale):
+        diff = numpy.abs(payload_column(origs, key, groups) - payload_column(candidates, key))
+        return numpy.exp(-diff / scale)
 
-def length_bonus(l1, l2):
-    diff = abs(l1 - l2)
-    return math.exp(-diff / 5)
+    # mode / genre / language (binary)
+    score = 0.05 * same("artist") + 0.05 * same("genre") + 0.05 * same("language")
 
+    # weigh cs before everything else as keymode on mania
+    mania = (
+        (numpy.array([o.get("mode") == "mania" for o in origs])[groups])
+        & numpy.array([c.get("mode") == "mania" for c in candidates])
+    )
+    score += numpy.where(mania, 0.05, 0.01) * same("cs")
 
-def meta_similarity(orig, cand):
-    score = 0.0
+    score += 0.03 * decay("star_rating", 1 / 1.5)
+    score += 0.03 * decay("length", 5)
+    score += 0.02 * decay("bpm", 10)
+    score += 0.01 * decay("max_combo", 50)
 
-    # mode / genre / language (binary)
-    score += 0.05 * (orig["artist"] == cand["artist"])
-    score += 0.05 * (orig["genre"] == cand["genre"])
-    score += 0.05 * (orig["language"] == cand["language"])
-    
-    # numeric decay similarity functions
-    def exp_decay_diff(v1, v2, scale=1.0):
-        return math.exp(-abs(v1 - v2) / scale)
-    
-    if orig["mode"] == "mania" and cand["mode"] == "mania":
-        # weigh cs before everything else as keymode
-        score += 0.05 * (orig["cs"] == cand["cs"])
-    else:
-        score += 0.01 * (orig["cs"] == cand["cs"])
-
-    score += 0.03 * star_bonus(orig["star_rating"], cand["star_rating"])
-    score += 0.03 * length_bonus(orig["length"], cand["length"])
-    score += 0.02 * exp_decay_diff(orig["bpm"], cand["bpm"], scale=10)
-    score += 0.01 * exp_decay_diff(orig.get("max_combo", 0), cand.get("max_combo", 0), scale=50)
-
-    # temporarily commented out as play count doesn't really measure
-    # map similarity
-
-    # score += 0.01 * exp_decay_diff(orig.get("play_count", 0), cand.get("play_count", 0), scale=1000)
-    # score += 0.01 * exp_decay_diff(orig.get("favourite_count", 0), cand.get("favourite_count", 0), scale=100)
+    # play count / favourites left out as they don't really measure map similarity
 
     return score
 
+def similarity_scores(origs, candidates, groups):
+    """Score `candidates` against their original in `origs`, clamped to 0-1."""
+    groups = numpy.asarray(groups, dtype=numpy.intp)
+    if len(candidates) == 0:
+        return numpy.zeros(0)
 
-# ---------------------------
-# final score
+    score = (
+        ALPHA_TAGS * tag_scores(origs, candidates, groups) +
+        BETA_META  * meta_scores(origs, candidates, groups)
+    )
 
-def total_similarity(orig, cand):
-    tags = compute_tag_score(orig, cand, 2)
-    meta = meta_similarity(orig, cand)
+    return numpy.clip(score, 0.0, 1.0)
 
-    score = (
-        ALPHA_TAGS * tags +
-        BETA_META  * meta
+def rank_mapsets(points, scores, limit: int, exclude: SeenSet | None = None) -> list[int]:
+    """Mapset ids of `points` ordered by `scores`, first `limit` distinct ones not in `exclude`."""
+    ranked = dict.fromkeys(
+        points[i].payload["beatmapset_id"] for i in numpy.argsort(-scores, kind="stable")
     )
+    return [mapset_id for mapset_id in ranked if not exclude or mapset_id not in exclude][:limit]
 
-    return min(max(score, 0.0), 1.0)  # clamp 0–1
+def group_points(points, limit: int = CANDIDATE_GROUPS, group_size: int = GROUP_SIZE):
+    """Same as qdrant's `group_by="beatmapset_id"` over already fetched points, best first."""
+    kept: dict[int, int] = {}
+    grouped = []
 
-@router.get("/beatmapsets/{beatmapset_id}/similar")
-async def get_similar_beatmapsets(
-    beatmapset_id: int,
-    state: APIState = Depends(get_state),
+    for point in points:
+        mapset_id = point.payload["beatmapset_id"]
+        count = kept.get(mapset_id, 0)
 
-    limit: int = Query(10, le=50),
-    mode: str = "osu"
-):
-    """
-    Returns a list of beatmapsets similar to the given beatmapset.
-    """
-    session: AsyncSession = state.session_factory() # type: ignore
+        if count >= group_size or (count == 0 and len(kept) >= limit):
+            continue
 
-    # get every beatmap in the set
-    beatmaps = await session.execute(
-        select(Beatmap).where(Beatmap.beatmapset_id == beatmapset_id)
-    )
-    beatmaps = beatmaps.scalars().all()
+        kept[mapset_id] = count + 1
+        grouped.append(point)
 
-    if len(beatmaps) == 0:
-        raise HTTPException(status_code=404, detail="beatmapset not found")
+    return grouped
 
-    client = state.qdrant
-    filter_conditions = []
-    vectors = await client.retrieve(
-        collection_name="beatmap_embeddings",
-        ids=[bm.id for bm in beatmaps],
-        with_vectors=True
-    )
+def similar_filter(mode, beatmap_id, beatmapset_id, exclude: SeenSet | None = None) -> Filter:
+    must_not = [
+        FieldCondition(key="beatmap_id", match=MatchValue(value=beatmap_id)),
+        FieldCondition(key="beatmapset_id", match=MatchValue(value=beatmapset_id))
+    ]
 
-    filter_conditions.append(
-        FieldCondition(key="mode", match=MatchValue(value=mode)),
-    )
+    condition = exclude.exclude_condition() if exclude else None
+    if condition:
+        must_not.append(condition)
 
-    response = await client.query_points(
-        collection_name="beatmap_embeddings",
-        query=numpy.mean([v.vector for v in vectors], axis=0).tolist(),
-        query_filter=Filter(must=filter_conditions,must_not=[
-            FieldCondition(key="beatmapset_id", match=MatchValue(value=beatmapset_id))
-        ]),
-        limit=limit
+    return Filter(
+        must=[
+            FieldCondition(key="mode", match=MatchValue(value=mode))
+        ],
+        must_not=must_not
     )
-    
-    beatmapset_ids = list({p.payload["beatmapset_id"] for p in response.points})
-    results = []
 
-    for mapset_id in beatmapset_ids:
-        result = await session.execute(
-            select(BeatmapSet).where(BeatmapSet.id == mapset_id)
+def parse_ids(ids: str | None) -> list[int]:
+    try:
+        return [int(i) for i in ids.split(",") if i.strip()] if ids else []
+    except ValueError:
+        raise HTTPException(400, "ids must be comma separated integers")
+
+async def load_exclusions(state: APIState, session: AsyncSession, user: Principal | None, ignore: list[int]) -> SeenSet:
+    """Mapsets to leave out: everything the player has seen, plus an explicit ignore list."""
+    seen = await get_seen(state.redis, session, user.id) if user else SeenSet()
+    return seen.union(ignore)
+
+IGNORE_QUERY = Query(None, description="Comma separated mapset ids to leave out")
+
+async def similar_set_ids(
+    state: APIState,
+    beatmapset_id: int,
+    query,
+    query_filter: Filter,
+    profile: SearchProfile,
+    limit: int,
+    fetch: int,
+    exclude: SeenSet,
+) -> list[int]:
+    """Ids of the sets nearest to `query`, up to `limit` of them that aren't in `exclude`.
+
+    Exclusions qdrant couldn't filter are dropped here, so pages are fetched
+    (each twice as large as the last) until `limit` is met or the
+    collection runs out.
+    """
+    mapset_ids: list[int] = []
+    offset = 0
+
+    for _ in range(EXCLUDE_MAX_PAGES):
+        response = await state.qdrant.query_points(
+            collection_name=BEATMAPSET_COLLECTION,
+            query=query,
+            query_filter=query_filter,
+            search_params=profile.to_params(),
+            limit=fetch,
+            offset=offset,
+            with_payload=False
+        )
+        mapset_ids.extend(
+            int(p.id) for p in response.points if int(p.id) != beatmapset_id and int(p.id) not in exclude
         )
 
-        mapset = result.scalar_one_or_none()
-        if mapset:
-            # fetch beatmaps
-            await session.refresh(mapset, attribute_names=["beatmaps"])
-            results.append(mapset)
-
-    await session.close()
-    
-    return {
-        "success": True,
-        "data": results
-    }
+        if len(mapset_ids) >= limit or len(response.points) < fetch:
+            break
+        offset += fetch
+        fetch *= 2
+
+    return mapset_ids[:limit]
+
+
+@router.get("/beatmapsets/{beatmapset_id}/similar", response_model=MapsetListResponse)
+async def get_similar_beatmapsets(
+    beatmapset_id: int,
+    state: APIState = Depends(get_state),
+    session: AsyncSession = Depends(get_read_session),
+    profile: SearchProfile = Depends(search_profile("similar_beatmapset")),
 
-@router.get("/beatmaps/{beatmap_id}/similar")
+    user: Principal | None = Depends(get_optional_user),
+
+    limit: int = Query(10, le=50),
+    mode: str = "osu",
+    ignore: str = IGNORE_QUERY,
+    fields: str = FIELDS_QUERY
+):
+    """
+    Returns a list of beatmapsets similar to the given beatmapset.
+    Ignores sets already seen by the user or in a provided ignore list.
+    """
+    with timed("similar_beatmapset", "seen"):
+        exclude = await load_exclusions(state, session, user, parse_ids(ignore))
+    condition = exclude.exclude_condition()
+
+    query_filter = Filter(
+        must=[
+            FieldCondition(key="modes", match=MatchValue(value=mode))
+        ],
+        must_not=[condition] if condition else None
+    )
+    # too many exclusions to filter in qdrant, fetch more and drop them here
+    fetch = limit if condition or not exclude else limit * EXCLUDE_OVERFETCH
+
+    # the set's own point is the query, qdrant leaves it out of the results
+    try:
+        with timed("similar_beatmapset", "search"):
+            mapset_ids = await similar_set_ids(state, beatmapset_id, beatmapset_id, query_filter, profile, limit, fetch, exclude)
+    except UnexpectedResponse as e:
+        if e.status_code != 404:
+            raise
+        mapset_ids = None
+    except ValueError:
+        # local mode raises this for a missing point instead
+        mapset_ids = None
+
+    if mapset_ids is None:
+        # stored but not backfilled yet, build its point from the difficulties
+        with timed("similar_beatmapset", "backfill"):
+            point = await backfill_beatmapset_embedding(state.qdrant, beatmapset_id)
+        if point is None:
+            result = await session.execute(select(BeatmapSet.id).where(BeatmapSet.id == beatmapset_id))
+            if result.scalar_one_or_none() is None:
+                raise HTTPException(status_code=404, detail="beatmapset not found")
+            raise HTTPException(status_code=404, detail="embedding not found for beatmapset")
+
+        with timed("similar_beatmapset", "search"):
+            mapset_ids = await similar_set_ids(state, beatmapset_id, point.vector, query_filter, profile, limit, fetch, exclude)
+
+    with timed("similar_beatmapset", "hydrate"):
+        results = await fetch_mapsets(session, mapset_ids)
+
+    return mapsets_response(results, parse_fields(fields))
+
+@router.get("/beatmaps/{beatmap_id}/similar", response_model=MapsetListResponse)
 async def get_similar_beatmapsets_from_beatmap(
     beatmap_id: int,
     state: APIState = Depends(get_state),
+    session: AsyncSession = Depends(get_read_session),
+    profile: SearchProfile = Depends(search_profile("similar_beatmap")),
+    user: Principal | None = Depends(get_optional_user),
 
-    limit: int = Query(10, le=50)
+    limit: int = Query(10, le=50),
+    ignore: str = IGNORE_QUERY,
+    fields: str = FIELDS_QUERY
 ):
-    
+
     """
     Returns a list of beatmaps similar to the given beatmap.
     Ignores sets already seen by the user or in a provided ignore list.
     """
-    session: AsyncSession = state.session_factory() # type: ignore
-
-    result = await session.execute(select(Beatmap).where(Beatmap.id == beatmap_id))
-    original = result.scalar_one_or_none()
+    with timed("similar_beatmap", "lookup"):
+        result = await session.execute(select(Beatmap).where(Beatmap.id == beatmap_id))
+        original = result.scalar_one_or_none()
     if not original:
         raise HTTPException(404, detail="beatmap not found")
-    
+
     # retrieve the vector for the beatmap
     client = state.qdrant
-    vectors = await client.retrieve(
-        collection_name="beatmap_embeddings",
-        ids=[original.id],
-        with_vectors=True
-    )
+    with timed("similar_beatmap", "retrieve"):
+        vectors = await client.retrieve(
+            collection_name=BEATMAP_COLLECTION,
+            ids=[original.id],
+            with_payload=SIMILARITY_PAYLOAD_FIELDS,
+            with_vectors=True
+        )
     if not vectors or vectors[0].vector is None:
         raise HTTPException(404, detail="embedding not found for beatmap")
-    
-    query_vector = vectors[0].vector
-
-    response = await client.query_points(
-        collection_name="beatmap_embeddings",
-        query=query_vector,
-        query_filter=Filter(
-            must=[
-                FieldCondition(key="mode", match=MatchValue(value=original.mode))
-            ],
-            must_not = [
-                FieldCondition(key="beatmap_id", match=MatchValue(value=original.id)),
-                FieldCondition(key="beatmapset_id", match=MatchValue(value=original.beatmapset_id))
-            ]
-        ),
-        limit=CANDIDATE_LIMIT
-    )
 
-    
-    candidate_points = response.points
+    with timed("similar_beatmap", "seen"):
+        exclude = await load_exclusions(state, session, user, parse_ids(ignore))
+
+    # grouped by mapset, so a set with many difficulties can't take most of
+    # the candidates and every candidate is a set that can be returned
+    with timed("similar_beatmap", "search"):
+        response = await client.query_points_groups(
+            collection_name=BEATMAP_COLLECTION,
+            query=vectors[0].vector,
+            group_by="beatmapset_id",
+            group_size=GROUP_SIZE,
+            query_filter=similar_filter(original.mode, original.id, original.beatmapset_id, exclude),
+            search_params=profile.to_params(),
+            limit=CANDIDATE_GROUPS,
+            with_payload=SIMILARITY_PAYLOAD_FIELDS
+        )
+
+    # back in plain score order, like the batch endpoint sees them, so both
+    # break re-ranking ties the same way
+    candidate_points = sorted(
+        (hit for group in response.groups for hit in group.hits), key=lambda hit: hit.score, reverse=True
+    )
     if not candidate_points:
-        await session.close()
-        return {"success": True, "data": []}
+        return mapsets_response([])
 
-    # fetch Beatmap objects for weighting
-    candidate_ids = [p.id for p in candidate_points]
-    result = await session.execute(select(Beatmap).where(Beatmap.id.in_(candidate_ids)))
+    with timed("similar_beatmap", "score"):
+        scores = similarity_scores(
+            [vectors[0].payload],
+            [point.payload for point in candidate_points],
+            numpy.zeros(len(candidate_points)),
+        )
+        ranked = rank_mapsets(candidate_points, scores, limit, exclude)
+
+    with timed("similar_beatmap", "hydrate"):
+        results = await fetch_mapsets(session, ranked)
+
+    return mapsets_response(results, parse_fields(fields))
+
+@router.post("/beatmaps/similar:batch", response_model=SimilarBatchResponse)
+async def get_similar_beatmapsets_batch(
+    body: SimilarBatchRequest,
+    state: APIState = Depends(get_state),
+    session: AsyncSession = Depends(get_read_session),
+    profile: SearchProfile = Depends(search_profile("similar_beatmap")),
+    user: Principal | None = Depends(get_optional_user),
+
+    fields: str = FIELDS_QUERY
+):
+    """
+    Same as `/beatmaps/{beatmap_id}/similar` for many beatmaps at once.
+
+    Returns the similar mapsets keyed by beatmap id, ids without an
+    embedding are listed in `missing` instead.
+    """
+    include = parse_fields(fields)
+    beatmap_ids = list(dict.fromkeys(body.ids))
+    with timed("similar_batch", "seen"):
+        exclude = await load_exclusions(state, session, user, body.ignore)
 
-    weighted_candidates = []
+    client = state.qdrant
+    with timed("similar_batch", "retrieve"):
+        originals = await client.retrieve(
+            collection_name=BEATMAP_COLLECTION,
+            ids=beatmap_ids,
+            with_payload=SIMILARITY_PAYLOAD_FIELDS,
+            with_vectors=True
+        )
+    originals = [o for o in originals if o.vector is not None]
+
+    found = {int(o.id) for o in originals}
+    missing = [beatmap_id for beatmap_id in beatmap_ids if beatmap_id not in found]
+
+    if not originals:
+        return orjson_response({"success": True, "data": {}, "missing": missing})
+
+    with timed("similar_batch", "search"):
+        responses = await client.query_batch_points(
+            collection_name=BEATMAP_COLLECTION,
+            requests=[
+                QueryRequest(
+                    query=o.vector,
+                    filter=similar_filter(o.payload["mode"], int(o.id), o.payload["beatmapset_id"], exclude),
+                    params=profile.to_params(),
+                    limit=CANDIDATE_LIMIT,
+                    with_payload=SIMILARITY_PAYLOAD_FIELDS
+                )
+                for o in originals
+            ],
+        )
 
-    for point in candidate_points:
-        overall_score = total_similarity(
-            vectors[0].payload,
-            point.payload,
+    with timed("similar_batch", "score"):
+        # qdrant has no batched grouped query, so group each response here to
+        # re-rank the same candidates as the single lookup would
+        grouped = [group_points(resp.points) for resp in responses]
+
+        # re-rank every candidate of every query together
+        candidate_points = [point for points in grouped for point in points]
+        groups = numpy.repeat(numpy.arange(len(grouped)), [len(points) for points in grouped])
+
+        scores = similarity_scores(
+            [o.payload for o in originals],
+            [point.payload for point in candidate_points],
+            groups,
         )
 
-        weighted_candidates.append((overall_score, point))
-    
-    weighted_candidates.sort(key=lambda x: x[0], reverse=True)
-
-    
-    for score, candidate in weighted_candidates:
-        orig = vectors[0].payload
-        cand = candidate.payload
-        print(cand["title"])
-
-        if "Painters" in cand["title"]:
-
-            print(orig["user_tags"])
-            print(cand["user_tags"])
-            print(f"score: {score} - original: {orig["title"]} / candidate: {cand["title"]}")
-            print("")
-
-    seen_mapsets = set()
-    results = []
-
-    for _, bm in weighted_candidates:
-        mapset_id = bm.payload["beatmapset_id"]
-        if mapset_id not in seen_mapsets:
-            seen_mapsets.add(mapset_id)
-            result = await session.execute(select(BeatmapSet).where(BeatmapSet.id == mapset_id))
-            mapset = result.scalar_one_or_none()
-            if mapset:
-                # populate beatmaps in the set
-                await session.refresh(mapset, attribute_names=["beatmaps"])
-                results.append(mapset)
-        if len(results) >= limit:
-            break
+        ranked: dict[int, list[int]] = {}
+        start = 0
+        for original, points in zip(originals, grouped):
+            end = start + len(points)
+            ranked[int(original.id)] = rank_mapsets(candidate_points[start:end], scores[start:end], body.limit, exclude)
+            start = end
+
+    # hydrate and serialize every mapset once, however many results share it
+    with timed("similar_batch", "hydrate"):
+        mapset_ids = list(dict.fromkeys(mapset_id for ids in ranked.values() for mapset_id in ids))
+        mapsets = await fetch_mapsets(session, mapset_ids)
+        serialized = dict(zip((mapset.id for mapset in mapsets), serialize_mapsets(mapsets, include)))
+
+    data = {
+        str(beatmap_id): [serialized[mapset_id] for mapset_id in ids if mapset_id in serialized]
+        for beatmap_id, ids in ranked.items()
+    }
 
-    await session.close()
-    return {"success": True, "data": results}
+    return orjson_response({"success": True, "data": data, "missing": missing})
@@ -1,143 +1,349 @@
+import json
+import time
+import secrets
+import asyncio
+from dataclasses import dataclass
 from fastapi import APIRouter, HTTPException, Query, Depends
-from .state import APIState, get_state
+from fastapi.responses import StreamingResponse
+from .state import APIState, get_state, get_read_session
+from .beatmaps import group_points
+from .models import MapsetListResponse, FIELDS_QUERY, parse_fields, mapsets_response, serialize_mapset
 from app.util.api import get_current_user
-from app.database.beatmaps import Beatmap, BeatmapSet
-from app.database.players import Player, PlayerActivity
+from app.util.auth import Principal
+from app.database.beatmaps import fetch_mapsets
+from app.database.embeddings import BEATMAP_COLLECTION, BEATMAPSET_COLLECTION
+from app.database.players import Player
 from sqlalchemy.ext.asyncio import AsyncSession
-from qdrant_client.models import Filter,FieldCondition,QueryRequest,MatchValue,ScoredPoint
-from sqlalchemy import select
-from itertools import chain
+from qdrant_client.models import Filter,FieldCondition,MatchValue,QueryRequest
+from redis import asyncio as aioredis
 from app.database.groups import Permissions
+from app.util.search import SearchProfile, search_profile, get_search_profile, describe_profile
+from app.util.seen import SeenSet, get_seen
+from app.util.feeds import load_materialized_feed
+from app.util.metrics import count_cache, timed
+from app.util.weighting import FeedWeights, FeedProfile, get_feed_weights, load_mapset_weights, describe_weights
 
 router = APIRouter()
 
-ACTIVITY_WEIGHTS = {
-    "score": 1.0,
-    "favourite": 1.8,
-    "pinned": 2.8,
-    "nominated": 1.6,
-}
+CANDIDATE_LIMIT = 400  # points fetched per activity vector, a set usually has a few matching difficulties
+CANDIDATE_GROUPS = 100 # distinct mapsets kept per activity vector
+
+FEED_PAGE_LIMIT = 100          # max mapsets per page
+FEED_SNAPSHOT_SIZE = 500       # ranked mapsets kept per feed snapshot
+FEED_SNAPSHOT_TTL = 60 * 15    # how long cursors into a snapshot stay valid
+FEED_STREAM_CHUNK = 10         # mapsets hydrated per query when streaming
+
+@dataclass(frozen=True)
+class FeedTuning:
+    weights: FeedWeights
+    explain: bool = False
+    overridden: bool = False  # `?weights=` was given
+
+async def feed_tuning(
+    user: Principal = Depends(get_current_user),
+    weights: str = Query(None, include_in_schema=False),
+    explain: bool = Query(False, include_in_schema=False),
+) -> FeedTuning:
+    """Admin (`MANAGE_USERS`) only knobs for tuning the feed.
+
+    `?weights={"half_life_days": 30}` overrides `FeedWeights` for one
+    request (the feed is then ranked live), `?explain=true` ranks live and adds a `profile` with stage
+    timings and counts to the response.
+    """
+    if weights is None and not explain:
+        return FeedTuning(weights=get_feed_weights())
+
+    if not (user.effective_permissions & Permissions.MANAGE_USERS):
+        raise HTTPException(403, "insufficient permissions")
+
+    try:
+        overrides = json.loads(weights) if weights else {}
+    except json.JSONDecodeError:
+        raise HTTPException(400, "weights must be a json object")
 
-ALPHA_TAGS = 0.65     # tag overlap strength
-BETA_META = 0.25      # metadata similarity strength (unused for now)
-CANDIDATE_LIMIT = 250 # candidacy limit for vectors
+    if not isinstance(overrides, dict):
+        raise HTTPException(400, "weights must be a json object")
 
-@router.get("/feed/discovery")
+    return FeedTuning(weights=get_feed_weights(overrides), explain=explain, overridden=weights is not None)
+
+@router.get("/feed/discovery", response_model=MapsetListResponse)
 async def get_discovery_feed(
-    user: Player = Depends(get_current_user),
+    user: Principal = Depends(get_current_user),
     state: APIState = Depends(get_state),
+    session: AsyncSession = Depends(get_read_session),
+    profile: SearchProfile = Depends(search_profile("feed")),
+    tuning: FeedTuning = Depends(feed_tuning),
 
     # parameters
-    limit: int = 50,
-    mode: str = Query(None, description="Filter by osu! mode, e.g., 'osu', 'taiko', 'catch', 'mania'")
+    limit: int = Query(50, ge=1, le=FEED_PAGE_LIMIT),
+    mode: str = Query(None, description="Filter by osu! mode, e.g., 'osu', 'taiko', 'catch', 'mania'"),
+    cursor: str = Query(None, description="Cursor from a previous page, continues the same ranking"),
+    output: str = Query("json", alias="format", pattern="^(json|ndjson)$", description="ndjson streams one mapset per line"),
+    fields: str = FIELDS_QUERY
 ):
-    session: AsyncSession = state.session_factory() # type: ignore
-
-    results = await build_discovery_feed(
+    return await serve_discovery_feed(
+        state=state,
         session=session,
-        qdrant=state.qdrant,
         target_player_id=int(user.id),
         limit=limit,
         mode=mode,
-        default_mode=getattr(user, "main_mode", None),
+        default_mode=user.main_mode,
+        search=profile,
+        cursor=cursor,
+        output=output,
+        include=parse_fields(fields),
+        weights=tuning.weights,
+        explain=tuning.explain,
+        overridden=tuning.overridden or profile.overridden,
     )
-
-    return {"success": True, "data": results}
     
-@router.get("/feed/discovery/{player_id}")
+@router.get("/feed/discovery/{player_id}", response_model=MapsetListResponse)
 async def get_discovery_feed_for_player(
     player_id: int,
-    user: Player = Depends(get_current_user),
+    user: Principal = Depends(get_current_user),
     state: APIState = Depends(get_state),
+    session: AsyncSession = Depends(get_read_session),
+    profile: SearchProfile = Depends(search_profile("feed")),
+    tuning: FeedTuning = Depends(feed_tuning),
 
     # parameters
-    limit: int = 50,
-    mode: str = Query(None, description="Filter by osu! mode, e.g., 'osu', 'taiko', 'catch', 'mania'")
+    limit: int = Query(50, ge=1, le=FEED_PAGE_LIMIT),
+    mode: str = Query(None, description="Filter by osu! mode, e.g., 'osu', 'taiko', 'catch', 'mania'"),
+    cursor: str = Query(None, description="Cursor from a previous page, continues the same ranking"),
+    output: str = Query("json", alias="format", pattern="^(json|ndjson)$", description="ndjson streams one mapset per line"),
+    fields: str = FIELDS_QUERY
 ):
     if not (user.effective_permissions & Permissions.VIEW_OTHERS_FEED):
         raise HTTPException(403, "insufficient permissions")
 
-    session: AsyncSession = state.session_factory() # type: ignore
-
     player = await session.get(Player, player_id)
 
     if not player:
         raise HTTPException(404, "player not found")
 
-    results = await build_discovery_feed(
+    return await serve_discovery_feed(
+        state=state,
         session=session,
-        qdrant=state.qdrant,
         target_player_id=player.id,
         limit=limit,
         mode=mode,
-        default_mode=None,  # let helper fetch target player's main_mode
+        default_mode=player.main_mode,
+        search=profile,
+        cursor=cursor,
+        output=output,
+        include=parse_fields(fields),
+        weights=tuning.weights,
+        explain=tuning.explain,
+        overridden=tuning.overridden or profile.overridden,
+    )
+
+
+# -----------------------
+# pagination
+
+def make_cursor(snapshot_id: str, offset: int) -> str:
+    return f"{snapshot_id}:{offset}"
+
+def parse_cursor(cursor: str) -> tuple[str, int]:
+    snapshot_id, _, offset = cursor.partition(":")
+
+    if not snapshot_id or not offset.isdigit():
+        raise HTTPException(400, "invalid cursor")
+
+    return snapshot_id, int(offset)
+
+def snapshot_key(target_player_id, snapshot_id: str) -> str:
+    return f"pandemonium:feed_snapshot:{target_player_id}:{snapshot_id}"
+
+async def store_feed_snapshot(redis: aioredis.Redis, target_player_id, ranked: list[int], generated_at: int) -> str:
+    snapshot_id = secrets.token_urlsafe(8)
+    await redis.setex(
+        snapshot_key(target_player_id, snapshot_id),
+        FEED_SNAPSHOT_TTL,
+        json.dumps({"ranked": ranked, "generated_at": generated_at}),
     )
 
-    return {"success": True, "data": results}
+    return snapshot_id
 
+async def load_feed_snapshot(redis: aioredis.Redis, target_player_id, snapshot_id: str) -> tuple[list[int], int] | None:
+    raw = await redis.get(snapshot_key(target_player_id, snapshot_id))
+    if raw is None:
+        return None
 
-async def build_discovery_feed(
+    data = json.loads(raw)
+    return data["ranked"], data["generated_at"]
+
+async def serve_discovery_feed(
+    state: APIState,
+    session: AsyncSession,
+    target_player_id,
+    limit: int,
+    mode: str | None,
+    default_mode,
+    search: SearchProfile,
+    cursor: str | None,
+    output: str,
+    include: dict | None = None,
+    weights: FeedWeights | None = None,
+    explain: bool = False,
+    overridden: bool = False,
+):
+    """Serve one page of the feed for `target_player_id`.
+
+    The first page serves the feed precomputed by the feed workers if there
+    is one for this mode, otherwise ranks it live, and stores the ranked
+    mapset ids as a snapshot in redis; cursors point into that snapshot, so
+    later pages are stable and skip ranking entirely (their `mode` is ignored).
+    `generated_at` in the response says when the ranking was computed.
+    `explain` always ranks live and adds the ranking's profile, so does
+    `overridden` (admin weight or search overrides, which the precomputed
+    feed wasn't ranked with).
+    """
+    extra = {}
+
+    if cursor:
+        snapshot_id, offset = parse_cursor(cursor)
+        snapshot = await load_feed_snapshot(state.redis, target_player_id, snapshot_id)
+
+        if snapshot is None:
+            raise HTTPException(410, "cursor expired, request the feed again without a cursor")
+
+        ranked, generated_at = snapshot
+    else:
+        with timed("feed", "seen"):
+            seen = await get_seen(state.redis, session, target_player_id)
+
+        feed_mode = mode or default_mode
+        materialized = None
+        if feed_mode and not explain and not overridden:
+            materialized = await load_materialized_feed(state.redis, target_player_id, feed_mode)
+            count_cache("materialized_feed", hits=int(materialized is not None), misses=int(materialized is None))
+
+        if materialized:
+            # maps played since the feed was computed still get dropped
+            ranked = [mapset_id for mapset_id in materialized.ranked if mapset_id not in seen]
+            generated_at = materialized.generated_at
+        else:
+            profile = FeedProfile()
+            ranked = await rank_discovery_feed(
+                session=session,
+                qdrant=state.qdrant,
+                target_player_id=target_player_id,
+                mode=mode,
+                default_mode=default_mode,
+                search=search,
+                seen=seen,
+                weights=weights,
+                profile=profile,
+            )
+            generated_at = int(time.time())
+
+            if explain:
+                extra["profile"] = {
+                    **profile.as_dict(),
+                    "weights": describe_weights(weights or get_feed_weights()),
+                    "search": describe_profile(search),
+                }
+
+        snapshot_id = await store_feed_snapshot(state.redis, target_player_id, ranked, generated_at)
+        offset = 0
+
+    page = ranked[offset:offset + limit]
+    next_cursor = make_cursor(snapshot_id, offset + limit) if offset + limit < len(ranked) else None
+
+    if output == "ndjson":
+        return StreamingResponse(
+            stream_mapsets(session, page, next_cursor, generated_at, include, extra),
+            media_type="application/x-ndjson",
+        )
+
+    with timed("feed", "hydrate"):
+        mapsets = await fetch_mapsets(session, page)
+
+    return mapsets_response(mapsets, include, cursor=next_cursor, generated_at=generated_at, **extra)
+
+async def stream_mapsets(
+    session: AsyncSession,
+    mapset_ids: list[int],
+    next_cursor: str | None,
+    generated_at: int,
+    include: dict | None = None,
+    extra: dict | None = None,
+):
+    """Yield `{"data": mapset}` lines as mapsets are hydrated, then a final `{"cursor": ...}` line."""
+    for start in range(0, len(mapset_ids), FEED_STREAM_CHUNK):
+        for mapset in await fetch_mapsets(session, mapset_ids[start:start + FEED_STREAM_CHUNK]):
+            yield b'{"data":' + serialize_mapset(mapset, include) + b'}\n'
+
+    yield json.dumps({"success": True, "cursor": next_cursor, "generated_at": generated_at, **(extra or {})}).encode() + b"\n"
+
+
+# -----------------------
+# ranking
+
+async def rank_discovery_feed(
     session: AsyncSession,
     qdrant,
     target_player_id,
-    limit: int = 50,
     mode: str | None = None,
     default_mode=None,
-):
-    """Build discovery feed for `target_player_id` and return list[BeatmapSet].
+    search: SearchProfile | None = None,
+    max_results: int = FEED_SNAPSHOT_SIZE,
+    seen: SeenSet | None = None,
+    weights: FeedWeights | None = None,
+    profile: FeedProfile | None = None,
+) -> list[int]:
+    """Rank discovery candidates for `target_player_id`, returns mapset ids best first.
 
     - If `mode` is provided it is used as a filter; otherwise `default_mode` or
       the target player's `main_mode` is used.
+    - `search` controls the vector search accuracy, defaulting to the "feed" profile.
+    - mapsets in `seen` are left out, in the qdrant filter when it's small enough.
+    - `weights` decides how activity is weighed, see `FeedWeights`; stage
+      timings and counts are recorded into `profile` if one is given.
+    - `session` is owned by the caller and left open.
     """
-    # load activity rows for the target player
-    activity_rows = await session.execute(
-        select(
-            PlayerActivity.type,
-            PlayerActivity.map_id,
-            PlayerActivity.mapset_id
-        )
-        .where(PlayerActivity.player_id == target_player_id)
-        .order_by(PlayerActivity.created_at.desc())
-    )
+    search = search or get_search_profile("feed")
+    weights = weights or get_feed_weights()
+    profile = profile if profile is not None else FeedProfile()
 
-    activity_rows = activity_rows.all()
+    # one aggregate query weighs every activity row and returns the
+    # heaviest mapsets, these are what candidates get searched around
+    with profile.stage("weights"):
+        sources = await load_mapset_weights(session, target_player_id, weights, profile)
 
-    if not activity_rows:
+    if not sources:
         raise HTTPException(404, "no activity found for this user")
 
-    activity_weight_map: dict[int, float] = {}
-    beatmap_ids: set[int] = set()
-
-    for activity_type, map_id, mapset_id in activity_rows:
-        if mapset_id is None and map_id is not None:
-            r = await session.execute(
-                select(Beatmap.beatmapset_id).where(Beatmap.id == map_id)
-            )
-            mapset_id = r.scalar_one_or_none()
-
-        if mapset_id is None:
-            continue
-
-        w = ACTIVITY_WEIGHTS.get(activity_type, 1.0)
-        activity_weight_map[mapset_id] = activity_weight_map.get(mapset_id, 1.0) + w
-
-        if map_id is not None:
-            beatmap_ids.add(map_id)
-        else:
-            r = await session.execute(
-                select(Beatmap.id).where(Beatmap.beatmapset_id == mapset_id)
-            )
-            ids = [bm_id for (bm_id,) in r.all()]
-            beatmap_ids.update(ids)
+    # played difficulties are queried directly, sets without any (e.g.
+    # favourites) through their set level vector
+    with profile.stage("vectors"):
+        beatmap_sources = {map_id: source for source in sources for map_id in source.map_ids}
+        set_sources = {source.mapset_id: source for source in sources if not source.map_ids}
+
+        beatmap_vectors, set_vectors = await asyncio.gather(
+            qdrant.retrieve(
+                collection_name=BEATMAP_COLLECTION,
+                ids=list(beatmap_sources),
+                with_payload=False,
+                with_vectors=True,
+            ) if beatmap_sources else asyncio.sleep(0, []),
+            qdrant.retrieve(
+                collection_name=BEATMAPSET_COLLECTION,
+                ids=list(set_sources),
+                with_payload=False,
+                with_vectors=True,
+            ) if set_sources else asyncio.sleep(0, []),
+        )
 
-    vectors = await qdrant.retrieve(
-        collection_name="beatmap_embeddings",
-        ids=list(beatmap_ids),
-        with_vectors=True,
-    )
+    queries = [
+        (v.vector, beatmap_sources[int(v.id)].weight) for v in beatmap_vectors if v.vector is not None
+    ] + [
+        (v.vector, set_sources[int(v.id)].weight) for v in set_vectors if v.vector is not None
+    ]
+    profile.counts["queries"] = len(queries)
 
-    query_vectors = [v.vector for v in vectors if v.vector is not None]
-    if not query_vectors:
+    if not queries:
         raise HTTPException(500, "no candidates available for user activity. this is a server mistake, so if you get this error please report it!")
 
     filter_must = []
@@ -153,36 +359,47 @@ async def build_discovery_feed(
         if chosen_mode is not None:
             filter_must.append(FieldCondition(key="mode", match=MatchValue(value=chosen_mode)))
 
-    q_filter = Filter(must=filter_must)
-    responses = await qdrant.query_batch_points(
-        collection_name="beatmap_embeddings",
-        requests=[
-            QueryRequest(query=vector, filter=q_filter, limit=CANDIDATE_LIMIT, with_payload=True)
-            for vector in query_vectors
-        ],
-    )
+    # one batched search for every source, grouped by mapset here (qdrant has
+    # no batched grouped query) so every candidate is a distinct set, the
+    # best difficulty per set is all the scoring below looks at
+    seen = seen or SeenSet()
+    exclude = seen.exclude_condition()
+
+    q_filter = Filter(must=filter_must, must_not=[exclude] if exclude else None)
+    with profile.stage("search"):
+        responses = await qdrant.query_batch_points(
+            collection_name=BEATMAP_COLLECTION,
+            requests=[
+                QueryRequest(
+                    query=vector,
+                    filter=q_filter,
+                    params=search.to_params(),
+                    limit=CANDIDATE_LIMIT,
+                    with_payload=["beatmapset_id"],
+                )
+                for vector, _ in queries
+            ],
+        )
+        grouped = [group_points(resp.points, limit=CANDIDATE_GROUPS, group_size=1) for resp in responses]
 
-    candidate_points = list(chain.from_iterable(resp.points for resp in responses))
-    if not candidate_points:
+    profile.counts["candidates"] = sum(len(points) for points in grouped)
+    if not profile.counts["candidates"]:
         raise HTTPException(500, "no candidates available for user activity. this is a server mistake, so if you get this error please report it!")
 
-    scored_mapsets: dict[int, tuple[float, ScoredPoint]] = {}
-    for point in candidate_points:
-        mapset_id = int(point.payload["beatmapset_id"])
-        base_sim = point.score
-        activity_w = activity_weight_map.get(mapset_id, 1.0)
-        final_score = base_sim * activity_w
-        if mapset_id not in scored_mapsets or final_score > scored_mapsets[mapset_id][0]:
-            scored_mapsets[mapset_id] = (final_score, point)
-
-    sorted_mapsets = sorted(scored_mapsets.items(), key=lambda x: x[1][0], reverse=True)[:limit]
-    results: list[BeatmapSet] = []
-    for mapset_id, _ in sorted_mapsets:
-        result = await session.execute(select(BeatmapSet).where(BeatmapSet.id == mapset_id))
-        mapset = result.scalar_one_or_none()
-        if mapset:
-            await session.refresh(mapset, attribute_names=["beatmaps"])
-            results.append(mapset)
-
-    await session.close()
-    return results
+    # a candidate scores its best similarity to any source, scaled by
+    # how much that source weighs
+    with profile.stage("score"):
+        scored_mapsets: dict[int, float] = {}
+        for (_, source_weight), points in zip(queries, grouped):
+            for point in points:
+                mapset_id = int(point.payload["beatmapset_id"])
+                if mapset_id in seen:
+                    continue
+
+                final_score = point.score * source_weight
+                if final_score > scored_mapsets.get(mapset_id, float("-inf")):
+                    scored_mapsets[mapset_id] = final_score
+
+        sorted_mapsets = sorted(scored_mapsets.items(), key=lambda x: x[1], reverse=True)[:max_results]
+
+    return [mapset_id for mapset_id, _ in sorted_mapsets]
@@ -0,0 +1,25 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import JSONResponse, Response
+from .state import APIState, get_state
+from app.util.metrics import render_metrics
+
+router = APIRouter()
+
+@router.get("/health/ready")
+async def ready(
+    state: APIState = Depends(get_state)
+):
+    problems = await state.check_ready()
+
+    if problems:
+        return JSONResponse(status_code=503, content={"success": False, "data": problems})
+
+    return {"success": True, "data": []}
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics(
+    state: APIState = Depends(get_state)
+):
+    """Prometheus metrics of this process, including workers running in it."""
+    body, content_type = await render_metrics(state.redis)
+    return Response(content=body, media_type=content_type)
@@ -0,0 +1,113 @@
+import orjson
+from typing import Any, Iterable, Optional
+from fastapi import HTTPException, Query, Response
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
+from app.database.beatmaps import BeatmapSet
+
+class BeatmapModel(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    beatmapset_id: int
+    difficulty_name: Optional[str] = None
+    mode: Optional[str] = None
+    bpm: Optional[float] = None
+    cs: Optional[float] = None
+    ar: Optional[float] = None
+    od: Optional[float] = None
+    hp: Optional[float] = None
+    star_rating: Optional[float] = None
+    total_length: Optional[int] = None
+    hit_object_count: Optional[int] = None
+    approved_date: Optional[int] = None
+    extra_metadata: Optional[dict[str, Any]] = None
+
+class BeatmapSetModel(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    artist: Optional[str] = None
+    title: Optional[str] = None
+    creator: Optional[str] = None
+    source: Optional[str] = None
+    genre: Optional[int] = None
+    language: Optional[int] = None
+    tags: Optional[list[str]] = None
+    status: Optional[int] = None
+    play_count: Optional[int] = None
+    favourite_count: Optional[int] = None
+    last_synced_at: Optional[int] = None
+    beatmaps: list[BeatmapModel] = []
+
+class MapsetListResponse(BaseModel):
+    """Documentation only, handlers return pre-serialized `Response`s."""
+    success: bool
+    data: list[BeatmapSetModel]
+    cursor: Optional[str] = None
+    generated_at: Optional[int] = None  # feeds only, when the ranking was computed
+
+class SimilarBatchRequest(BaseModel):
+    ids: list[int] = Field(..., min_length=1, max_length=50, description="Beatmap ids to find similar mapsets for")
+    limit: int = Field(10, ge=1, le=50, description="Mapsets per beatmap")
+    ignore: list[int] = Field([], max_length=1000, description="Mapset ids to leave out")
+
+class SimilarBatchResponse(BaseModel):
+    """Documentation only, keyed by the requested beatmap ids."""
+    success: bool
+    data: dict[int, list[BeatmapSetModel]]
+    missing: list[int] = []
+
+class QueueItemsRequest(BaseModel):
+    ids: list[int] = Field(..., min_length=1, max_length=10_000, description="Mapset or player ids, depending on the queue")
+    front: bool = Field(False, description="Queue at the head instead of the tail, enqueue only")
+
+MAPSET_LIST = TypeAdapter(list[BeatmapSetModel])
+
+FIELDS_QUERY = Query(
+    None,
+    description="Comma separated fields to return, e.g. `id,title,beatmaps.id,beatmaps.star_rating`",
+)
+
+def parse_fields(fields: Optional[str]) -> Optional[dict]:
+    """Turn `fields=id,beatmaps.star_rating` into a pydantic include spec for one mapset."""
+    if not fields:
+        return None
+
+    include: dict[str, Any] = {}
+
+    for field in fields.split(","):
+        field = field.strip()
+        if not field:
+            continue
+
+        name, _, sub = field.partition(".")
+
+        if name not in BeatmapSetModel.model_fields:
+            raise HTTPException(400, f"unknown field: {name}")
+
+        if not sub:
+            include[name] = True
+            continue
+
+        if name != "beatmaps" or sub not in BeatmapModel.model_fields:
+            raise HTTPException(400, f"unknown field: {field}")
+
+        beatmap_fields = include.setdefault("beatmaps", {"__all__": {}})
+        if beatmap_fields is not True:
+            beatmap_fields["__all__"][sub] = True
+
+    return include or None
+
+def serialize_mapsets(mapsets: Iterable[BeatmapSet], include: Optional[dict] = None) -> list[dict]:
+    models = MAPSET_LIST.validate_python(list(mapsets), from_attributes=True)
+    return MAPSET_LIST.dump_python(models, include={"__all__": include} if include else None)
+
+def serialize_mapset(mapset: BeatmapSet, include: Optional[dict] = None) -> bytes:
+    return BeatmapSetModel.model_validate(mapset).model_dump_json(include=include).encode()
+
+def orjson_response(content: Any) -> Response:
+    return Response(content=orjson.dumps(content), media_type="application/json")
+
+def mapsets_response(mapsets: Iterable[BeatmapSet], include: Optional[dict] = None, **extra) -> Response:
+    """Serialize a `{"success": true, "data": [...mapsets], **extra}` response with orjson."""
+    return orjson_response({"success": True, "data": serialize_mapsets(mapsets, include), **extra})
@@ -4,7 +4,8 @@ from fastapi import APIRouter, HTTPException, Query, Depends
 from fastapi.responses import RedirectResponse
 from .state import APIState, get_state
 import app.settings as settings
-from app.util import generate_state, exchange_code_for_token, get_osu_self, generate_session_token
+from app.util import generate_state, exchange_code_for_token, get_osu_self, generate_session_token, OSU_AUTHORIZE_URL
+from app.util.queues import PLAYER_QUEUE, enqueue
 
 router = APIRouter()
 
@@ -22,13 +23,13 @@ async def login(
     }
 
     await state.redis.setex(f"pandemonium:oauth_state:{state_token}", 300, "1")
-    return RedirectResponse(f"https://osu.ppy.sh/oauth/authorize?{urllib.urlencode(params)}")
+    return RedirectResponse(f"{OSU_AUTHORIZE_URL}?{urllib.urlencode(params)}")
 
 @router.get("/oauth/callback")
 async def callback(
     code: str = Query(),
     state: str = Query(),
-    api_state: APIState = Depends(get_state)
+    api_state: APIState = Depends(get_state),
 ):
     key = f"pandemonium:oauth_state:{state}"
     exists = await api_state.redis.get(key)
@@ -38,12 +39,16 @@ async def callback(
     
     await api_state.redis.delete(key)
 
-    tokens = await exchange_code_for_token(code)
-    myself = await get_osu_self(tokens["access_token"])
+    tokens = await exchange_code_for_token(api_state.http, code)
+    myself = await get_osu_self(api_state.http, tokens["access_token"])
 
-    # enqueue the player to the redis queue for processing
+    # permissions and main mode are resolved per request (and cached), so
+    # the token only says who this is
     session_token = generate_session_token(myself["id"])
-    await api_state.redis.lpush("pandemonium:player_queue", myself["id"])
+
+    # queue the player for processing ahead of everyone else, through the
+    # priority list even when they're already waiting behind a crawl
+    await enqueue(api_state.redis, PLAYER_QUEUE, [myself["id"]], front=True)
 
     return {
         "success": True,
@@ -1,41 +1,165 @@
+import asyncio
+import time
 import app.settings as settings
+from typing import AsyncIterator, Optional
+from fastapi import Depends, Request
+from app.database import create_engine, create_sessionmaker
+from app.database.embeddings import check_collection
+from app.resources import Resources, ProcessRole
+from app.logger import api_logger
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
 
-from ossapi import OssapiAsync
-from qdrant_client import AsyncQdrantClient
-from qdrant_client.http.models import VectorParams, Distance
-from app.database import async_session
-from sqlalchemy.orm import sessionmaker, Session
-from redis import asyncio as aioredis
+# seconds the replica is behind the primary, 0 on a primary. an idle primary
+# doesn't move pg_last_xact_replay_timestamp forward, so a replica that has
+# replayed everything it received counts as caught up
+REPLICA_LAG_QUERY = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
 
-class APIState:
-    session_factory: sessionmaker[Session]
-    qdrant: AsyncQdrantClient
-    redis: aioredis.Redis
-    osu: OssapiAsync
+class APIState(Resources):
+    """
+    The api's resources. With PG_REPLICA_HOST set it also holds a pool to
+    the replica, which `read_session` hands out while it's fresh enough.
+    """
+    replica_engine: Optional[AsyncEngine] = None
+    replica_session_factory: Optional[async_sessionmaker[AsyncSession]] = None
+
+    def __init__(self) -> None:
+        super().__init__(ProcessRole.API)
+        self._replica_lag: tuple[float, Optional[float]] | None = None  # (checked at, lag)
+        self._replica_monitor: Optional[asyncio.Task] = None
 
     async def init(self):
-        self.session_factory = async_session
-        self.redis = await aioredis.from_url(
-            f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_DB}",
-            decode_responses=True
-        )
-        self.osu = OssapiAsync(
-            settings.OSU_API_CLIENT_ID,
-            settings.OSU_API_CLIENT_SECRET
-        )
-        
-        self.qdrant = AsyncQdrantClient(url=settings.QDRANT_URL,api_key=settings.QDRANT_API_KEY)
-        pass
-
-global_state = None
-
-async def get_state():
-    global global_state
-    
-    if global_state is None:
-        global_state = APIState()
-        await global_state.init()
-
-        return global_state
-    else:
-        return global_state
\ No newline at end of file
+        if self._initialized:
+            return
+
+        await super().init()
+
+        if settings.PG_REPLICA_DSN:
+            self.replica_engine = create_engine(
+                pool_size=self.limits.pg_pool_size,
+                max_overflow=self.limits.pg_max_overflow,
+                dsn=settings.PG_REPLICA_DSN,
+            )
+            self.replica_session_factory = create_sessionmaker(self.replica_engine)
+
+    async def close(self):
+        if self._replica_monitor is not None:
+            self._replica_monitor.cancel()
+            self._replica_monitor = None
+
+        if self._initialized and self.replica_engine is not None:
+            await self.replica_engine.dispose()
+
+        await super().close()
+
+    async def check_replica_lag(self) -> Optional[float]:
+        """Measure how far the replica is behind, None if it can't be reached."""
+        if self.replica_engine is None:
+            return None
+
+        try:
+            async with asyncio.timeout(settings.PG_REPLICA_LAG_CHECK_INTERVAL):
+                async with self.replica_engine.connect() as conn:
+                    lag = float((await conn.execute(REPLICA_LAG_QUERY)).scalar_one())
+        except Exception as e:
+            api_logger.warning("replica unavailable, reading from the primary", extra={"error": repr(e)})
+            lag = None
+
+        self._replica_lag = (time.monotonic(), lag)
+        return lag
+
+    def start_replica_monitor(self):
+        """Keep the replica lag fresh in the background, requests only read it."""
+        if self.replica_engine is None or self._replica_monitor is not None:
+            return
+
+        async def monitor():
+            while True:
+                await asyncio.sleep(settings.PG_REPLICA_LAG_CHECK_INTERVAL)
+                await self.check_replica_lag()
+
+        self._replica_monitor = asyncio.create_task(monitor())
+
+    def replica_lag(self) -> Optional[float]:
+        """Seconds the replica was behind at the last check, None without a
+        (reachable) replica or when the last check is too old to trust.
+        """
+        if self._replica_lag is None:
+            return None
+
+        checked_at, lag = self._replica_lag
+        if time.monotonic() - checked_at > settings.PG_REPLICA_LAG_CHECK_INTERVAL * 3:
+            return None
+
+        return lag
+
+    async def read_session(self) -> AsyncSession:
+        """A session for read-only queries.
+
+        The replica while it's at most PG_REPLICA_MAX_LAG seconds behind,
+        the primary otherwise. Never write through it.
+        """
+        lag = self.replica_lag()
+
+        if lag is not None and lag <= settings.PG_REPLICA_MAX_LAG:
+            return self.replica_session_factory()
+
+        return self.session_factory()
+
+    async def check_ready(self) -> list[str]:
+        """Touch every backing service once, returns a list of problems.
+
+        Besides checking readiness this opens the first connection of every
+        pool, so the first real request doesn't pay for the handshakes.
+        """
+        problems = []
+
+        try:
+            await self.redis.ping()
+        except Exception as e:
+            problems.append(f"redis: {e}")
+
+        try:
+            async with self.session_factory() as session:
+                await session.execute(text("SELECT 1"))
+        except Exception as e:
+            problems.append(f"postgres: {e}")
+
+        # not a problem if it's down, reads fall back to the primary
+        await self.check_replica_lag()
+
+        try:
+            problems.extend(await check_collection(self.qdrant))
+        except Exception as e:
+            problems.append(f"qdrant: {e}")
+
+        return problems
+
+async def get_state(request: Request) -> APIState:
+    """The process-wide `APIState`, created by the application lifespan."""
+    return request.app.state.api
+
+async def get_session(state: APIState = Depends(get_state)) -> AsyncIterator[AsyncSession]:
+    """A session scoped to the current request.
+
+    FastAPI caches dependencies per request, so authentication and the
+    handler share this session, and it's returned to the pool once the
+    response is sent, including when the handler raises.
+    """
+    async with state.session_factory() as session:
+        yield session
+
+async def get_read_session(state: APIState = Depends(get_state)) -> AsyncIterator[AsyncSession]:
+    """Like `get_session`, but possibly on the replica, see `APIState.read_session`.
+
+    For handlers that only read and can live with PG_REPLICA_MAX_LAG seconds
+    of staleness. Writes must keep using `get_session`.
+    """
+    async with await state.read_session() as session:
+        yield session
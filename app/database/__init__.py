@@ -1,19 +1,27 @@
-from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine, AsyncSession
 import app.settings as settings
 
-engine = create_async_engine(
-    settings.PG_DSN,
-    echo=False,
-    future=True,
-    pool_size=10,
-    max_overflow=20
-)
+Base = declarative_base()
 
-async_session = sessionmaker(
-    engine,
-    expire_on_commit=False,
-    class_=AsyncSession,
-)
+def create_engine(pool_size: int, max_overflow: int, dsn: str = settings.PG_DSN) -> AsyncEngine:
+    """Create an engine with an explicitly sized pool.
 
-Base = declarative_base()
\ No newline at end of file
+    Processes should create exactly one of these, through `app.resources.Resources`.
+    """
+    return create_async_engine(
+        dsn,
+        echo=False,
+        future=True,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=settings.PG_POOL_TIMEOUT,
+        pool_pre_ping=True,
+    )
+
+def create_sessionmaker(engine: AsyncEngine) -> async_sessionmaker[AsyncSession]:
+    return async_sessionmaker(
+        engine,
+        expire_on_commit=False,
+        class_=AsyncSession,
+    )
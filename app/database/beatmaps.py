@@ -1,9 +1,12 @@
 import enum
+from typing import Sequence
 from . import Base
 from sqlalchemy import (
-    Column, Integer, String, Float, JSON, Enum,
-    ForeignKey, Table, Index
+    Column, Integer, String, Float, Enum,
+    ForeignKey, Table, Index, select
 )
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import relationship
 
 class Mode(enum.StrEnum):
@@ -32,7 +35,7 @@ class BeatmapSet(Base):
 
     genre = Column(Integer)  # osu provides int, keep as-is
     language = Column(Integer)  # osu provides int, keep as-is
-    tags = Column(JSON, default=list)  # from osu api
+    tags = Column(JSONB, default=list)  # from osu api
     status = Column(Integer) # enums are dumb because sqlalchemy expects a string or something
 
     play_count = Column(Integer, default=0)
@@ -46,6 +49,10 @@ class BeatmapSet(Base):
         lazy="selectin",
     )
 
+    __table_args__ = (
+        # tag lookups, `tags @> '["touhou"]'`
+        Index("ix_beatmapsets_tags", "tags", postgresql_using="gin", postgresql_ops={"tags": "jsonb_path_ops"}),
+    )
 
 class Beatmap(Base):
     __tablename__ = "beatmaps"
@@ -65,7 +72,7 @@ class Beatmap(Base):
     hit_object_count = Column(Integer)
     approved_date = Column(Integer)  # timestamp
 
-    extra_metadata = Column(JSON, default=dict)
+    extra_metadata = Column(JSONB, default=dict)
 
     beatmapset = relationship("BeatmapSet", back_populates="beatmaps")
 
@@ -74,4 +81,23 @@ class Beatmap(Base):
         Index("ix_beatmaps_mode", "mode"),
         Index("ix_beatmaps_star", "star_rating"),
         Index("ix_beatmaps_bpm", "bpm"),
-    )
\ No newline at end of file
+        # map id -> mapset id without visiting the heap, the feed weights join
+        Index("ix_beatmaps_id_beatmapset", "id", postgresql_include=["beatmapset_id"]),
+    )
+
+
+async def fetch_mapsets(session: AsyncSession, mapset_ids: Sequence[int]) -> list[BeatmapSet]:
+    """Load mapsets ordered like `mapset_ids`, skipping ids that don't exist.
+
+    Takes two queries no matter how many ids are given: the mapsets, then
+    all of their beatmaps through the selectin-loaded relationship.
+    """
+    if not mapset_ids:
+        return []
+
+    result = await session.execute(
+        select(BeatmapSet).where(BeatmapSet.id.in_(mapset_ids))
+    )
+    by_id = {mapset.id: mapset for mapset in result.scalars().all()}
+
+    return [by_id[mapset_id] for mapset_id in mapset_ids if mapset_id in by_id]
@@ -0,0 +1,352 @@
+import numpy
+import app.settings as settings
+
+from typing import Sequence
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.http.models import (
+    PayloadSchemaType, VectorParams, Distance, HnswConfigDiff,
+    ScalarQuantization, ScalarQuantizationConfig, ScalarType, Disabled,
+    PointStruct, Filter, FieldCondition, MatchAny
+)
+
+BEATMAP_COLLECTION = "beatmap_embeddings"
+BEATMAPSET_COLLECTION = "beatmapset_embeddings"
+# redis key set once `backfill_beatmapset_embeddings` ran to the end
+BEATMAPSET_BACKFILLED_KEY = "pandemonium:beatmapset_embeddings:backfilled"
+BEATMAP_VECTOR_SIZE = 512
+
+# every payload field we filter or group on in `beatmap_embeddings`.
+# this is the single place indexes are declared, anything that needs
+# a new filter should add its field here first
+BEATMAP_PAYLOAD_INDEXES: dict[str, PayloadSchemaType] = {
+    "beatmapset_id": PayloadSchemaType.INTEGER,
+    "beatmap_id": PayloadSchemaType.INTEGER,
+    "mode": PayloadSchemaType.KEYWORD,
+    "genre": PayloadSchemaType.INTEGER,
+    "language": PayloadSchemaType.INTEGER,
+    "star_rating": PayloadSchemaType.FLOAT,
+    "bpm": PayloadSchemaType.FLOAT,
+    "length": PayloadSchemaType.FLOAT,
+}
+
+# one point per beatmapset, id = beatmapset id, vector = mean of its
+# difficulties' vectors (see `beatmapset_point`)
+BEATMAPSET_PAYLOAD_INDEXES: dict[str, PayloadSchemaType] = {
+    "beatmapset_id": PayloadSchemaType.INTEGER,
+    "modes": PayloadSchemaType.KEYWORD,
+    "genre": PayloadSchemaType.INTEGER,
+    "language": PayloadSchemaType.INTEGER,
+}
+
+# every collection a deployment needs, with its payload indexes
+COLLECTIONS: dict[str, dict[str, PayloadSchemaType]] = {
+    BEATMAP_COLLECTION: BEATMAP_PAYLOAD_INDEXES,
+    BEATMAPSET_COLLECTION: BEATMAPSET_PAYLOAD_INDEXES,
+}
+
+# payload fields read by the similarity re-ranking (see `similarity_scores`) and
+# the grouping by set, nothing else. the batch endpoint fetches these for up to
+# CANDIDATE_LIMIT points per beatmap, so keep it to what's actually read
+SIMILARITY_PAYLOAD_FIELDS = [
+    "beatmapset_id",
+    "artist",
+    "genre",
+    "language",
+    "mode",
+    "cs",
+    "star_rating",
+    "length",
+    "bpm",
+    "max_combo",
+    "user_tags",
+]
+
+
+def vector_params() -> VectorParams:
+    return VectorParams(
+        size=BEATMAP_VECTOR_SIZE,
+        distance=Distance(settings.QDRANT_DISTANCE),
+    )
+
+
+def hnsw_config() -> HnswConfigDiff:
+    return HnswConfigDiff(
+        m=settings.QDRANT_HNSW_M,
+        ef_construct=settings.QDRANT_HNSW_EF_CONSTRUCT,
+    )
+
+
+def quantization_config() -> ScalarQuantization | None:
+    if settings.QDRANT_QUANTIZATION == "none":
+        return None
+
+    return ScalarQuantization(
+        scalar=ScalarQuantizationConfig(
+            type=ScalarType.INT8,
+            always_ram=settings.QDRANT_QUANTIZATION_ALWAYS_RAM,
+        )
+    )
+
+
+async def create_payload_indexes(
+    qdrant: AsyncQdrantClient,
+    existing: set[str] | None = None,
+    collection_name: str = BEATMAP_COLLECTION,
+):
+    """Create every payload index declared for `collection_name` in `COLLECTIONS`.
+
+    Fields listed in `existing` are skipped, everything else is (re)created;
+    qdrant treats re-creating an index with the same schema as a no-op.
+    """
+    for field_name, schema in COLLECTIONS[collection_name].items():
+        if existing and field_name in existing:
+            continue
+
+        await qdrant.create_payload_index(
+            collection_name=collection_name,
+            field_name=field_name,
+            field_schema=schema,
+        )
+
+
+async def bootstrap_collection(qdrant: AsyncQdrantClient, collection_name: str = BEATMAP_COLLECTION) -> bool:
+    """Create or verify `collection_name` and bring it up to the configured schema.
+
+    This is idempotent and meant to be run once per deployment (see
+    `python main.py bootstrap`), not from request or worker startup paths.
+    Returns True if the collection was created.
+    """
+    created = False
+
+    if not await qdrant.collection_exists(collection_name):
+        await qdrant.create_collection(
+            collection_name=collection_name,
+            vectors_config=vector_params(),
+            hnsw_config=hnsw_config(),
+            quantization_config=quantization_config(),
+        )
+        created = True
+    else:
+        info = await qdrant.get_collection(collection_name)
+        vectors = info.config.params.vectors
+
+        # vector params can't be changed in place, so refuse to continue
+        # rather than silently mixing embeddings of different shapes
+        if vector_params_mismatch(vectors):
+            raise RuntimeError(
+                f"collection {collection_name} has vector params {vectors}, expected {vector_params()}"
+            )
+
+        if hnsw_mismatch(info.config.hnsw_config):
+            await qdrant.update_collection(
+                collection_name=collection_name,
+                hnsw_config=hnsw_config(),
+            )
+
+        if quantization_mismatch(info.config.quantization_config):
+            await qdrant.update_collection(
+                collection_name=collection_name,
+                # None would mean "leave it as is", turning it off needs Disabled
+                quantization_config=quantization_config() or Disabled.DISABLED,
+            )
+
+    await create_payload_indexes(
+        qdrant,
+        existing=await existing_payload_indexes(qdrant, collection_name),
+        collection_name=collection_name,
+    )
+
+    return created
+
+
+def vector_params_mismatch(current) -> bool:
+    """Whether a collection's vector params differ in size or distance from `vector_params`."""
+    expected = vector_params()
+    return not isinstance(current, VectorParams) or current.size != expected.size or current.distance != expected.distance
+
+
+def hnsw_mismatch(current) -> bool:
+    """Whether a collection's HNSW config differs from `QDRANT_HNSW_M` / `QDRANT_HNSW_EF_CONSTRUCT`."""
+    return current.m != settings.QDRANT_HNSW_M or current.ef_construct != settings.QDRANT_HNSW_EF_CONSTRUCT
+
+
+def quantization_mismatch(current) -> bool:
+    """Whether a collection's quantization config differs from `QDRANT_QUANTIZATION`."""
+    return current != quantization_config()
+
+
+async def existing_payload_indexes(qdrant: AsyncQdrantClient, collection_name: str = BEATMAP_COLLECTION) -> set[str]:
+    info = await qdrant.get_collection(collection_name)
+    return set((info.payload_schema or {}).keys())
+
+
+async def check_collection(qdrant: AsyncQdrantClient) -> list[str]:
+    """Cheap readiness check, returns a list of problems (empty when ready).
+
+    This only reads collection info and never modifies anything, so it's
+    fine to call it on every process start or from a readiness probe.
+    """
+    problems = []
+
+    for collection_name, indexes in COLLECTIONS.items():
+        if not await qdrant.collection_exists(collection_name):
+            problems.append(f"collection {collection_name} does not exist")
+            continue
+
+        info = await qdrant.get_collection(collection_name)
+        indexed = set((info.payload_schema or {}).keys())
+        hnsw = info.config.hnsw_config
+
+        if vector_params_mismatch(info.config.params.vectors):
+            problems.append(
+                f"collection {collection_name} has vector params {info.config.params.vectors}, "
+                f"expected {vector_params()}"
+            )
+
+        if hnsw_mismatch(hnsw):
+            problems.append(
+                f"collection {collection_name} has hnsw m={hnsw.m} ef_construct={hnsw.ef_construct}, "
+                f"expected m={settings.QDRANT_HNSW_M} ef_construct={settings.QDRANT_HNSW_EF_CONSTRUCT}"
+            )
+
+        if quantization_mismatch(info.config.quantization_config):
+            problems.append(
+                f"collection {collection_name} has quantization {info.config.quantization_config}, "
+                f"expected {quantization_config()} (QDRANT_QUANTIZATION={settings.QDRANT_QUANTIZATION})"
+            )
+
+        problems.extend(
+            f"missing payload index on {collection_name}.{field_name}"
+            for field_name in indexes
+            if field_name not in indexed
+        )
+
+    return problems
+
+
+# -----------------------
+# beatmapset embeddings
+
+def beatmapset_vector(vectors: Sequence[Sequence[float]]) -> list[float]:
+    """Mean of a set's difficulty vectors.
+
+    qdrant stores cosine vectors normalized, so they're normalized here
+    first to get the same mean as averaging what `retrieve` returns.
+    """
+    vectors = numpy.asarray(vectors, dtype=numpy.float32)
+
+    if Distance(settings.QDRANT_DISTANCE) == Distance.COSINE:
+        norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / numpy.where(norms > 0, norms, 1)
+
+    return vectors.mean(axis=0).tolist()
+
+
+def beatmapset_point(beatmapset_id: int, vectors: Sequence[Sequence[float]], payloads: Sequence[dict]) -> PointStruct:
+    """Build the `beatmapset_embeddings` point from a set's difficulty vectors and payloads."""
+    first = payloads[0]
+
+    return PointStruct(
+        id=beatmapset_id,
+        vector=beatmapset_vector(vectors),
+        payload={
+            "beatmapset_id": beatmapset_id,
+            "modes": sorted({p["mode"] for p in payloads}),
+            "genre": first.get("genre"),
+            "language": first.get("language"),
+            "title": first.get("title"),
+            "artist": first.get("artist"),
+            "beatmap_count": len(payloads),
+        },
+    )
+
+
+async def backfill_beatmapset_embeddings(qdrant: AsyncQdrantClient, batch_size: int = 100) -> int:
+    """Build `beatmapset_embeddings` points from the existing difficulty points.
+
+    The workers keep it up to date after this, so it only needs to run to the
+    end once. Sets that already have a point are skipped, so an interrupted
+    run picks up where it stopped. Returns the number of sets written.
+    """
+    mapset_ids: set[int] = set()
+    offset = None
+
+    # first pass only reads ids, so memory stays bounded by `batch_size` sets
+    while True:
+        records, offset = await qdrant.scroll(
+            collection_name=BEATMAP_COLLECTION,
+            limit=1000,
+            offset=offset,
+            with_payload=["beatmapset_id"],
+            with_vectors=False,
+        )
+        mapset_ids.update(int(r.payload["beatmapset_id"]) for r in records)
+
+        if offset is None:
+            break
+
+    ordered = sorted(mapset_ids)
+    written = 0
+
+    for start in range(0, len(ordered), batch_size):
+        batch = ordered[start:start + batch_size]
+        existing = await qdrant.retrieve(
+            collection_name=BEATMAPSET_COLLECTION,
+            ids=batch,
+            with_payload=False,
+            with_vectors=False,
+        )
+        done = {int(point.id) for point in existing}
+        batch = [mapset_id for mapset_id in batch if mapset_id not in done]
+        if not batch:
+            continue
+
+        by_set = await difficulty_records(qdrant, batch)
+
+        await qdrant.upsert(
+            collection_name=BEATMAPSET_COLLECTION,
+            points=[
+                beatmapset_point(mapset_id, [r.vector for r in records], [r.payload for r in records])
+                for mapset_id, records in by_set.items()
+            ],
+        )
+        written += len(by_set)
+
+    return written
+
+
+async def difficulty_records(qdrant: AsyncQdrantClient, mapset_ids: Sequence[int]) -> dict[int, list]:
+    """Difficulty points (with vectors) of `mapset_ids`, keyed by mapset id."""
+    by_set: dict[int, list] = {}
+    offset = None
+
+    while True:
+        records, offset = await qdrant.scroll(
+            collection_name=BEATMAP_COLLECTION,
+            scroll_filter=Filter(must=[FieldCondition(key="beatmapset_id", match=MatchAny(any=list(mapset_ids)))]),
+            limit=1000,
+            offset=offset,
+            with_payload=["beatmapset_id", "mode", "genre", "language", "title", "artist"],
+            with_vectors=True,
+        )
+        for record in records:
+            by_set.setdefault(int(record.payload["beatmapset_id"]), []).append(record)
+
+        if offset is None:
+            break
+
+    return by_set
+
+
+async def backfill_beatmapset_embedding(qdrant: AsyncQdrantClient, beatmapset_id: int) -> PointStruct | None:
+    """Write the `beatmapset_embeddings` point of one set from its difficulty points.
+
+    Returns the point, or None when the set has no difficulty points either.
+    """
+    records = (await difficulty_records(qdrant, [beatmapset_id])).get(beatmapset_id)
+    if not records:
+        return None
+
+    point = beatmapset_point(beatmapset_id, [r.vector for r in records], [r.payload for r in records])
+    await qdrant.upsert(collection_name=BEATMAPSET_COLLECTION, points=[point])
+    return point
@@ -1,5 +1,5 @@
 from enum import IntFlag, auto
-from sqlalchemy import Column, Integer, String, Table, ForeignKey
+from sqlalchemy import Column, Integer, String, Table, ForeignKey, Index
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import relationship
@@ -11,6 +11,8 @@ user_groups = Table(
     Base.metadata,
     Column("user_id", Integer, ForeignKey("players.id", ondelete="CASCADE")),
     Column("group_id", Integer, ForeignKey("groups.id", ondelete="CASCADE")),
+    # resolving a principal's permissions joins on user_id
+    Index("ix_user_groups_user", "user_id", "group_id"),
 )
 
 class Permissions(IntFlag):
@@ -44,7 +46,8 @@ async def populate_groups_table(session: AsyncSession):
     """Insert or update default groups with appropriate permission masks.
 
     This performs an UPSERT for each named group using its `name` as
-    the conflict target.
+    the conflict target. Like any change to groups or memberships, follow
+    it with `app.util.auth.bump_groups_version` so cached principals go.
     """
 
     groups = [
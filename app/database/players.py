@@ -1,8 +1,11 @@
 from . import Base
 from sqlalchemy import (
     Column, Integer, String, Float, JSON, Enum,
-    ForeignKey, Index, BigInteger, TIMESTAMP
+    ForeignKey, Index, BigInteger, TIMESTAMP,
+    PrimaryKeyConstraint, case, event, text
 )
+from sqlalchemy.dialects.postgresql import JSONB, insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import relationship
 from .beatmaps import Mode
 from .groups import user_groups
@@ -24,30 +27,112 @@ class Player(Base):
     
     groups = relationship("Group", secondary=user_groups, back_populates="members")
 
+    __table_args__ = (
+        # the feed scheduler's "who synced recently" scan
+        Index(
+            "ix_players_synced_main_mode",
+            "last_synced_at",
+            postgresql_include=["id"],
+            postgresql_where=main_mode.is_not(None),
+        ),
+    )
+
 class PlayerActivityType(enum.Enum):
     SCORE = "score"
     FAVOURITE = "favourite"
     PINNED = "pinned"
     NOMINATED = "nominated"
 
+# player_activity is hash partitioned by player_id, so every index and upsert
+# only touches one partition. changing this needs a migration that moves rows
+ACTIVITY_PARTITIONS = 16
+
+def activity_partition(remainder: int) -> str:
+    return f"player_activity_p{remainder:02d}"
+
 class PlayerActivity(Base):
     __tablename__ = "player_activity"
 
-    id = Column(BigInteger, primary_key=True)
-    player_id = Column(BigInteger, ForeignKey("players.id", ondelete="CASCADE"), index=True)
+    id = Column(BigInteger, autoincrement=True)
+    player_id = Column(BigInteger, ForeignKey("players.id", ondelete="CASCADE"), nullable=False)
     type = Column(Enum(PlayerActivityType, values_callable=lambda x: [e.value for e in PlayerActivityType]))
     map_id = Column(BigInteger, nullable=True)
     mapset_id = Column(BigInteger, nullable=True)
-    value = Column(JSON, default={})
-    created_at = Column(TIMESTAMP)
+    value = Column(JSONB, default={})
+    created_at = Column(TIMESTAMP)  # when the score was set, or the favourite first showed up
+    synced_at = Column(TIMESTAMP)   # last sync that returned this row, for retention
 
     __table_args__ = (
+        # partitioned tables need the partition key in every unique constraint
+        PrimaryKeyConstraint("player_id", "id"),
+        # the upsert key. favourites have no map_id and old scores no mapset_id,
+        # NULLS NOT DISTINCT makes those rows conflict instead of piling up
         Index(
             "ix_player_activity_player_type_map_mapset",
             "player_id",
             "type",
             "map_id",
             "mapset_id",
-            unique=True  # <-- make this unique for proper ON CONFLICT
+            unique=True,
+            postgresql_nulls_not_distinct=True,
+        ),
+        # a player's activity newest first, feed weights and the seen fallback
+        # read only these columns (plus value) without touching other players' rows
+        Index(
+            "ix_player_activity_player_created",
+            "player_id",
+            "created_at",
+            postgresql_include=["type", "map_id", "mapset_id"],
         ),
+        # scores waiting for their mapset, see app/util/mapsets.py. stays tiny,
+        # rows leave it as soon as BeatmapWorker stores their set
+        Index(
+            "ix_player_activity_unresolved",
+            "map_id",
+            postgresql_where=mapset_id.is_(None),
+        ),
+        {"postgresql_partition_by": "HASH (player_id)"},
     )
+
+@event.listens_for(PlayerActivity.__table__, "after_create")
+def create_activity_partitions(target, connection, **kw):
+    # for metadata.create_all, deployments get these from the migration
+    for remainder in range(ACTIVITY_PARTITIONS):
+        connection.execute(text(
+            f"CREATE TABLE {activity_partition(remainder)} PARTITION OF player_activity "
+            f"FOR VALUES WITH (MODULUS {ACTIVITY_PARTITIONS}, REMAINDER {remainder})"
+        ))
+
+
+ACTIVITY_UPSERT_BATCH = 1000
+
+async def upsert_activities(session: AsyncSession, activities: list[dict]):
+    """Insert or refresh activity rows, a few statements per player instead of one per row.
+
+    Rows sharing a key (e.g. a score that is both a top and a recent play)
+    are collapsed first, postgres refuses to update one row twice in a
+    single statement. The last one wins, like separate upserts would.
+
+    A score's created_at follows the play it now holds, favourites keep the
+    created_at of their first sync so they decay from when they showed up.
+    """
+    deduped = {
+        (act["player_id"], act["type"], act["map_id"], act["mapset_id"]): act
+        for act in activities
+    }
+    rows = list(deduped.values())
+
+    for start in range(0, len(rows), ACTIVITY_UPSERT_BATCH):
+        stmt = insert(PlayerActivity).values(rows[start:start + ACTIVITY_UPSERT_BATCH])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[PlayerActivity.player_id, PlayerActivity.type, PlayerActivity.map_id, PlayerActivity.mapset_id],
+            set_={
+                "value": stmt.excluded.value,
+                "created_at": case(
+                    (PlayerActivity.type == PlayerActivityType.FAVOURITE, PlayerActivity.created_at),
+                    else_=stmt.excluded.created_at,
+                ),
+                "synced_at": stmt.excluded.synced_at,
+            },
+        )
+        await session.execute(stmt)
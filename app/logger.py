@@ -1,6 +1,129 @@
+"""Logging for the api, the workers and the cli.
+
+Loggers hang off three roots: `api`, `workers` (e.g. `workers.beatmaps`)
+and `main`. Call sites log a short message plus structured fields:
+
+    logger.info("processed beatmapset", extra={"beatmapset_id": 1, "beatmaps": 4})
+
+`setup_logging` (called once per process) puts a single queue handler on
+the root logger, so logging a record only appends it to an in-memory
+queue; a listener thread formats and writes it. When the queue is full
+records are dropped (and counted in `pandemonium_log_records_dropped_total`)
+instead of blocking the request or worker.
+
+Below WARNING, records can be sampled per logger with LOG_SAMPLING, e.g.
+'{"workers.beatmaps": 0.1}' keeps a tenth of the beatmap workers' info
+lines. A logger without an entry falls back to its parent's.
+"""
+import atexit
 import logging
+import logging.handlers
+import queue
+import random
+import sys
+import orjson
+import app.settings as settings
+from app.util.metrics import LOG_RECORDS_DROPPED
 
 worker_logger = logging.getLogger("workers")
-formatter = logging.Formatter(
-    '[workers] %(levelname)s: %(message)s'
-)
\ No newline at end of file
+api_logger = logging.getLogger("api")
+main_logger = logging.getLogger("main")
+
+# every attribute a bare LogRecord has, anything else came in through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+def record_fields(record: logging.LogRecord) -> dict:
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+
+class JsonFormatter(logging.Formatter):
+    """One json object per line: time, level, logger, message and the `extra` fields."""
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **record_fields(record),
+        }
+
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+
+        return orjson.dumps(line, default=str).decode()
+
+class TextFormatter(logging.Formatter):
+    """`[logger] LEVEL: message key=value ...`, for reading in a terminal."""
+    def __init__(self):
+        super().__init__("[%(name)s] %(levelname)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = record_fields(record)
+
+        if fields:
+            # the traceback (if any) stays last
+            head, _, tail = line.partition("\n")
+            line = head + " " + " ".join(f"{key}={value}" for key, value in fields.items()) + ("\n" + tail if tail else "")
+
+        return line
+
+class SamplingFilter(logging.Filter):
+    """Keeps `rate` of the records below WARNING per logger, longest matching prefix wins."""
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._resolved: dict[str, float] = {}
+
+    def rate(self, name: str) -> float:
+        rate = self._resolved.get(name)
+        if rate is None:
+            prefix = name
+            while prefix not in self.rates and "." in prefix:
+                prefix = prefix.rsplit(".", 1)[0]
+            rate = self._resolved[name] = float(self.rates.get(prefix, 1.0))
+
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        rate = self.rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that drops records when the queue is full instead of blocking."""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the listener runs in this process, leave the formatting to its thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+_listener: logging.handlers.QueueListener | None = None
+
+def setup_logging():
+    """Route every logger of this process through the queue. Safe to call more than once."""
+    global _listener
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter() if settings.LOG_FORMAT == "json" else TextFormatter())
+
+    log_queue = queue.Queue(maxsize=settings.LOG_QUEUE_SIZE)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(settings.LOG_SAMPLING))
+
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(settings.LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+
+    # flush what's still queued when the process exits
+    atexit.register(_listener.stop)
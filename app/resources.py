@@ -0,0 +1,121 @@
+import enum
+import httpx
+import app.settings as settings
+
+from dataclasses import dataclass
+from ossapi import OssapiAsync
+from qdrant_client import AsyncQdrantClient
+from redis import asyncio as aioredis
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+from app.database import create_engine, create_sessionmaker
+from app.util import create_http_client
+
+class ProcessRole(enum.StrEnum):
+    API = "api"
+    WORKER = "worker"
+
+@dataclass(frozen=True)
+class PoolLimits:
+    pg_pool_size: int
+    pg_max_overflow: int
+    redis_max_connections: int
+    qdrant_pool_size: int
+
+    @classmethod
+    def for_role(cls, role: ProcessRole) -> "PoolLimits":
+        if role is ProcessRole.API:
+            return cls(
+                pg_pool_size=settings.PG_POOL_SIZE_API,
+                pg_max_overflow=settings.PG_MAX_OVERFLOW_API,
+                redis_max_connections=settings.REDIS_MAX_CONNECTIONS_API,
+                qdrant_pool_size=settings.QDRANT_POOL_SIZE_API,
+            )
+
+        return cls(
+            pg_pool_size=settings.PG_POOL_SIZE_WORKER,
+            pg_max_overflow=settings.PG_MAX_OVERFLOW_WORKER,
+            redis_max_connections=settings.REDIS_MAX_CONNECTIONS_WORKER,
+            qdrant_pool_size=settings.QDRANT_POOL_SIZE_WORKER,
+        )
+
+
+class Resources:
+    """
+    Every connection pool a process needs, created once and closed once.
+
+    The api and the workers each hold a single instance (see `APIState` and
+    `WorkerState`), everything else borrows from it instead of creating its
+    own engines or clients. The pools are bound to the event loop that ran
+    `init`, so an instance must only be used from that loop.
+    """
+    engine: AsyncEngine
+    session_factory: async_sessionmaker[AsyncSession]
+    redis: aioredis.Redis
+    qdrant: AsyncQdrantClient
+    osu: OssapiAsync
+    http: httpx.AsyncClient
+
+    def __init__(self, role: ProcessRole) -> None:
+        self.role = role
+        self.limits = PoolLimits.for_role(role)
+        self._initialized = False
+
+    async def init(self):
+        if self._initialized:
+            return
+
+        self.engine = create_engine(
+            pool_size=self.limits.pg_pool_size,
+            max_overflow=self.limits.pg_max_overflow,
+        )
+        self.session_factory = create_sessionmaker(self.engine)
+
+        # a blocking pool waits for a free connection instead of opening
+        # a new one past the limit, so the connection count stays fixed
+        self.redis = aioredis.Redis.from_pool(
+            aioredis.BlockingConnectionPool(
+                host=settings.REDIS_HOST,
+                port=settings.REDIS_PORT,
+                db=settings.REDIS_DB,
+                password=settings.REDIS_PASSWORD,
+                max_connections=self.limits.redis_max_connections,
+                timeout=settings.REDIS_POOL_TIMEOUT,
+                decode_responses=True,
+            )
+        )
+
+        self.qdrant = AsyncQdrantClient(
+            url=settings.QDRANT_URL,
+            api_key=settings.QDRANT_API_KEY,
+            pool_size=self.limits.qdrant_pool_size,
+        )
+
+        self.osu = OssapiAsync(
+            settings.OSU_API_CLIENT_ID,
+            settings.OSU_API_CLIENT_SECRET
+        )
+
+        self.http = create_http_client()
+
+        self._initialized = True
+
+    def get_session(self) -> AsyncSession:
+        return self.session_factory()
+
+    async def close(self):
+        if not self._initialized:
+            return
+
+        self._initialized = False
+
+        await self.redis.aclose()
+        await self.qdrant.close()
+        await self.http.aclose()
+        await self.engine.dispose()
+
+    async def __aenter__(self):
+        await self.init()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
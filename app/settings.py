@@ -1,4 +1,5 @@
 from dotenv import load_dotenv
+import json
 import os
 
 load_dotenv()
@@ -9,6 +10,12 @@ PORT = int(os.getenv("PORT", 8000))
 OSU_API_CLIENT_ID = int(os.getenv("OSU_API_CLIENT_ID", 0))
 OSU_API_CLIENT_SECRET = os.getenv("OSU_API_CLIENT_SECRET", "")
 OSU_API_REDIRECT_URL = os.getenv("OSU_API_REDIRECT_URL", "")
+OSU_BASE_URL = os.getenv("OSU_BASE_URL", "https://osu.ppy.sh")  # point at a local stand-in for testing
+
+# shared http client used for osu! oauth calls, see app.util.create_http_client
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 10))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 20))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 2))
 
 PG_USER = os.getenv("PG_USER")
 PG_PASSWORD = os.getenv("PG_PASSWORD")
@@ -18,6 +25,19 @@ PG_DB = os.getenv("PG_DB")
 PG_DSN = f"postgresql+asyncpg://{PG_USER}:{PG_PASSWORD}@{PG_HOST}:{PG_PORT}/{PG_DB}"
 PG_ALEMBIC_DSN = f"postgresql+psycopg2://{PG_USER}:{PG_PASSWORD}@{PG_HOST}:{PG_PORT}/{PG_DB}"
 
+# optional streaming replica for the api's read-only queries (feeds, similar
+# maps, auth). same credentials and database as the primary unless overridden.
+# reads go back to the primary while the replica is more than
+# PG_REPLICA_MAX_LAG seconds behind, checked every PG_REPLICA_LAG_CHECK_INTERVAL
+PG_REPLICA_HOST = os.getenv("PG_REPLICA_HOST")
+PG_REPLICA_PORT = os.getenv("PG_REPLICA_PORT", PG_PORT)
+PG_REPLICA_DSN = (
+    f"postgresql+asyncpg://{PG_USER}:{PG_PASSWORD}@{PG_REPLICA_HOST}:{PG_REPLICA_PORT}/{PG_DB}"
+    if PG_REPLICA_HOST else None
+)
+PG_REPLICA_MAX_LAG = float(os.getenv("PG_REPLICA_MAX_LAG", 10))
+PG_REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("PG_REPLICA_LAG_CHECK_INTERVAL", 5))
+
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
@@ -26,7 +46,96 @@ REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
 QDRANT_URL = os.getenv("QDRANT_URL", "http://localhost:6333")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY", None)
 
+# connection pool limits per process role, see app/resources.py.
+# every process holds exactly one pool per backing service, so these
+# are the hard per-process connection limits
+PG_POOL_SIZE_API = int(os.getenv("PG_POOL_SIZE_API", 10))
+PG_MAX_OVERFLOW_API = int(os.getenv("PG_MAX_OVERFLOW_API", 10))
+PG_POOL_SIZE_WORKER = int(os.getenv("PG_POOL_SIZE_WORKER", 4))
+PG_MAX_OVERFLOW_WORKER = int(os.getenv("PG_MAX_OVERFLOW_WORKER", 2))
+PG_POOL_TIMEOUT = float(os.getenv("PG_POOL_TIMEOUT", 10))
+
+REDIS_MAX_CONNECTIONS_API = int(os.getenv("REDIS_MAX_CONNECTIONS_API", 20))
+REDIS_MAX_CONNECTIONS_WORKER = int(os.getenv("REDIS_MAX_CONNECTIONS_WORKER", 4))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
+
+QDRANT_POOL_SIZE_API = int(os.getenv("QDRANT_POOL_SIZE_API", 20))
+QDRANT_POOL_SIZE_WORKER = int(os.getenv("QDRANT_POOL_SIZE_WORKER", 4))
+
 JWT_SECRET = os.getenv("JWT_SECRET")
 
+# how long a resolved principal is cached (in-process and in redis), and how
+# often the in-process groups version is compared against redis
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", 300))
+AUTH_VERSION_CHECK_INTERVAL = float(os.getenv("AUTH_VERSION_CHECK_INTERVAL", 5))
+
+# per player seen bitmaps (app/util/seen.py): how long an unsynced player's
+# bitmap is kept, and up to how many seen mapsets are pushed into qdrant filters
+SEEN_TTL = int(os.getenv("SEEN_TTL", 60 * 60 * 24 * 30))
+SEEN_PUSHDOWN_LIMIT = int(os.getenv("SEEN_PUSHDOWN_LIMIT", 1000))
+
+# precomputed feeds (app/workers/feeds.py): players synced within the last
+# FEED_ACTIVE_DAYS get their feed recomputed daily at FEED_MATERIALIZE_HOUR (utc),
+# and a stored feed is served until it expires after FEED_MATERIALIZED_TTL seconds
+FEED_MATERIALIZE_HOUR = int(os.getenv("FEED_MATERIALIZE_HOUR", 4))
+FEED_ACTIVE_DAYS = int(os.getenv("FEED_ACTIVE_DAYS", 7))
+FEED_MATERIALIZED_TTL = int(os.getenv("FEED_MATERIALIZED_TTL", 60 * 60 * 30))
+
+# player_activity retention (app/workers/activity.py): daily at ACTIVITY_COMPACT_HOUR
+# (utc), rows not refreshed by a sync for ACTIVITY_RETENTION_DAYS are deleted and
+# each player keeps at most ACTIVITY_MAX_ROWS_PER_PLAYER of their newest rows
+ACTIVITY_COMPACT_HOUR = int(os.getenv("ACTIVITY_COMPACT_HOUR", 5))
+ACTIVITY_RETENTION_DAYS = int(os.getenv("ACTIVITY_RETENTION_DAYS", 365))
+ACTIVITY_MAX_ROWS_PER_PLAYER = int(os.getenv("ACTIVITY_MAX_ROWS_PER_PLAYER", 1000))
+
+# `python main.py backfill` walks the ranked beatmapset listing (app/workers/backfill.py),
+# fetching at most one page every BACKFILL_PAGE_INTERVAL seconds
+BACKFILL_PAGE_INTERVAL = float(os.getenv("BACKFILL_PAGE_INTERVAL", 1))
+
+# feed activity weighting, merged over the defaults in app/util/weighting.py.
+# e.g. '{"half_life_days": 30, "max_sources": 32}'
+FEED_WEIGHTS = json.loads(os.getenv("FEED_WEIGHTS", "{}"))
+
+# prometheus metrics (app/util/metrics.py). the api serves them on /metrics,
+# `python main.py workers` on WORKER_METRICS_PORT, refreshing the queue depth
+# gauges every METRICS_REFRESH_INTERVAL seconds
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 9101))
+METRICS_REFRESH_INTERVAL = float(os.getenv("METRICS_REFRESH_INTERVAL", 15))
+
+# worker bookkeeping for /admin/queues and /admin/workers (app/util/queues.py).
+# workers heartbeat every WORKER_HEARTBEAT_INTERVAL seconds and are shown as stale
+# after missing three, which also requeues the items they had in flight. their
+# stats are dropped after WORKER_STATS_TTL seconds
+WORKER_HEARTBEAT_INTERVAL = float(os.getenv("WORKER_HEARTBEAT_INTERVAL", 10))
+WORKER_STATS_TTL = int(os.getenv("WORKER_STATS_TTL", 60 * 60 * 24))
+
+# a worker that crashes is restarted on its own, after a backoff that doubles
+# from one second up to WORKER_RESTART_BACKOFF_MAX seconds while it keeps failing
+WORKER_RESTART_BACKOFF_MAX = float(os.getenv("WORKER_RESTART_BACKOFF_MAX", 60))
+
+# requests slower than SLOW_REQUEST_THRESHOLD seconds get their stacks sampled
+# every SLOW_REQUEST_SAMPLE_INTERVAL seconds and the last SLOW_REQUEST_BUFFER of
+# them are kept in redis (app/util/profiling.py, /admin/slow-requests)
+SLOW_REQUEST_THRESHOLD = float(os.getenv("SLOW_REQUEST_THRESHOLD", 1.0))
+SLOW_REQUEST_SAMPLE_INTERVAL = float(os.getenv("SLOW_REQUEST_SAMPLE_INTERVAL", 0.01))
+SLOW_REQUEST_BUFFER = int(os.getenv("SLOW_REQUEST_BUFFER", 200))
+
+# logging (app/logger.py): LOG_FORMAT is "json" or "text", at most LOG_QUEUE_SIZE
+# records wait for the writer thread before new ones are dropped, and records
+# below WARNING are sampled per logger by LOG_SAMPLING, e.g. '{"workers.beatmaps": 0.1}'
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10_000))
+LOG_SAMPLING = json.loads(os.getenv("LOG_SAMPLING", "{}"))
 WORKER_SLEEP_INTERVAL = float(os.getenv("WORKER_SLEEP_INTERVAL", 1))
+
+# vector collection settings, applied by `python main.py bootstrap`
+QDRANT_DISTANCE = os.getenv("QDRANT_DISTANCE", "Cosine")
+QDRANT_HNSW_M = int(os.getenv("QDRANT_HNSW_M", 16))
+QDRANT_HNSW_EF_CONSTRUCT = int(os.getenv("QDRANT_HNSW_EF_CONSTRUCT", 100))
+QDRANT_QUANTIZATION = os.getenv("QDRANT_QUANTIZATION", "int8")  # "int8" or "none"
+QDRANT_QUANTIZATION_ALWAYS_RAM = os.getenv("QDRANT_QUANTIZATION_ALWAYS_RAM", "true").lower() == "true"
+
+# per-endpoint vector search profiles, merged over the defaults in
+# app/util/search.py. e.g. '{"feed": {"hnsw_ef": 32}, "similar_beatmap": {"exact": true}}'
+SEARCH_PROFILES = json.loads(os.getenv("SEARCH_PROFILES", "{}"))
@@ -1,62 +1,86 @@
+import asyncio
 import secrets
 import httpx
 import time
 import app.settings as settings
 import jwt
-import time
 
 from typing import Optional
 from fastapi import HTTPException
 
-OSU_TOKEN_URL = "https://osu.ppy.sh/oauth/token"
-OSU_API_ME_URL = "https://osu.ppy.sh/api/v2/me"
+OSU_AUTHORIZE_URL = f"{settings.OSU_BASE_URL}/oauth/authorize"
+OSU_TOKEN_URL = f"{settings.OSU_BASE_URL}/oauth/token"
+OSU_API_ME_URL = f"{settings.OSU_BASE_URL}/api/v2/me"
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_SECONDS = 60 * 60 * 24 * 30  # 30 days
+RETRY_STATUS_CODES = {429, 502, 503, 504}
 
 def generate_state():
     return secrets.token_urlsafe(32)
 
-async def exchange_code_for_token(code: str):
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            OSU_TOKEN_URL,
-            json={
-                "client_id": settings.OSU_API_CLIENT_ID,
-                "client_secret": settings.OSU_API_CLIENT_SECRET,
-                "code": code,
-                "grant_type": "authorization_code",
-                "redirect_uri": settings.OSU_API_REDIRECT_URL,
-            },
-            timeout=10.0,
-        )
+def create_http_client(transport: Optional[httpx.AsyncBaseTransport] = None) -> httpx.AsyncClient:
+    """Create the process-wide http client for calls to osu!.
+
+    Connections are pooled and kept alive (over http/2 when the server
+    supports it), so login bursts reuse a handful of TLS sessions instead of
+    handshaking for every call. The default transport retries failed
+    connection attempts; `transport` replaces it, e.g. with a local stand-in.
+    """
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(settings.HTTP_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=settings.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.HTTP_MAX_CONNECTIONS,
+        ),
+        transport=transport or httpx.AsyncHTTPTransport(http2=True, retries=settings.HTTP_RETRIES),
+    )
 
-        if response.status_code != 200:
-            raise Exception(
-                f"OAuth token exchange failed: {response.status_code} {response.text}"
-            )
-
-        data = response.json()
-        data["expires_at"] = int(time.time()) + data["expires_in"]
-
-        return data
-    
-async def get_osu_self(access_token: str):
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            OSU_API_ME_URL,
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Accept": "application/json",
-            },
-            timeout=10.0,
+async def exchange_code_for_token(client: httpx.AsyncClient, code: str):
+    # authorization codes are single use, so this is only retried on
+    # connection failures (by the transport), never after a response
+    response = await client.post(
+        OSU_TOKEN_URL,
+        json={
+            "client_id": settings.OSU_API_CLIENT_ID,
+            "client_secret": settings.OSU_API_CLIENT_SECRET,
+            "code": code,
+            "grant_type": "authorization_code",
+            "redirect_uri": settings.OSU_API_REDIRECT_URL,
+        },
+    )
+
+    if response.status_code != 200:
+        raise Exception(
+            f"OAuth token exchange failed: {response.status_code} {response.text}"
         )
 
-        if response.status_code != 200:
-            raise Exception(
-                f"failed to fetch osu user: {response.status_code} {response.text}"
-            )
+    data = response.json()
+    data["expires_at"] = int(time.time()) + data["expires_in"]
+
+    return data
+
+async def get_osu_self(client: httpx.AsyncClient, access_token: str):
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Accept": "application/json",
+    }
+
+    # idempotent, so also retry on rate limits and gateway errors
+    for attempt in range(settings.HTTP_RETRIES + 1):
+        response = await client.get(OSU_API_ME_URL, headers=headers)
+
+        if response.status_code not in RETRY_STATUS_CODES or attempt == settings.HTTP_RETRIES:
+            break
+
+        await asyncio.sleep(0.25 * 2 ** attempt)
+
+    if response.status_code != 200:
+        raise Exception(
+            f"failed to fetch osu user: {response.status_code} {response.text}"
+        )
 
-        return response.json()
+    return response.json()
 
 def generate_session_token(user_id: int, expires_in: Optional[int] = None) -> str:
     now = int(time.time())
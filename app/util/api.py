@@ -2,11 +2,9 @@ import jwt
 import app.settings as settings
 from fastapi import Depends, HTTPException, Header
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from app.api.state import get_state
-from app.database.players import Player
-from app.database.groups import Group, user_groups
+from app.api.state import APIState, get_state, get_read_session
 from app.util import JWT_ALGORITHM
+from app.util.auth import Principal, get_groups_version, load_principal
 
 def verify_session_token(token: str):
     try:
@@ -17,34 +15,38 @@ def verify_session_token(token: str):
     except jwt.InvalidTokenError:
         raise HTTPException(401, "invalid session token")
 
-async def get_current_user(
-    authorization: str = Header(...) # expects "Bearer <token>"
-):
+async def authenticate(state: APIState, session: AsyncSession, authorization: str) -> Principal:
+    """Resolve an "Authorization: Bearer <token>" header to a principal.
+
+    Permissions and main mode come from `load_principal`, cached in process
+    and in redis for AUTH_CACHE_TTL, so they follow group changes and syncs
+    instead of being frozen into the token. Players without a `players` row
+    get a 404.
+    """
     if not authorization.startswith("Bearer "):
         raise HTTPException(401, "invalid authorization header")
 
-    state = await get_state()
-    session: AsyncSession = state.session_factory() # type: ignore
     token = authorization.split(" ", 1)[1]
     payload = verify_session_token(token)
     user_id = int(payload["sub"])
-    
-    player = await session.get(Player, user_id)
-    if not player:
-        raise HTTPException(404, "player not found")
-
-    result = await session.execute(
-        select(Group).join(user_groups).where(user_groups.c.user_id == player.id)
-    )
-    groups = result.scalars().all()
-
-    effective_perms = 0
-    for g in groups:
-        effective_perms |= g.permissions
-
-    player.groups = groups
-    player.effective_permissions = effective_perms
-    
-    await session.close()
-
-    return player
\ No newline at end of file
+
+    version = await get_groups_version(state.redis)
+    return await load_principal(state.redis, session, user_id, version)
+
+async def get_current_user(
+    authorization: str = Header(...), # expects "Bearer <token>"
+    state: APIState = Depends(get_state),
+    session: AsyncSession = Depends(get_read_session)
+) -> Principal:
+    return await authenticate(state, session, authorization)
+
+async def get_optional_user(
+    authorization: str | None = Header(None),
+    state: APIState = Depends(get_state),
+    session: AsyncSession = Depends(get_read_session)
+) -> Principal | None:
+    """Like `get_current_user`, but anonymous requests get None instead of a 401."""
+    if authorization is None:
+        return None
+
+    return await authenticate(state, session, authorization)
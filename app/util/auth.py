@@ -0,0 +1,119 @@
+import json
+import time
+import app.settings as settings
+from dataclasses import dataclass, asdict
+from typing import Optional
+from fastapi import HTTPException
+from redis import asyncio as aioredis
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database.players import Player
+from app.database.groups import Group, user_groups
+from app.util.metrics import count_cache
+
+GROUPS_VERSION_KEY = "pandemonium:groups_version"
+
+@dataclass(frozen=True)
+class Principal:
+    """The authenticated player, as far as authorization is concerned."""
+    id: int
+    effective_permissions: int = 0
+    main_mode: Optional[str] = None
+
+# in-process caches, per api process. the groups version is only
+# re-read from redis every AUTH_VERSION_CHECK_INTERVAL seconds
+_groups_version: tuple[float, int] | None = None
+_principals: dict[tuple[int, int], tuple[float, Principal]] = {}
+_PRINCIPALS_MAX = 10_000
+
+async def get_groups_version(redis: aioredis.Redis) -> int:
+    global _groups_version
+
+    now = time.monotonic()
+    if _groups_version is not None and now - _groups_version[0] < settings.AUTH_VERSION_CHECK_INTERVAL:
+        return _groups_version[1]
+
+    version = int(await redis.get(GROUPS_VERSION_KEY) or 0)
+    _groups_version = (now, version)
+
+    return version
+
+async def bump_groups_version(redis: aioredis.Redis) -> int:
+    """Invalidate every issued permission claim and cached principal.
+
+    Call this after changing group permissions or memberships. Other api
+    processes pick the new version up within AUTH_VERSION_CHECK_INTERVAL.
+    """
+    global _groups_version
+
+    version = await redis.incr(GROUPS_VERSION_KEY)
+    _groups_version = None
+    _principals.clear()
+
+    return version
+
+def principal_key(user_id: int, version: int) -> str:
+    return f"pandemonium:principal:{version}:{user_id}"
+
+async def forget_principal(redis: aioredis.Redis, user_id: int):
+    """Drop the redis copy of `user_id`'s principal, e.g. after a sync changed
+    their main mode. Api processes drop their own copy within AUTH_CACHE_TTL.
+    """
+    await redis.delete(principal_key(user_id, await get_groups_version(redis)))
+
+async def resolve_principal(session: AsyncSession, user_id: int) -> Principal | None:
+    """Load a principal from the database, None if the player doesn't exist."""
+    result = await session.execute(
+        select(Player.main_mode, func.coalesce(func.bit_or(Group.permissions), 0))
+        .outerjoin(user_groups, user_groups.c.user_id == Player.id)
+        .outerjoin(Group, Group.id == user_groups.c.group_id)
+        .where(Player.id == user_id)
+        .group_by(Player.id)
+    )
+    row = result.one_or_none()
+
+    if row is None:
+        return None
+
+    main_mode, permissions = row
+    return Principal(
+        id=user_id,
+        effective_permissions=int(permissions),
+        main_mode=str(main_mode) if main_mode is not None else None,
+    )
+
+async def load_principal(
+    redis: aioredis.Redis,
+    session: AsyncSession,
+    user_id: int,
+    version: int
+) -> Principal:
+    """Principal for `user_id`, from the in-process cache, redis, then the database."""
+    now = time.monotonic()
+    cached = _principals.get((user_id, version))
+    if cached is not None and cached[0] > now:
+        count_cache("principal", hits=1)
+        return cached[1]
+
+    count_cache("principal", misses=1)
+
+    key = principal_key(user_id, version)
+    raw = await redis.get(key)
+
+    if raw is not None:
+        count_cache("principal_redis", hits=1)
+        principal = Principal(**json.loads(raw))
+    else:
+        count_cache("principal_redis", misses=1)
+        principal = await resolve_principal(session, user_id)
+        if principal is None:
+            raise HTTPException(404, "player not found")
+
+        await redis.setex(key, settings.AUTH_CACHE_TTL, json.dumps(asdict(principal)))
+
+    if len(_principals) >= _PRINCIPALS_MAX:
+        _principals.clear()
+
+    _principals[(user_id, version)] = (now + settings.AUTH_CACHE_TTL, principal)
+
+    return principal
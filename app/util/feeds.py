@@ -0,0 +1,35 @@
+"""Feeds precomputed by the feed workers, see app/workers/feeds.py."""
+import json
+import time
+import app.settings as settings
+from dataclasses import dataclass
+from typing import Optional
+from redis import asyncio as aioredis
+
+FEED_QUEUE = "pandemonium:feed_queue"
+
+def materialized_key(player_id, mode) -> str:
+    return f"pandemonium:feed:{player_id}:{mode}"
+
+@dataclass(frozen=True)
+class MaterializedFeed:
+    ranked: list[int]   # mapset ids, best first
+    generated_at: int   # unix timestamp the ranking was computed at
+
+async def store_materialized_feed(redis: aioredis.Redis, player_id, mode, ranked: list[int]) -> MaterializedFeed:
+    feed = MaterializedFeed(ranked=ranked, generated_at=int(time.time()))
+    await redis.setex(
+        materialized_key(player_id, mode),
+        settings.FEED_MATERIALIZED_TTL,
+        json.dumps({"ranked": feed.ranked, "generated_at": feed.generated_at}),
+    )
+
+    return feed
+
+async def load_materialized_feed(redis: aioredis.Redis, player_id, mode) -> Optional[MaterializedFeed]:
+    raw = await redis.get(materialized_key(player_id, mode))
+    if raw is None:
+        return None
+
+    data = json.loads(raw)
+    return MaterializedFeed(ranked=data["ranked"], generated_at=data["generated_at"])
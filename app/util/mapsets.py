@@ -0,0 +1,80 @@
+"""map_id -> mapset_id resolution for activity rows.
+
+Beatmaps never move between sets, so the pairs are cached in one redis
+hash (`pandemonium:map_mapset`) without expiry. `PlayerWorker` resolves
+every score before storing it; scores on maps that aren't in `beatmaps`
+yet keep a NULL mapset_id until `BeatmapWorker` stores the set and calls
+`backfill_activity_mapsets`.
+"""
+from typing import Iterable
+from redis import asyncio as aioredis
+from sqlalchemy import and_, delete, exists, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+from app.database.beatmaps import Beatmap
+from app.database.players import PlayerActivity
+from app.util.metrics import count_cache
+
+MAP_MAPSET_KEY = "pandemonium:map_mapset"
+
+async def cache_mapset_ids(redis: aioredis.Redis, mapset_ids: dict[int, int]):
+    if mapset_ids:
+        await redis.hset(MAP_MAPSET_KEY, mapping=mapset_ids)
+
+async def resolve_mapset_ids(redis: aioredis.Redis, session: AsyncSession, map_ids: Iterable[int]) -> dict[int, int]:
+    """The mapset of every known map in `map_ids`, one HMGET plus at most one query."""
+    map_ids = list(set(map_ids))
+    if not map_ids:
+        return {}
+
+    cached = await redis.hmget(MAP_MAPSET_KEY, map_ids)
+    resolved = {map_id: int(mapset_id) for map_id, mapset_id in zip(map_ids, cached) if mapset_id is not None}
+
+    missing = [map_id for map_id in map_ids if map_id not in resolved]
+    count_cache("map_mapset", hits=len(resolved), misses=len(missing))
+
+    if missing:
+        result = await session.execute(
+            select(Beatmap.id, Beatmap.beatmapset_id).where(Beatmap.id.in_(missing))
+        )
+        found = {int(map_id): int(mapset_id) for map_id, mapset_id in result.all() if mapset_id is not None}
+
+        await cache_mapset_ids(redis, found)
+        resolved.update(found)
+
+    return resolved
+
+async def backfill_activity_mapsets(session: AsyncSession, mapset_id: int, map_ids: list[int]) -> set[int]:
+    """Fill in `mapset_id` on activity rows of `map_ids` stored before the set was known.
+
+    Returns the players whose rows were filled. A NULL row whose player
+    already has the same activity with the mapset filled in (synced again
+    after the map was resolved) would collide on the upsert key, those are
+    dropped instead.
+    """
+    if not map_ids:
+        return set()
+
+    resolved = aliased(PlayerActivity)
+    await session.execute(
+        delete(PlayerActivity)
+        .where(
+            PlayerActivity.map_id.in_(map_ids),
+            PlayerActivity.mapset_id.is_(None),
+            exists().where(and_(
+                resolved.player_id == PlayerActivity.player_id,
+                resolved.type == PlayerActivity.type,
+                resolved.map_id == PlayerActivity.map_id,
+                resolved.mapset_id == mapset_id,
+            )),
+        )
+    )
+
+    result = await session.execute(
+        update(PlayerActivity)
+        .where(PlayerActivity.map_id.in_(map_ids), PlayerActivity.mapset_id.is_(None))
+        .values(mapset_id=mapset_id)
+        .returning(PlayerActivity.player_id)
+    )
+
+    return set(result.scalars().all())
@@ -0,0 +1,84 @@
+"""Prometheus metrics shared by the api and the workers.
+
+Everything lives in prometheus_client's default registry. The api serves
+it on `/metrics`; workers running in the api process (`main.py serve`)
+show up there too, worker-only processes (`main.py workers`) serve their
+own on WORKER_METRICS_PORT.
+
+Stages are timed with `timed("operation", "stage")`, e.g. the feed's
+`weights`, `vectors`, `search` and `score` stages end up as
+`pandemonium_stage_seconds{operation="feed",stage="search"}`.
+"""
+import time
+from contextlib import contextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from redis import asyncio as aioredis
+from app.util.queues import QUEUES, queue_depth, waiting_items
+
+# most stages are a single query or search, a whole worker item can take seconds
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+STAGE_SECONDS = Histogram(
+    "pandemonium_stage_seconds",
+    "Time spent in one stage of an operation",
+    ["operation", "stage"],
+    buckets=STAGE_BUCKETS,
+)
+
+WORKER_ITEMS = Counter(
+    "pandemonium_worker_items_total",
+    "Queue items processed by the workers",
+    ["queue", "result"],  # result is "ok" or "failed"
+)
+
+QUEUE_WAIT_SECONDS = Histogram(
+    "pandemonium_queue_wait_seconds",
+    "Time items waited in a worker queue before a worker picked them up",
+    ["queue"],
+    buckets=(1, 5, 15, 60, 300, 900, 3600, 4 * 3600, 12 * 3600, 24 * 3600),
+)
+
+QUEUE_DEPTH = Gauge(
+    "pandemonium_queue_depth",
+    "Items waiting in a worker queue",
+    ["queue"],
+)
+
+CACHE_REQUESTS = Counter(
+    "pandemonium_cache_requests_total",
+    "Cache lookups by cache and outcome",
+    ["cache", "result"],  # result is "hit" or "miss"
+)
+
+LOG_RECORDS_DROPPED = Counter(
+    "pandemonium_log_records_dropped_total",
+    "Log records dropped because the log queue was full",
+)
+
+@contextmanager
+def timed(operation: str, stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(operation, stage).observe(time.perf_counter() - started)
+
+def count_cache(cache: str, hits: int = 0, misses: int = 0):
+    if hits:
+        CACHE_REQUESTS.labels(cache, "hit").inc(hits)
+    if misses:
+        CACHE_REQUESTS.labels(cache, "miss").inc(misses)
+
+async def refresh_queue_depths(redis: aioredis.Redis):
+    async with redis.pipeline(transaction=False) as pipe:
+        for queue in QUEUES.values():
+            queue_depth(pipe, queue)
+        results = await pipe.execute()
+
+    for index, queue in enumerate(QUEUES.values()):
+        QUEUE_DEPTH.labels(queue).set(waiting_items(*results[index * 3:index * 3 + 3]))
+
+async def render_metrics(redis: aioredis.Redis) -> tuple[bytes, str]:
+    """The exposition body and its content type, with fresh queue depths."""
+    await refresh_queue_depths(redis)
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,322 @@
+"""Request profiling for admins and an always-on slow request sampler.
+
+Per request: an admin (`MANAGE_USERS`) sending `X-Profile: pstats` gets a
+cProfile dump of the request instead of its response (open it with
+`python -m pstats`, snakeviz or flameprof), `X-Profile: collapsed` gets
+sampled stacks in the folded format flamegraph.pl and speedscope read.
+The original status is in `X-Profile-Status`.
+
+Always: a sampler thread watches the requests in flight. Once one has been
+running for SLOW_REQUEST_THRESHOLD seconds it samples the event loop every
+SLOW_REQUEST_SAMPLE_INTERVAL seconds. A sample counts as `cpu` when the
+request's own task is the one running (python level hot spots, e.g.
+scoring or orm hydration), otherwise the task's await stack is counted as
+`wait` (which query or search it's blocked on). When the request finishes
+its samples are pushed to a redis ring buffer of the last
+SLOW_REQUEST_BUFFER slow requests, see `/admin/slow-requests`.
+"""
+import asyncio
+import cProfile
+import io
+import json
+import marshal
+import os
+import sys
+import threading
+import time
+import app.settings as settings
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Optional
+from redis import asyncio as aioredis
+from starlette.responses import JSONResponse, Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from app.database.groups import Permissions
+from app.logger import api_logger
+
+SLOW_REQUESTS_KEY = "pandemonium:slow_requests"
+PROFILE_HEADER = b"x-profile"
+PROFILE_FORMATS = ("pstats", "collapsed")
+PROFILE_SAMPLE_INTERVAL = 0.001  # seconds between samples of a profiled request
+MAX_STACK_DEPTH = 64
+MAX_STACKS = 50                  # distinct stacks kept per slow request, most frequent first
+
+logger = api_logger.getChild("profiling")
+
+# -----------------------
+# stacks
+
+def frame_label(code) -> str:
+    path = code.co_filename.replace(os.sep, "/").rsplit("/", 2)
+    return f"{code.co_qualname} ({'/'.join(path[-2:])}:{code.co_firstlineno})"
+
+# frames above these (the event loop, the server) are the same for every request
+ROOT_CODES: set = set()
+
+def fold(frames) -> str:
+    """`frames` innermost first, as one folded line root first: `outer;...;inner`."""
+    kept = []
+    for frame in frames[:MAX_STACK_DEPTH]:
+        kept.append(frame_label(frame.f_code))
+        if frame.f_code in ROOT_CODES:
+            break
+
+    return ";".join(reversed(kept))
+
+def thread_stack(thread_id: int) -> list:
+    frame = sys._current_frames().get(thread_id)
+    frames = []
+    while frame is not None and len(frames) < MAX_STACK_DEPTH:
+        frames.append(frame)
+        if frame.f_code in ROOT_CODES:
+            break
+        frame = frame.f_back
+    return frames
+
+def task_stack(task: asyncio.Task) -> list:
+    """The await chain of a suspended `task`, innermost first.
+
+    `Task.get_stack` only returns the outermost frame of a suspended
+    coroutine, the rest hangs off `cr_await`.
+    """
+    frames = []
+    awaitable = task.get_coro()
+    try:
+        while awaitable is not None and len(frames) < MAX_STACK_DEPTH * 2:
+            frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "gi_frame", None)
+            if frame is not None:
+                frames.append(frame)
+            awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "gi_yieldfrom", None)
+    except Exception:
+        # the task moved on while we were reading it
+        return []
+
+    return frames[::-1]
+
+# -----------------------
+# sampling
+
+@dataclass(eq=False)
+class InFlight:
+    method: str
+    path: str
+    task: asyncio.Task
+    started: float = field(default_factory=time.monotonic)
+    always_sample: bool = False   # profiled with `X-Profile: collapsed`
+    cpu: Counter = field(default_factory=Counter)
+    wait: Counter = field(default_factory=Counter)
+    samples: int = 0
+    # the sampler thread may still be counting a sample taken just before
+    # the request finished, read the counters through `snapshot`
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def snapshot(self) -> tuple[Counter, Counter, int]:
+        """Copies of (cpu, wait, samples), safe to read on the loop thread."""
+        with self.lock:
+            return Counter(self.cpu), Counter(self.wait), self.samples
+
+class Sampler:
+    """Samples the event loop thread for requests in flight that are slow or being profiled."""
+    def __init__(self, loop: asyncio.AbstractEventLoop, loop_thread_id: int):
+        self.loop = loop
+        self.loop_thread_id = loop_thread_id
+        self.in_flight: dict[int, InFlight] = {}
+        self.stopped = False
+        self._thread = threading.Thread(target=self._run, name="request-sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self.stopped:
+            threshold = time.monotonic() - settings.SLOW_REQUEST_THRESHOLD
+            sampled = [r for r in list(self.in_flight.values()) if r.always_sample or r.started <= threshold]
+
+            if sampled:
+                self.sample(sampled)
+
+            profiled = any(r.always_sample for r in sampled)
+            time.sleep(PROFILE_SAMPLE_INTERVAL if profiled else settings.SLOW_REQUEST_SAMPLE_INTERVAL)
+
+    def sample(self, requests: list[InFlight]):
+        running = asyncio.current_task(self.loop)
+        cpu_stack = None
+
+        for request in requests:
+            if request.task is running:
+                if cpu_stack is None:
+                    cpu_stack = fold(thread_stack(self.loop_thread_id))
+                counter, stack = request.cpu, cpu_stack
+            else:
+                stack = task_stack(request.task)
+                counter, stack = request.wait, fold(stack) if stack else None
+
+            with request.lock:
+                request.samples += 1
+                if stack is not None:
+                    counter[stack] += 1
+
+_sampler: Optional[Sampler] = None
+
+def get_sampler() -> Sampler:
+    """The sampler of the running loop, replacing the previous loop's."""
+    global _sampler
+    loop = asyncio.get_running_loop()
+
+    if _sampler is None or _sampler.loop is not loop:
+        if _sampler is not None:
+            _sampler.stopped = True
+        _sampler = Sampler(loop, threading.get_ident())
+
+    return _sampler
+
+# -----------------------
+# ring buffer
+
+def slow_request_record(request: InFlight, status: int, duration: float) -> dict:
+    cpu, wait, samples = request.snapshot()
+    return {
+        "method": request.method,
+        "path": request.path,
+        "status": status,
+        "duration_ms": round(duration * 1000, 2),
+        "finished_at": int(time.time()),
+        "samples": samples,
+        "cpu": dict(cpu.most_common(MAX_STACKS)),
+        "wait": dict(wait.most_common(MAX_STACKS)),
+    }
+
+async def store_slow_request(redis: aioredis.Redis, record: dict):
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.lpush(SLOW_REQUESTS_KEY, json.dumps(record))
+        pipe.ltrim(SLOW_REQUESTS_KEY, 0, settings.SLOW_REQUEST_BUFFER - 1)
+        await pipe.execute()
+
+async def load_slow_requests(redis: aioredis.Redis, limit: int) -> list[dict]:
+    """The most recent slow requests, newest first."""
+    return [json.loads(raw) for raw in await redis.lrange(SLOW_REQUESTS_KEY, 0, limit - 1)]
+
+# -----------------------
+# middleware
+
+class ProfilingMiddleware:
+    """Tracks every http request for the sampler, and profiles the ones asking for it."""
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._profiling = asyncio.Lock()  # cProfile can't profile two requests at once
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        profile = headers.get(PROFILE_HEADER, b"").decode()
+
+        if profile:
+            return await self.profile(scope, receive, send, profile, headers.get(b"authorization"))
+
+        request = InFlight(method=scope["method"], path=scope["path"], task=asyncio.current_task())
+        status = 500
+
+        async def send_status(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        sampler = get_sampler()
+        sampler.in_flight[id(request)] = request
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            sampler.in_flight.pop(id(request), None)
+            duration = time.monotonic() - request.started
+
+            if duration >= settings.SLOW_REQUEST_THRESHOLD:
+                await self.store(scope, slow_request_record(request, status, duration))
+
+    async def store(self, scope: Scope, record: dict):
+        try:
+            await store_slow_request(scope["app"].state.api.redis, record)
+        except Exception as e:
+            logger.warning("failed to store slow request", extra={"path": record["path"], "error": repr(e)})
+
+    async def authorize(self, scope: Scope, authorization: Optional[bytes]) -> Optional[Response]:
+        """An error response unless `authorization` belongs to an admin."""
+        # imported here, app.util.api pulls in the api package
+        from fastapi import HTTPException
+        from app.util.api import authenticate
+
+        if authorization is None:
+            return JSONResponse({"detail": "profiling requires authorization"}, status_code=401)
+
+        state = scope["app"].state.api
+        try:
+            async with await state.read_session() as session:
+                user = await authenticate(state, session, authorization.decode())
+        except HTTPException as e:
+            return JSONResponse({"detail": e.detail}, status_code=e.status_code)
+
+        if not (user.effective_permissions & Permissions.MANAGE_USERS):
+            return JSONResponse({"detail": "insufficient permissions"}, status_code=403)
+
+        return None
+
+    async def profile(self, scope: Scope, receive: Receive, send: Send, profile: str, authorization: Optional[bytes]):
+        if profile not in PROFILE_FORMATS:
+            response = JSONResponse({"detail": f"X-Profile must be one of {', '.join(PROFILE_FORMATS)}"}, status_code=400)
+            return await response(scope, receive, send)
+
+        error = await self.authorize(scope, authorization)
+        if error is not None:
+            return await error(scope, receive, send)
+
+        status = 500
+
+        async def discard(message: Message):
+            # the profile is the response, the handler's own is dropped
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+        started = time.monotonic()
+
+        if profile == "pstats":
+            if self._profiling.locked():
+                response = JSONResponse({"detail": "another request is being profiled"}, status_code=409)
+                return await response(scope, receive, send)
+
+            async with self._profiling:
+                # deterministic, but also counts whatever else the loop runs meanwhile
+                profiler = cProfile.Profile()
+                profiler.enable()
+                try:
+                    await self.app(scope, receive, discard)
+                finally:
+                    profiler.disable()
+
+            profiler.create_stats()
+            body, media_type = marshal.dumps(profiler.stats), "application/octet-stream"
+        else:
+            request = InFlight(
+                method=scope["method"], path=scope["path"], task=asyncio.current_task(), always_sample=True
+            )
+            sampler = get_sampler()
+            sampler.in_flight[id(request)] = request
+            try:
+                await self.app(scope, receive, discard)
+            finally:
+                sampler.in_flight.pop(id(request), None)
+
+            cpu, wait, _ = request.snapshot()
+            lines = io.StringIO()
+            for kind, stacks in (("cpu", cpu), ("wait", wait)):
+                for stack, count in stacks.most_common():
+                    lines.write(f"{kind};{stack} {count}\n")
+            body, media_type = lines.getvalue().encode(), "text/plain"
+
+        response = Response(body, media_type=media_type, headers={
+            "X-Profile-Status": str(status),
+            "X-Profile-Duration-Ms": f"{(time.monotonic() - started) * 1000:.2f}",
+        })
+        await response(scope, receive, send)
+
+ROOT_CODES.update({ProfilingMiddleware.__call__.__code__, ProfilingMiddleware.profile.__code__})
@@ -0,0 +1,403 @@
+"""The worker queues and the bookkeeping behind `/admin/queues` and `/admin/workers`.
+
+A queue is a redis list of item ids (workers pop from the head) plus a few
+companion keys, kept in step by lua scripts so a push or pop and its
+bookkeeping happen atomically:
+
+- `{queue}:enqueued`   hash, item -> unix time it was queued. Doubles as the
+                       dedupe set: an item already waiting isn't queued again.
+- `{queue}:priority`   list of items queued with `front` or bumped, e.g. players
+                       who just logged in. Workers drain it before the queue itself.
+- `{queue}:prioritized` set of the items waiting in the priority list.
+- `{queue}:superseded` set of items that were already waiting in the queue when
+                       they were queued with `front` or bumped. That copy is skipped when
+                       it comes up, the priority one is processed instead.
+- `{queue}:in_flight`  hash, item -> json {worker, started_at} while a worker has it.
+                       Items of workers that stopped heartbeating (killed mid
+                       item) are reaped back to the head of the queue.
+- `{queue}:stats:{m}`  hash of per-minute counters (enqueued, dequeued, ok,
+                       failed) for unix minute `m`, expiring after STATS_TTL.
+
+Every worker also keeps a heartbeat hash `pandemonium:worker:{id}` (items,
+failures, busy time, last error) indexed by the `pandemonium:workers` zset.
+"""
+import json
+import logging
+import time
+import app.settings as settings
+from typing import Iterable, Optional
+from redis import asyncio as aioredis
+from app.util.feeds import FEED_QUEUE
+
+# app.logger imports the metrics, which import this module
+logger = logging.getLogger("workers.queues")
+
+BEATMAP_QUEUE = "pandemonium:beatmap_queue"
+PLAYER_QUEUE = "pandemonium:player_queue"
+
+# the names the admin endpoints take
+QUEUES = {
+    "beatmaps": BEATMAP_QUEUE,
+    "players": PLAYER_QUEUE,
+    "feeds": FEED_QUEUE,
+}
+
+WORKERS_KEY = "pandemonium:workers"
+STATS_TTL = 60 * 60 * 2       # per-minute counters outlive the longest rate window
+RATE_WINDOWS = (1, 15, 60)    # minutes
+OLDEST_SCAN = 100             # head items looked at for the oldest one
+STAT_FIELDS = ("enqueued", "dequeued", "ok", "failed")
+
+def enqueued_key(queue: str) -> str:
+    return f"{queue}:enqueued"
+
+def priority_key(queue: str) -> str:
+    return f"{queue}:priority"
+
+def prioritized_key(queue: str) -> str:
+    return f"{queue}:prioritized"
+
+def superseded_key(queue: str) -> str:
+    return f"{queue}:superseded"
+
+def in_flight_key(queue: str) -> str:
+    return f"{queue}:in_flight"
+
+def stats_key(queue: str, minute: int) -> str:
+    return f"{queue}:stats:{minute}"
+
+def worker_key(worker_id: str) -> str:
+    return f"pandemonium:worker:{worker_id}"
+
+# -----------------------
+# scripts
+
+# KEYS: queue, enqueued, stats, priority, prioritized, superseded  ARGV: now, front, ttl, items...
+ENQUEUE_SCRIPT = """
+local added = 0
+for i = 4, #ARGV do
+    local new = redis.call("HSETNX", KEYS[2], ARGV[i], ARGV[1]) == 1
+    if ARGV[2] ~= "1" then
+        if new then
+            redis.call("RPUSH", KEYS[1], ARGV[i])
+        end
+    elseif redis.call("SADD", KEYS[5], ARGV[i]) == 1 then
+        -- not in the priority list yet. if it was waiting in the queue,
+        -- that copy is skipped by DEQUEUE_SCRIPT instead of walking the list
+        if not new then
+            redis.call("SADD", KEYS[6], ARGV[i])
+        end
+        redis.call("RPUSH", KEYS[4], ARGV[i])
+    end
+    if new then
+        added = added + 1
+    end
+end
+if added > 0 then
+    redis.call("HINCRBY", KEYS[3], "enqueued", added)
+    redis.call("EXPIRE", KEYS[3], ARGV[3])
+end
+return added
+"""
+
+# KEYS: enqueued, stats, priority, prioritized, superseded  ARGV: now, ttl, items... (last one ends up first)
+BUMP_SCRIPT = """
+local moved, added = 0, 0
+for i = 3, #ARGV do
+    local new = redis.call("HSETNX", KEYS[1], ARGV[i], ARGV[1]) == 1
+    if redis.call("SADD", KEYS[4], ARGV[i]) == 0 then
+        -- already on the priority list, move it within it
+        redis.call("LREM", KEYS[3], 0, ARGV[i])
+    elseif not new then
+        -- waiting in the queue, skip that copy like ENQUEUE_SCRIPT does
+        redis.call("SADD", KEYS[5], ARGV[i])
+    end
+    if new then
+        added = added + 1
+    else
+        moved = moved + 1
+    end
+    redis.call("LPUSH", KEYS[3], ARGV[i])
+end
+if added > 0 then
+    redis.call("HINCRBY", KEYS[2], "enqueued", added)
+    redis.call("EXPIRE", KEYS[2], ARGV[2])
+end
+return {moved, added}
+"""
+
+# KEYS: queue, enqueued, in_flight, stats, priority, prioritized, superseded  ARGV: in flight value, ttl
+DEQUEUE_SCRIPT = """
+local item = redis.call("LPOP", KEYS[5])
+if item then
+    redis.call("SREM", KEYS[6], item)
+else
+    repeat
+        item = redis.call("LPOP", KEYS[1])
+    until not item or redis.call("SREM", KEYS[7], item) == 0
+end
+if not item then
+    return false
+end
+local enqueued_at = redis.call("HGET", KEYS[2], item) or ""
+redis.call("HDEL", KEYS[2], item)
+redis.call("HSET", KEYS[3], item, ARGV[1])
+redis.call("HINCRBY", KEYS[4], "dequeued", 1)
+redis.call("EXPIRE", KEYS[4], ARGV[2])
+return {item, enqueued_at}
+"""
+
+# KEYS: in_flight, workers, queue, enqueued  ARGV: now, stale before
+REAP_SCRIPT = """
+local reaped = 0
+local entries = redis.call("HGETALL", KEYS[1])
+for i = 1, #entries, 2 do
+    local item = entries[i]
+    local seen = redis.call("ZSCORE", KEYS[2], cjson.decode(entries[i + 1])["worker"])
+    if not seen or tonumber(seen) < tonumber(ARGV[2]) then
+        redis.call("HDEL", KEYS[1], item)
+        if redis.call("HSETNX", KEYS[4], item, ARGV[1]) == 1 then
+            redis.call("LPUSH", KEYS[3], item)
+        end
+        reaped = reaped + 1
+    end
+end
+return reaped
+"""
+
+_scripts: dict[tuple[int, str], object] = {}
+
+def script(redis: aioredis.Redis, source: str):
+    """`source` registered on `redis`, EVALSHA with an EVAL fallback."""
+    key = (id(redis), source)
+    registered = _scripts.get(key)
+    if registered is None or registered.registered_client is not redis:
+        registered = _scripts[key] = redis.register_script(source)
+    return registered
+
+# -----------------------
+# producers
+
+async def enqueue(redis: aioredis.Redis, queue: str, items: Iterable, front: bool = False) -> int:
+    """Queue the `items` that aren't already waiting, returns how many were added.
+
+    `front` puts them on the priority list, which workers drain first, e.g.
+    a player who just logged in. That includes items already waiting at the
+    back of the queue, they aren't counted as added.
+    """
+    items = [str(item) for item in items]
+    if not items:
+        return 0
+
+    now = str(int(time.time()))
+    run = script(redis, ENQUEUE_SCRIPT)
+    added = 0
+
+    for start in range(0, len(items), 1000):
+        added += await run(
+            keys=[
+                queue, enqueued_key(queue), stats_key(queue, int(now) // 60),
+                priority_key(queue), prioritized_key(queue), superseded_key(queue),
+            ],
+            args=[now, "1" if front else "0", STATS_TTL, *items[start:start + 1000]],
+        )
+
+    return added
+
+async def bump(redis: aioredis.Redis, queue: str, items: Iterable) -> tuple[int, int]:
+    """Move `items` to the head of the priority list in the given order,
+    queueing the ones that weren't waiting. Returns (moved, added).
+
+    LREM walks the priority list, fine for a handful of ids, not for bulk loads.
+    """
+    items = [str(item) for item in items]
+    if not items:
+        return 0, 0
+
+    now = int(time.time())
+    moved, added = await script(redis, BUMP_SCRIPT)(
+        keys=[
+            enqueued_key(queue), stats_key(queue, now // 60),
+            priority_key(queue), prioritized_key(queue), superseded_key(queue),
+        ],
+        args=[now, STATS_TTL, *reversed(items)],
+    )
+    return moved, added
+
+async def clear(redis: aioredis.Redis, queue: str):
+    """Drop everything waiting, what's in flight finishes normally."""
+    await redis.delete(queue, enqueued_key(queue), priority_key(queue), prioritized_key(queue), superseded_key(queue))
+
+# -----------------------
+# workers
+
+async def dequeue(redis: aioredis.Redis, queue: str, worker_id: str) -> Optional[tuple[str, Optional[float]]]:
+    """The next item, from the priority list first, and how long it waited
+    (None for items queued without `enqueue`), marked as in flight for
+    `worker_id`. None if the queue is empty.
+    """
+    now = time.time()
+    popped = await script(redis, DEQUEUE_SCRIPT)(
+        keys=[
+            queue, enqueued_key(queue), in_flight_key(queue), stats_key(queue, int(now) // 60),
+            priority_key(queue), prioritized_key(queue), superseded_key(queue),
+        ],
+        args=[json.dumps({"worker": worker_id, "started_at": round(now, 3)}), STATS_TTL],
+    )
+    if not popped:
+        return None
+
+    item, enqueued_at = popped
+    return item, (now - int(enqueued_at) if enqueued_at else None)
+
+async def finish(redis: aioredis.Redis, queue: str, worker_id: str, item: str, seconds: float, error: Optional[BaseException] = None):
+    """Record `item` as done (or failed with `error`) for the queue and the worker."""
+    now = time.time()
+    key = worker_key(worker_id)
+    result = "ok" if error is None else "failed"
+
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.hdel(in_flight_key(queue), item)
+        pipe.hincrby(stats_key(queue, int(now) // 60), result, 1)
+        pipe.expire(stats_key(queue, int(now) // 60), STATS_TTL)
+
+        pipe.hincrby(key, "processed" if error is None else "failed", 1)
+        pipe.hincrbyfloat(key, "busy_seconds", seconds)
+        fields = {"last_item": item, "last_seen": now}
+        if error is not None:
+            fields.update(last_error=repr(error)[:500], last_error_at=now, last_error_item=item)
+        pipe.hset(key, mapping=fields)
+        pipe.expire(key, settings.WORKER_STATS_TTL)
+        pipe.zadd(WORKERS_KEY, {worker_id: now})
+        await pipe.execute()
+
+async def heartbeat(redis: aioredis.Redis, queue: str, worker_id: str, started_at: float):
+    """Register the worker, tell `/admin/workers` it's still alive and reap
+    the items other workers of `queue` left in flight."""
+    now = time.time()
+    key = worker_key(worker_id)
+
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.hset(key, mapping={"queue": queue, "started_at": started_at, "last_seen": now})
+        pipe.expire(key, settings.WORKER_STATS_TTL)
+        pipe.zadd(WORKERS_KEY, {worker_id: now})
+        # workers gone for longer than their stats live
+        pipe.zremrangebyscore(WORKERS_KEY, 0, now - settings.WORKER_STATS_TTL)
+        await pipe.execute()
+
+    reaped = await reap(redis, queue)
+    if reaped:
+        logger.warning("requeued items of dead workers", extra={"queue": queue, "items": reaped})
+
+async def reap(redis: aioredis.Redis, queue: str) -> int:
+    """Requeue, at the head, the in flight items of workers that are gone or
+    missed three heartbeats, returns how many. Workers heartbeat while busy
+    too, so a slow item isn't taken from a live one.
+    """
+    now = time.time()
+    return await script(redis, REAP_SCRIPT)(
+        keys=[in_flight_key(queue), WORKERS_KEY, queue, enqueued_key(queue)],
+        args=[int(now), now - settings.WORKER_HEARTBEAT_INTERVAL * 3],
+    )
+
+# -----------------------
+# introspection
+
+def queue_depth(pipe, queue: str):
+    """Queue the commands for `waiting_items` on `pipe`, three results."""
+    pipe.llen(queue)
+    pipe.llen(priority_key(queue))
+    pipe.scard(superseded_key(queue))
+
+def waiting_items(length: int, priority: int, superseded: int) -> int:
+    """Items waiting in `queue`, not counting the superseded copies."""
+    return max(length + priority - superseded, 0)
+
+async def queue_status(redis: aioredis.Redis, queue: str) -> dict:
+    """Depth, in flight items, the oldest waiting item and enqueue/dequeue rates."""
+    now = time.time()
+    minute = int(now) // 60
+    # complete minutes only, the current one is still filling up
+    minutes = [minute - offset for offset in range(1, max(RATE_WINDOWS) + 1)]
+
+    async with redis.pipeline(transaction=False) as pipe:
+        queue_depth(pipe, queue)
+        pipe.lrange(priority_key(queue), 0, OLDEST_SCAN - 1)
+        pipe.lrange(queue, 0, OLDEST_SCAN - 1)
+        pipe.hgetall(in_flight_key(queue))
+        for m in minutes:
+            pipe.hgetall(stats_key(queue, m))
+        length, priority, superseded, priority_head, head, in_flight, *stats = await pipe.execute()
+
+    depth = waiting_items(length, priority, superseded)
+    head = priority_head + head
+
+    oldest = None
+    if head:
+        # items are mostly queued in order, a bump or front enqueue can put
+        # a newer one ahead, so look at both heads rather than just the first
+        queued_at = [int(t) for t in await redis.hmget(enqueued_key(queue), head) if t]
+        if queued_at:
+            oldest = min(queued_at)
+
+    rates = {}
+    for window in RATE_WINDOWS:
+        totals = {name: sum(int(s.get(name, 0)) for s in stats[:window]) for name in STAT_FIELDS}
+        rates[f"{window}m"] = {name: round(total / window, 2) for name, total in totals.items()}
+
+    items = []
+    for item, raw in in_flight.items():
+        entry = json.loads(raw)
+        items.append({"item": item, "worker": entry["worker"], "seconds": round(now - entry["started_at"], 1)})
+    items.sort(key=lambda entry: -entry["seconds"])
+
+    return {
+        "queue": queue,
+        "depth": depth,
+        "oldest_age_seconds": round(now - oldest) if oldest is not None else None,
+        "in_flight": items,
+        "rates_per_minute": rates,
+    }
+
+async def worker_status(redis: aioredis.Redis) -> list[dict]:
+    """Every worker seen within WORKER_STATS_TTL, most recently seen first."""
+    now = time.time()
+    worker_ids = await redis.zrevrange(WORKERS_KEY, 0, -1)
+
+    async with redis.pipeline(transaction=False) as pipe:
+        for worker_id in worker_ids:
+            pipe.hgetall(worker_key(worker_id))
+        hashes = await pipe.execute()
+
+    workers = []
+    for worker_id, stats in zip(worker_ids, hashes):
+        if not stats:
+            continue
+
+        started_at = float(stats.get("started_at", now))
+        last_seen = float(stats.get("last_seen", started_at))
+        processed = int(stats.get("processed", 0))
+        failed = int(stats.get("failed", 0))
+        busy = float(stats.get("busy_seconds", 0))
+        uptime = max(last_seen - started_at, 1.0)
+
+        workers.append({
+            "id": worker_id,
+            "queue": stats.get("queue"),
+            "started_at": int(started_at),
+            "last_seen": int(last_seen),
+            "stale": now - last_seen > settings.WORKER_HEARTBEAT_INTERVAL * 3,
+            "processed": processed,
+            "failed": failed,
+            "items_per_minute": round((processed + failed) / uptime * 60, 2),
+            "avg_item_seconds": round(busy / (processed + failed), 3) if processed + failed else None,
+            "busy_ratio": round(min(busy / uptime, 1.0), 3),
+            "last_item": stats.get("last_item"),
+            "last_error": {
+                "error": stats["last_error"],
+                "item": stats.get("last_error_item"),
+                "at": int(float(stats["last_error_at"])),
+            } if "last_error" in stats else None,
+        })
+
+    return workers
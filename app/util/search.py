@@ -0,0 +1,124 @@
+import app.settings as settings
+
+from dataclasses import dataclass, replace, asdict
+from typing import Optional
+from fastapi import HTTPException, Header, Query, Request
+from qdrant_client.models import SearchParams, QuantizationSearchParams
+from app.database.groups import Permissions
+
+@dataclass(frozen=True)
+class SearchProfile:
+    """Accuracy/latency trade-off for the vector search of one endpoint."""
+    hnsw_ef: Optional[int] = None          # None uses the collection default
+    exact: bool = False                    # brute force, skips the hnsw index
+    rescore: Optional[bool] = None         # rescore quantized results with original vectors
+    oversampling: Optional[float] = None   # fetch `limit * oversampling` quantized candidates
+    ignore_quantization: Optional[bool] = None  # search the original vectors only
+    overridden: bool = False               # changed by an admin for this request, see `search_profile`
+
+    def to_params(self) -> SearchParams:
+        quantization = None
+        if self.rescore is not None or self.oversampling is not None or self.ignore_quantization is not None:
+            quantization = QuantizationSearchParams(
+                ignore=self.ignore_quantization,
+                rescore=self.rescore,
+                oversampling=self.oversampling,
+            )
+
+        return SearchParams(
+            hnsw_ef=self.hnsw_ef,
+            exact=self.exact,
+            quantization=quantization,
+        )
+
+# the feed fans out into many queries whose results get re-weighted
+# anyway, so it can afford a cheaper search than the similarity pages
+DEFAULT_SEARCH_PROFILES = {
+    "feed": SearchProfile(hnsw_ef=64),
+    # precomputed off-peak by the feed workers, nobody is waiting on it
+    "feed_materialized": SearchProfile(hnsw_ef=256, rescore=True),
+    "similar_beatmap": SearchProfile(hnsw_ef=128, rescore=True, oversampling=1.5),
+    "similar_beatmapset": SearchProfile(hnsw_ef=128, rescore=True),
+}
+
+# ground truth for bench/recall.py, brute force over the unquantized vectors
+EXACT_PROFILE = SearchProfile(exact=True, ignore_quantization=True)
+
+
+def validate_search_profiles(profiles: dict):
+    """Fail at startup on a bad `SEARCH_PROFILES`, instead of on every search."""
+    fields = set(SearchProfile.__dataclass_fields__) - {"overridden"}
+
+    for endpoint, overrides in profiles.items():
+        if not isinstance(overrides, dict):
+            raise ValueError(f"SEARCH_PROFILES[{endpoint!r}] must be an object of search settings")
+
+        unknown = set(overrides) - fields
+        if unknown:
+            raise ValueError(
+                f"unknown search settings in SEARCH_PROFILES[{endpoint!r}]: {', '.join(sorted(unknown))}, "
+                f"expected {', '.join(sorted(fields))}"
+            )
+
+validate_search_profiles(settings.SEARCH_PROFILES)
+
+
+def get_search_profile(endpoint: str) -> SearchProfile:
+    profile = DEFAULT_SEARCH_PROFILES.get(endpoint, SearchProfile())
+    return replace(profile, **settings.SEARCH_PROFILES.get(endpoint, {}))
+
+
+def get_search_profiles() -> dict[str, SearchProfile]:
+    endpoints = set(DEFAULT_SEARCH_PROFILES) | set(settings.SEARCH_PROFILES)
+    return {endpoint: get_search_profile(endpoint) for endpoint in sorted(endpoints)}
+
+
+def search_profile(endpoint: str):
+    """Dependency returning the `SearchProfile` for `endpoint`.
+
+    Admins (`MANAGE_USERS`) can override any field per request through the
+    `search_*` query parameters, e.g. `?search_exact=true` to compare against
+    exact results. Overrides from anybody else are rejected.
+    """
+    async def dependency(
+        request: Request,
+        search_ef: Optional[int] = Query(None, ge=1, include_in_schema=False),
+        search_exact: Optional[bool] = Query(None, include_in_schema=False),
+        search_rescore: Optional[bool] = Query(None, include_in_schema=False),
+        search_oversampling: Optional[float] = Query(None, ge=1.0, include_in_schema=False),
+        authorization: Optional[str] = Header(None),
+    ) -> SearchProfile:
+        profile = get_search_profile(endpoint)
+        overrides = {
+            key: value for key, value in {
+                "hnsw_ef": search_ef,
+                "exact": search_exact,
+                "rescore": search_rescore,
+                "oversampling": search_oversampling,
+            }.items()
+            if value is not None
+        }
+
+        if not overrides:
+            return profile
+
+        # imported here, app.util.api pulls in the api package which imports us
+        from app.util.api import authenticate
+
+        if authorization is None:
+            raise HTTPException(401, "search overrides require authorization")
+
+        state = request.app.state.api
+        async with await state.read_session() as session:
+            user = await authenticate(state, session, authorization)
+
+        if not (user.effective_permissions & Permissions.MANAGE_USERS):
+            raise HTTPException(403, "insufficient permissions")
+
+        return replace(profile, overridden=True, **overrides)
+
+    return dependency
+
+
+def describe_profile(profile: SearchProfile) -> dict:
+    return {key: value for key, value in asdict(profile).items() if value is not None and key != "overridden"}
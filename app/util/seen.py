@@ -0,0 +1,104 @@
+"""Per player set of mapsets they already know (played or favourited).
+
+Stored as a redis bitmap: bit `mapset_id` of `pandemonium:seen:{player_id}`
+is set once the player has any activity on that set. `PlayerWorker` sets
+bits as it syncs a player; readers fetch the whole bitmap once per request
+and test membership locally.
+"""
+import numpy
+import app.settings as settings
+from typing import Iterable, Optional
+from redis import asyncio as aioredis
+from redis.client import NEVER_DECODE
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from qdrant_client.models import FieldCondition, MatchAny
+from app.database.players import PlayerActivity
+from app.util.metrics import count_cache
+
+def seen_key(player_id) -> str:
+    return f"pandemonium:seen:{player_id}"
+
+class SeenSet:
+    """Read-only view of a seen bitmap, `mapset_id in seen` is O(1)."""
+
+    def __init__(self, bits: bytes = b""):
+        self.bits = bits
+        self._ids: Optional[numpy.ndarray] = None
+
+    @classmethod
+    def from_ids(cls, mapset_ids: Iterable[int]) -> "SeenSet":
+        ids = numpy.fromiter(mapset_ids, dtype=numpy.int64)
+        if len(ids) == 0:
+            return cls()
+
+        bits = numpy.zeros(int(ids.max()) + 1, dtype=numpy.uint8)
+        bits[ids] = 1
+        return cls(numpy.packbits(bits).tobytes())
+
+    def __contains__(self, mapset_id) -> bool:
+        index = int(mapset_id) >> 3
+        # redis numbers bits from the most significant bit of each byte
+        return index < len(self.bits) and bool(self.bits[index] & (0x80 >> (int(mapset_id) & 7)))
+
+    def __len__(self) -> int:
+        return len(self.ids())
+
+    def ids(self) -> numpy.ndarray:
+        if self._ids is None:
+            self._ids = numpy.flatnonzero(numpy.unpackbits(numpy.frombuffer(self.bits, dtype=numpy.uint8)))
+        return self._ids
+
+    def union(self, mapset_ids: Iterable[int]) -> "SeenSet":
+        extra = list(mapset_ids)
+        if not extra:
+            return self
+        return SeenSet.from_ids([*self.ids().tolist(), *extra])
+
+    def exclude_condition(self, key: str = "beatmapset_id") -> Optional[FieldCondition]:
+        """A qdrant `must_not` condition for these mapsets, if it's small enough to push down.
+
+        Large `MatchAny` filters cost more in qdrant than dropping the few
+        seen candidates afterwards, so past `SEEN_PUSHDOWN_LIMIT` callers
+        only filter locally.
+        """
+        ids = self.ids()
+        if len(ids) == 0 or len(ids) > settings.SEEN_PUSHDOWN_LIMIT:
+            return None
+
+        return FieldCondition(key=key, match=MatchAny(any=ids.tolist()))
+
+async def mark_seen(redis: aioredis.Redis, player_id, mapset_ids: Iterable[int]):
+    """Set the bits for `mapset_ids` and refresh the bitmap's ttl."""
+    key = seen_key(player_id)
+
+    async with redis.pipeline(transaction=False) as pipe:
+        for mapset_id in set(mapset_ids):
+            pipe.setbit(key, int(mapset_id), 1)
+        pipe.expire(key, settings.SEEN_TTL)
+        await pipe.execute()
+
+async def get_seen(redis: aioredis.Redis, session: AsyncSession, player_id) -> SeenSet:
+    """Load the seen set for `player_id`.
+
+    Falls back to the player's activity rows when the bitmap is missing
+    (never synced since this was added, or expired) and writes it back.
+    """
+    bits = await redis.execute_command("GET", seen_key(player_id), **{NEVER_DECODE: True})
+    if bits is not None:
+        count_cache("seen", hits=1)
+        return SeenSet(bits)
+
+    count_cache("seen", misses=1)
+
+    result = await session.execute(
+        select(PlayerActivity.mapset_id)
+        .where(PlayerActivity.player_id == player_id, PlayerActivity.mapset_id.is_not(None))
+        .distinct()
+    )
+    mapset_ids = result.scalars().all()
+
+    if mapset_ids:
+        await mark_seen(redis, player_id, mapset_ids)
+
+    return SeenSet.from_ids(mapset_ids)
@@ -0,0 +1,200 @@
+import math
+import time
+import app.settings as settings
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace, asdict
+from typing import Optional
+from fastapi import HTTPException
+from sqlalchemy import Select, String, case, cast, func, literal, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database.players import PlayerActivity
+from app.util.metrics import STAGE_SECONDS
+
+@dataclass(frozen=True)
+class FeedWeights:
+    """How much each activity row steers a player's feed.
+
+    A row weighs `type * decay * pp * rank * mods`, and a mapset weighs the
+    sum of its rows. Only the `max_sources` heaviest mapsets are used to
+    search for candidates, which is the main cost knob of the feed.
+    """
+    half_life_days: float = 90.0     # activity this old counts half, 0 disables decay
+    pp_scale: float = 300.0          # pp at which a score gets the full pp bonus
+    pp_bonus: float = 0.5            # up to +50% for scores at or above pp_scale
+    max_sources: int = 64            # heaviest mapsets used as search queries
+    type_weights: dict[str, float] = field(default_factory=lambda: {
+        "score": 1.0,
+        "favourite": 1.8,
+        "pinned": 2.8,
+        "nominated": 1.6,
+    })
+    rank_multipliers: dict[str, float] = field(default_factory=lambda: {
+        "XH": 1.2, "X": 1.2,
+        "SH": 1.1, "S": 1.1,
+        "A": 1.0,
+        "B": 0.85, "C": 0.7, "D": 0.6, "F": 0.5,
+    })
+    # mod affinity, scores set with these mods say more (or less) about taste
+    mod_multipliers: dict[str, float] = field(default_factory=lambda: {
+        "DT": 1.15, "NC": 1.15, "HR": 1.1, "FL": 1.1,
+        "HT": 0.8, "EZ": 0.8, "NF": 0.9,
+    })
+
+    def __post_init__(self):
+        if self.half_life_days < 0:
+            raise ValueError("half_life_days must be at least 0")
+        if self.pp_scale <= 0:
+            raise ValueError("pp_scale must be positive")
+        if self.max_sources < 1:
+            raise ValueError("max_sources must be at least 1")
+
+def merge_weights(weights: FeedWeights, source: dict) -> FeedWeights:
+    """`weights` with the fields of `source` replaced, raises ValueError on bad ones.
+
+    Numbers are checked against the field's type, the multiplier dicts are
+    merged into the current ones, so `{"type_weights": {"pinned": 3}}` keeps
+    the other types.
+    """
+    unknown = set(source) - set(FeedWeights.__dataclass_fields__)
+    if unknown:
+        raise ValueError(f"unknown feed weights: {', '.join(sorted(unknown))}")
+
+    changes = {}
+    for name, value in source.items():
+        current = getattr(weights, name)
+
+        if isinstance(current, dict):
+            if not isinstance(value, dict) or not all(is_number(v) for v in value.values()):
+                raise ValueError(f"{name} must be an object of numbers")
+            changes[name] = {**current, **{key: float(v) for key, v in value.items()}}
+        elif FeedWeights.__dataclass_fields__[name].type is int:
+            if not is_number(value) or value != int(value):
+                raise ValueError(f"{name} must be an integer")
+            changes[name] = int(value)
+        else:
+            if not is_number(value):
+                raise ValueError(f"{name} must be a number")
+            changes[name] = float(value)
+
+    return replace(weights, **changes)
+
+def is_number(value) -> bool:
+    # json.loads takes NaN and Infinity too
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+# checked once, a bad FEED_WEIGHTS fails at startup instead of on every feed
+CONFIGURED_WEIGHTS = merge_weights(FeedWeights(), settings.FEED_WEIGHTS)
+
+def get_feed_weights(overrides: Optional[dict] = None) -> FeedWeights:
+    """Defaults, then `settings.FEED_WEIGHTS`, then the request's `overrides`."""
+    if not overrides:
+        return CONFIGURED_WEIGHTS
+
+    try:
+        return merge_weights(CONFIGURED_WEIGHTS, overrides)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+def describe_weights(weights: FeedWeights) -> dict:
+    return asdict(weights)
+
+
+def activity_weight_expression(weights: FeedWeights):
+    """Per row weight of `player_activity`, as a sql expression."""
+    activity_type = cast(PlayerActivity.type, String)
+    type_weight = case(weights.type_weights, value=activity_type, else_=1.0)
+
+    if weights.half_life_days > 0:
+        # scores age from when they were set, favourites from their first sync
+        age_days = func.extract("epoch", func.now() - PlayerActivity.created_at) / 86400.0
+        decay = func.power(0.5, func.greatest(age_days, 0) / weights.half_life_days)
+    else:
+        decay = literal(1.0)
+
+    pp = func.coalesce(PlayerActivity.value["pp"].as_float(), 0.0)
+    pp_multiplier = 1.0 + weights.pp_bonus * func.least(pp / weights.pp_scale, 1.0)
+
+    rank_multiplier = case(weights.rank_multipliers, value=PlayerActivity.value["rank"].as_string(), else_=1.0)
+
+    # mods are stored as a json list of acronyms, e.g. ["HD", "DT"]
+    mods = func.coalesce(PlayerActivity.value["mods"].as_string(), "")
+    weight = type_weight * decay * pp_multiplier * rank_multiplier
+    for mod, multiplier in weights.mod_multipliers.items():
+        weight = weight * case((mods.like(f'%"{mod}"%'), multiplier), else_=1.0)
+
+    return weight
+
+def mapset_weights_query(player_id, weights: FeedWeights) -> Select:
+    """One aggregate over the player's activity: the `max_sources` heaviest mapsets.
+
+    Rows are `(mapset_id, weight, map_ids, activities, mapsets)`, where `map_ids`
+    are the played difficulties (empty for e.g. favourites), and the last two
+    count the activity rows and mapsets that got a weight, before the limit.
+    Rows still waiting for their mapset (see app/util/mapsets.py) are skipped.
+    """
+    mapset_id = PlayerActivity.mapset_id
+    weight = func.sum(activity_weight_expression(weights)).label("weight")
+
+    return (
+        select(
+            mapset_id,
+            weight,
+            func.array_remove(func.array_agg(PlayerActivity.map_id.distinct()), None).label("map_ids"),
+            func.sum(func.count()).over().label("activities"),
+            func.count().over().label("mapsets"),
+        )
+        .where(PlayerActivity.player_id == player_id, mapset_id.is_not(None))
+        .group_by(mapset_id)
+        .order_by(weight.desc(), mapset_id)
+        .limit(weights.max_sources)
+    )
+
+@dataclass
+class MapsetWeight:
+    mapset_id: int
+    weight: float
+    map_ids: list[int]
+
+@dataclass
+class FeedProfile:
+    """Where the time of one feed ranking went, for tuning `FeedWeights`.
+
+    Stages are also observed as `pandemonium_stage_seconds{operation=...}`.
+    """
+    stages: dict[str, float] = field(default_factory=dict)  # milliseconds
+    counts: dict[str, int] = field(default_factory=dict)
+    operation: str = "feed"  # metrics label, the feed workers use their own
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.stages[name] = round(elapsed * 1000, 3)
+            STAGE_SECONDS.labels(self.operation, name).observe(elapsed)
+
+    def as_dict(self) -> dict:
+        return {"stages_ms": self.stages, "counts": self.counts}
+
+async def load_mapset_weights(
+    session: AsyncSession,
+    player_id,
+    weights: FeedWeights,
+    profile: Optional[FeedProfile] = None,
+) -> list[MapsetWeight]:
+    """The heaviest mapsets of `player_id`, heaviest first."""
+    result = await session.execute(mapset_weights_query(player_id, weights))
+    rows = result.all()
+
+    if profile is not None:
+        profile.counts["activities"] = int(rows[0].activities) if rows else 0
+        profile.counts["weighted_mapsets"] = int(rows[0].mapsets) if rows else 0
+        profile.counts["sources"] = len(rows)
+
+    return [
+        MapsetWeight(mapset_id=int(row.mapset_id), weight=float(row.weight), map_ids=list(row.map_ids or []))
+        for row in rows
+    ]
@@ -1,100 +1,85 @@
 import asyncio
+import itertools
+import os
+import socket
+import time
 import app.settings as settings
 
 from abc import ABC, abstractmethod
-from redis import asyncio as aioredis
-from ossapi import OssapiAsync
-from qdrant_client import AsyncQdrantClient
-from qdrant_client.http.models import VectorParams, Distance
-from app.database import async_session
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from app.resources import Resources, ProcessRole
+from app.util.metrics import QUEUE_WAIT_SECONDS, WORKER_ITEMS
+from app.util.queues import dequeue, finish, heartbeat
+from app.logger import worker_logger
 
 
-class WorkerState:
+class WorkerState(Resources):
     """
     A shared state object for workers to maintain context between tasks.
+    All workers of a process share a single instance and its pools.
     """
-    redis: aioredis.Redis
-    osu: OssapiAsync
-    qdrant: AsyncQdrantClient
-
     def __init__(self) -> None:
-        self._engine = None
-        self._sessionmaker = None
-        pass
-
-    async def init(self):
-        self.redis = await aioredis.from_url(
-            f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_DB}",
-            decode_responses=True
-        )
-
-        self.osu = OssapiAsync(
-            settings.OSU_API_CLIENT_ID,
-            settings.OSU_API_CLIENT_SECRET
-        )
-        
-        self.qdrant = AsyncQdrantClient(url=settings.QDRANT_URL,api_key=settings.QDRANT_API_KEY)
-
-        await self.qdrant.create_payload_index(
-            collection_name="beatmap_embeddings",
-            field_name="beatmapset_id",
-            field_schema={"type": "integer"}  # string filterable
-        )
-
-    def get_engine(self):
-        if self._engine is None:
-            self._engine = create_async_engine(
-                settings.PG_DSN,
-                echo=False,
-                future=True,
-                pool_size=10,
-                max_overflow=20,
-            )
-        return self._engine
-
-    def get_sessionmaker(self):
-        if self._sessionmaker is None:
-            self._sessionmaker = async_sessionmaker(
-                self.get_engine(),
-                expire_on_commit=False,
-                class_=AsyncSession,
-            )
-        return self._sessionmaker
-
-    async def get_session(self):
-        return self.get_sessionmaker()()
-    
-    async def get_redis_pool(self) -> aioredis.Redis:
-        return await aioredis.from_url(
-            f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_DB}",
-            decode_responses=True
-        )
-
-    async def close(self):
-        if self.redis:
-            await self.redis.close()
+        super().__init__(ProcessRole.WORKER)
 
 class Worker(ABC):
     """
     Abstract asynchronous worker class for processing tasks from a queue.
     All worker implementations must inherit from this class and implement the `process` method.
     """
+    _instances = itertools.count(1)
+
     def __init__(self, queue_name: str, state: WorkerState):
         self.queue_name = queue_name
         self.state = state
+        # unique across hosts and processes, shown by /admin/workers
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{type(self).__name__}:{next(self._instances)}"
 
     async def run(self):
-        pool = await self.state.get_redis_pool()
+        # busy or idle, so /admin/workers knows the queue and uptime from the
+        # start and the reaper doesn't take a slow item from a live worker.
+        # registered before the first dequeue, an unknown worker gets reaped
+        started_at = time.time()
+        await heartbeat(self.state.redis, self.queue_name, self.worker_id, started_at)
+        beating = asyncio.create_task(self.beat(started_at))
+        try:
+            await self.consume()
+        finally:
+            beating.cancel()
+
+    async def beat(self, started_at: float):
+        while True:
+            await asyncio.sleep(settings.WORKER_HEARTBEAT_INTERVAL)
+            try:
+                await heartbeat(self.state.redis, self.queue_name, self.worker_id, started_at)
+            except Exception:
+                worker_logger.exception("failed to heartbeat", extra={"queue": self.queue_name})
+
+    async def consume(self):
+        redis = self.state.redis
 
         while True:
-            item_id = await pool.lpop(self.queue_name)
+            popped = await dequeue(redis, self.queue_name, self.worker_id)
 
-            if item_id is not None:
-                await self.process(item_id)
-            else:
+            if popped is None:
                 await asyncio.sleep(1)  # sleep briefly if no items are available
+                continue
+
+            item_id, waited = popped
+            if waited is not None:
+                QUEUE_WAIT_SECONDS.labels(self.queue_name).observe(waited)
+
+            started = time.monotonic()
+            error = None
+
+            try:
+                await self.process(item_id)
+            except Exception as e:
+                # one bad item shouldn't take the worker down, it shows up in
+                # the logs and as the worker's last error on /admin/workers
+                error = e
+                worker_logger.exception("failed to process item", extra={"queue": self.queue_name, "item_id": item_id})
+
+            WORKER_ITEMS.labels(self.queue_name, "ok" if error is None else "failed").inc()
+            await finish(redis, self.queue_name, self.worker_id, item_id, time.monotonic() - started, error)
 
     @abstractmethod
     async def process(self, item_id):
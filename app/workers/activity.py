@@ -0,0 +1,84 @@
+import asyncio
+import app.settings as settings
+from . import WorkerState
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text
+from app.database.players import ACTIVITY_PARTITIONS, activity_partition
+from app.workers.feeds import seconds_until_hour
+from app.logger import worker_logger
+
+logger = worker_logger.getChild("activity")
+
+class ActivityCompactor:
+    """
+    Keeps player_activity bounded. Once a day at ACTIVITY_COMPACT_HOUR (utc)
+    it deletes rows no sync has returned for ACTIVITY_RETENTION_DAYS and
+    everything past a player's ACTIVITY_MAX_ROWS_PER_PLAYER freshest rows, one partition at a time
+    so each transaction (and its locks) only covers a sixteenth of the table.
+    """
+    def __init__(self, state: WorkerState):
+        self.state = state
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(seconds_until_hour(settings.ACTIVITY_COMPACT_HOUR))
+            try:
+                await self.compact()
+            except Exception:
+                # partitions done so far stay compacted, the rest waits for tomorrow
+                logger.exception("failed to compact player activity")
+
+    async def compact(self, force: bool = False) -> int:
+        """Compact every partition, returns how many rows were deleted. `force` skips the once-a-day claim."""
+        now = datetime.now(timezone.utc)
+
+        # a forced run doesn't claim the day, the nightly run still happens
+        if not force:
+            claimed = await self.state.redis.set(f"pandemonium:activity_compact:{now:%Y-%m-%d}", 1, nx=True, ex=60 * 60 * 48)
+            if not claimed:
+                return 0
+
+        # synced_at is stored naive utc
+        cutoff = (now - timedelta(days=settings.ACTIVITY_RETENTION_DAYS)).replace(tzinfo=None)
+        deleted = 0
+
+        for remainder in range(ACTIVITY_PARTITIONS):
+            count = await self.compact_partition(activity_partition(remainder), cutoff)
+            deleted += count
+
+            if count:
+                logger.info("compacted partition", extra={"partition": activity_partition(remainder), "deleted": count})
+
+        logger.info("compacted player_activity", extra={"deleted": deleted})
+        return deleted
+
+    async def compact_partition(self, table: str, cutoff: datetime) -> int:
+        async with self.state.get_session() as session:
+            result = await session.execute(
+                text(f"""
+                    DELETE FROM {table} AS activity
+                    USING (
+                        SELECT player_id, id
+                        FROM (
+                            SELECT player_id, id, synced_at, row_number() OVER (
+                                PARTITION BY player_id
+                                ORDER BY synced_at DESC NULLS LAST, created_at DESC NULLS LAST, id DESC
+                            ) AS position
+                            FROM {table}
+                        ) ranked
+                        WHERE position > :max_rows OR synced_at < :cutoff
+                    ) expired
+                    WHERE activity.player_id = expired.player_id AND activity.id = expired.id
+                """),
+                {"max_rows": settings.ACTIVITY_MAX_ROWS_PER_PLAYER, "cutoff": cutoff},
+            )
+            await session.commit()
+
+        if result.rowcount:
+            # makes the freed space reusable by the next syncs, so the partition
+            # stops growing instead of waiting for autovacuum to get to it
+            async with self.state.engine.connect() as conn:
+                conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+                await conn.execute(text(f"VACUUM (ANALYZE) {table}"))
+
+        return result.rowcount
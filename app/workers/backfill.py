@@ -0,0 +1,151 @@
+import asyncio
+import json
+import time
+import app.settings as settings
+from . import WorkerState
+from typing import Optional
+from ossapi.enums import BeatmapsetSearchCategory, BeatmapsetSearchExplicitContent, BeatmapsetSearchSort, RankStatus
+from ossapi.models import Cursor
+from app.util.metrics import timed
+from app.util.queues import BEATMAP_QUEUE, enqueue
+from app.workers.beatmaps import BeatmapWorker
+from app.logger import worker_logger
+
+logger = worker_logger.getChild("backfill")
+
+CHECKPOINT_KEY = "pandemonium:backfill:catalogue"
+LOCK_KEY = "pandemonium:backfill:catalogue:lock"
+LOCK_TTL = 60 * 5  # refreshed every page, a crashed run frees it after this
+
+def complete_listing(beatmapset) -> bool:
+    """Whether a search result has everything `BeatmapWorker.store` needs."""
+    return (
+        getattr(beatmapset, "genre", None) is not None
+        and getattr(beatmapset, "language", None) is not None
+        and getattr(beatmapset, "tags", None) is not None
+        and all(getattr(beatmap, "top_tag_ids", None) is not None for beatmap in beatmapset.beatmaps or [])
+    )
+
+class CatalogueBackfill:
+    """
+    Walks the osu! ranked beatmapset listing, oldest ranked first, and stores
+    each page of sets through `BeatmapWorker.store`: one search call per page
+    instead of one beatmapset call per set. Sets the listing returns without
+    their genre, language or user tags are queued for BeatmapWorker instead.
+
+    The cursor is checkpointed in redis after every page, so an interrupted
+    run picks up where it left off. Sets ranked in the meantime land at the
+    end of the listing, so they are reached by the same run or, once it
+    caught up, by the next one.
+    """
+    def __init__(self, state: WorkerState):
+        self.state = state
+        self.beatmaps = BeatmapWorker(state)
+        self._last_fetch = 0.0
+
+    async def checkpoint(self) -> dict:
+        raw = await self.state.redis.get(CHECKPOINT_KEY)
+        return json.loads(raw) if raw else {}
+
+    async def run(self, restart: bool = False, max_pages: Optional[int] = None) -> Optional[dict]:
+        """Backfill until the listing ends or after `max_pages`, returns the
+        checkpoint. None if another run holds the lock.
+        """
+        redis = self.state.redis
+
+        if not await redis.set(LOCK_KEY, 1, nx=True, ex=LOCK_TTL):
+            logger.warning("catalogue backfill already running")
+            return None
+
+        try:
+            checkpoint = {} if restart else await self.checkpoint()
+            checkpoint = {"pages": 0, "sets": 0, "stored": 0, "queued": 0, **checkpoint, "done": False}
+
+            if checkpoint.get("cursor"):
+                logger.info("resuming catalogue backfill", extra={"pages": checkpoint["pages"], "cursor": checkpoint["cursor"]})
+
+            return await self.walk(checkpoint, max_pages)
+        finally:
+            await redis.delete(LOCK_KEY)
+
+    async def walk(self, checkpoint: dict, max_pages: Optional[int]) -> dict:
+        redis = self.state.redis
+        cursor = Cursor(**checkpoint["cursor"]) if checkpoint.get("cursor") else None
+        pages = 0
+        next_page = asyncio.create_task(self.fetch(cursor))
+
+        try:
+            while next_page is not None:
+                page = await next_page
+                pages += 1
+
+                # the next page downloads while this one is stored
+                more = page.cursor is not None and (max_pages is None or pages < max_pages)
+                next_page = asyncio.create_task(self.fetch(page.cursor)) if more else None
+
+                stored, queued = await self.ingest(page.beatmapsets)
+
+                # at the end of the listing keep the cursor of its last page:
+                # the next run reads that page again (its sets are up to date,
+                # so that's one call) and carries on with sets ranked since
+                if page.cursor is not None:
+                    cursor = page.cursor
+
+                checkpoint.update(
+                    cursor=vars(cursor) if cursor is not None else None,
+                    done=page.cursor is None,
+                    pages=checkpoint["pages"] + 1,
+                    sets=checkpoint["sets"] + len(page.beatmapsets),
+                    stored=checkpoint["stored"] + stored,
+                    queued=checkpoint["queued"] + queued,
+                    updated_at=int(time.time()),
+                )
+
+                async with redis.pipeline(transaction=False) as pipe:
+                    pipe.set(CHECKPOINT_KEY, json.dumps(checkpoint))
+                    pipe.expire(LOCK_KEY, LOCK_TTL)
+                    await pipe.execute()
+
+                logger.info("backfilled catalogue page", extra={
+                    "page": checkpoint["pages"], "sets": len(page.beatmapsets), "stored": stored, "queued": queued,
+                })
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+        logger.info("catalogue backfill " + ("caught up" if checkpoint["done"] else "paused"), extra={
+            key: checkpoint[key] for key in ("pages", "sets", "stored", "queued")
+        })
+        return checkpoint
+
+    async def fetch(self, cursor: Optional[Cursor]):
+        # stay under the osu! api rate limit, the workers share it
+        wait = self._last_fetch + settings.BACKFILL_PAGE_INTERVAL - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self._last_fetch = time.monotonic()
+
+        with timed("catalogue_backfill", "fetch"):
+            return await self.state.osu.search_beatmapsets(
+                category=BeatmapsetSearchCategory.RANKED,
+                sort=BeatmapsetSearchSort.RANKED_ASCENDING,
+                explicit_content=BeatmapsetSearchExplicitContent.SHOW,
+                cursor=cursor,
+            )
+
+    async def ingest(self, beatmapsets: list) -> tuple[int, int]:
+        """Store the new or changed ranked sets of a page, returns (stored, queued)."""
+        # same as BeatmapWorker, only ranked sets are kept
+        ranked = [beatmapset for beatmapset in beatmapsets if beatmapset.status is RankStatus.RANKED]
+        complete = [beatmapset for beatmapset in ranked if complete_listing(beatmapset)]
+        incomplete = [beatmapset for beatmapset in ranked if not complete_listing(beatmapset)]
+
+        outdated = await self.beatmaps.outdated(complete) if complete else []
+        if outdated:
+            await self.beatmaps.store(outdated)
+
+        # without user tags to compare, only sets that are new or were updated
+        # since they were stored need the full lookup
+        refetch = await self.beatmaps.outdated(incomplete, check_tags=False) if incomplete else []
+        queued = await enqueue(self.state.redis, BEATMAP_QUEUE, [beatmapset.id for beatmapset in refetch]) if refetch else 0
+        return len(outdated), queued
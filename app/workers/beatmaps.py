@@ -3,180 +3,166 @@ import hashlib
 import numpy
 from . import Worker, WorkerState
 from ossapi.enums import RankStatus
-from app.logger import worker_logger as logger
+from app.logger import worker_logger
 from datetime import datetime
 from app.database.beatmaps import BeatmapSet, Beatmap
+from app.database.embeddings import BEATMAP_COLLECTION, BEATMAPSET_COLLECTION, BEATMAP_VECTOR_SIZE, beatmapset_point
+from app.util.mapsets import backfill_activity_mapsets, cache_mapset_ids
+from app.util.metrics import timed
+from app.util.queues import BEATMAP_QUEUE
+from app.util.seen import mark_seen
+from sqlalchemy import select
 from sqlalchemy.dialects.postgresql import insert
 from qdrant_client.http.models import PointStruct
  
+logger = worker_logger.getChild("beatmaps")
+
+# rows per multi-row insert, a page of sets can have hundreds of beatmaps and
+# asyncpg takes at most 32767 parameters per statement
+UPSERT_BATCH = 1000
+
 class BeatmapWorker(Worker):
     def __init__(self, state: WorkerState):
-        super().__init__("pandemonium:beatmap_queue", state)
+        super().__init__(BEATMAP_QUEUE, state)
 
     async def process(self, item_id):
-        # Implement the processing logic for beatmap items here
-        beatmapset = await self.state.osu.beatmapset(item_id)
-        session = await self.state.get_session()
-        get_session = await self.state.get_session()
-        points = []
+        with timed("beatmap_worker", "fetch"):
+            beatmapset = await self.state.osu.beatmapset(item_id)
 
-        print(f"Processing beatmapset {beatmapset.id} - {beatmapset.artist} - {beatmapset.title}")
+        logger.debug("processing beatmapset", extra={"beatmapset_id": beatmapset.id})
 
-        # get the beatmapset from the database, or create it if it doesn't exist
-        added_mapset = await get_session.get(BeatmapSet, beatmapset.id)
+        if not await self.outdated([beatmapset]):
+            logger.debug("beatmapset up to date", extra={"beatmapset_id": beatmapset.id})
+            return
 
-        if added_mapset:
-            do_update = True
-            print(f"Beatmapset {beatmapset.id} already exists in the database, checking if it should be updated...")
+        if beatmapset.status is not RankStatus.RANKED:
+            # temporarily ignore unranked maps
 
-            if added_mapset.status != beatmapset.status.value:
-                # the status is different
-                do_update = True
-            elif added_mapset.last_synced_at >= int(beatmapset.last_updated.timestamp()):
-                do_update = False
-                
-                # it's safe to assume that generally, if the last sync time was 
-                # after the set last updated, then it likely shouldn't be updated.
-                # however, there are some circumstances where it shouldn't be
-                beatmap_embeddings = await self.state.qdrant.retrieve(
-                    collection_name="beatmap_embeddings",
-                    ids=[bm.id for bm in beatmapset.beatmaps if beatmapset.beatmaps is not None],
-                    with_payload=True,
-                )
+            # even though you can tag beatmaps, the statuses of them are
+            # far too unpredictable to really trust the data for them
 
-                # build a map of current beatmaps for quick lookup
-                beatmap_by_id = {bm.id: bm for bm in (beatmapset.beatmaps or [])}
+            # TODO: delete maps that exist in the database and are
+            # currently unranked
+            return
 
-                for point in beatmap_embeddings:
-                    pid = point.id
-                    payload = getattr(point, "payload", {}) or {}
-                    existing_tags = payload.get("user_tags", {})
+        await self.store([beatmapset])
 
-                    bm = beatmap_by_id.get(pid)
-                    if not bm:
-                        continue
+    async def outdated(self, beatmapsets: list, check_tags: bool = True) -> list:
+        """The sets of `beatmapsets` that aren't stored yet or changed since they were.
 
-                    # normalize both sides to {str(tag_id): int(count)} for comparison
-                    current_tags = {str(tag["tag_id"]): int(tag["count"]) for tag in (bm.top_tag_ids or [])}
-                    existing_tags_norm = {str(k): int(v) for k, v in (existing_tags or {}).items()}
+        `check_tags=False` trusts the status and last update alone, for sets
+        listed without their user tags.
+        """
+        with timed("beatmap_worker", "lookup"):
+            async with self.state.get_session() as session:
+                result = await session.execute(
+                    select(BeatmapSet.id, BeatmapSet.status, BeatmapSet.last_synced_at)
+                    .where(BeatmapSet.id.in_([beatmapset.id for beatmapset in beatmapsets]))
+                )
+                stored = {row.id: row for row in result}
 
-                    if current_tags != existing_tags_norm:
-                        do_update = True
-                        print(f"Detected tag differences for beatmap {pid}, marking set for update")
-                        break
+        outdated = []
+        synced = []
 
-            if not do_update:
-                print(f"Beatmapset {beatmapset.id} is up to date, skipping...")
-                await session.close()
-                await get_session.close()
-                return
+        for beatmapset in beatmapsets:
+            row = stored.get(beatmapset.id)
 
-        if beatmapset.status is not RankStatus.RANKED:
-            # temporarily ignore unranked maps
+            if row is None or row.status != beatmapset.status.value:
+                # new, or the status is different
+                outdated.append(beatmapset)
+            elif (row.last_synced_at or 0) >= int(beatmapset.last_updated.timestamp()):
+                # it's safe to assume that generally, if the last sync time was
+                # after the set last updated, then it likely shouldn't be updated.
+                # however, user tags change without the set being updated
+                synced.append(beatmapset)
+            else:
+                outdated.append(beatmapset)
 
-            # even though you can tag beatmaps, the statuses of them are
-            # far too unpredictable to really trust the data for them
-            await get_session.close()
+        if not synced or not check_tags:
+            return outdated
 
-            # TODO: delete maps that exist in the database and are
-            # currently unranked
-            return
-            
-        await get_session.close()
-        values = {
-            "id": beatmapset.id,
-            "artist": beatmapset.artist,
-            "title": beatmapset.title,
-            "creator": beatmapset.creator,
-            "source": beatmapset.source,
-            "genre": beatmapset.genre["id"] if beatmapset.genre else 0,
-            "language": beatmapset.language["id"] if beatmapset.language else 0,
-            "tags": beatmapset.tags.split(),
-            "status": beatmapset.status.value,
-            "play_count": beatmapset.play_count,
-            "favourite_count": beatmapset.favourite_count,
-            "last_synced_at": int(datetime.utcnow().timestamp())
+        with timed("beatmap_worker", "tag_check"):
+            beatmap_embeddings = await self.state.qdrant.retrieve(
+                collection_name=BEATMAP_COLLECTION,
+                ids=[bm.id for beatmapset in synced for bm in beatmapset.beatmaps or []],
+                with_payload=["user_tags"],
+            )
+
+        # normalize both sides to {str(tag_id): int(count)} for comparison
+        existing_tags = {
+            point.id: {str(k): int(v) for k, v in ((point.payload or {}).get("user_tags") or {}).items()}
+            for point in beatmap_embeddings
         }
 
-        stmt = insert(BeatmapSet)
-        stmt = stmt.values(**values)
-        stmt = stmt.on_conflict_do_update(
-            index_elements=[BeatmapSet.id],
-            set_=values
-        )
-            
-        await session.execute(stmt)
-
-        for beatmap in beatmapset.beatmaps or []:
-            embedding = self.compute_beatmap_embedding(beatmapset, beatmap)
-            top_tags_payload = {str(tag["tag_id"]): tag["count"] for tag in beatmap.top_tag_ids or []} # type: ignore // the ossapi types are wrong
-            bm_values  = {
-                "id": beatmap.id,
-                "beatmapset_id": beatmapset.id,
-                "difficulty_name": beatmap.version,
-                "mode": beatmap.mode.value,
-                "bpm": beatmap.bpm,
-                "cs": beatmap.cs,
-                "ar": beatmap.ar,
-                "od": beatmap.accuracy,
-                "hp": beatmap.drain,
-                "star_rating": beatmap.difficulty_rating,
-                "total_length": beatmap.total_length,
-                "hit_object_count": beatmap.hit_length,
-                "extra_metadata": {
-                    "max_combo": beatmap.max_combo,
-                }
-            }
-
-            stmt = insert(Beatmap)
-            stmt = stmt.values(**bm_values)
-            stmt = stmt.on_conflict_do_update(
-                index_elements=[Beatmap.id],
-                set_=bm_values
-            )
+        for beatmapset in synced:
+            for bm in beatmapset.beatmaps or []:
+                if bm.id not in existing_tags:
+                    continue
+
+                current_tags = {str(tag["tag_id"]): int(tag["count"]) for tag in (bm.top_tag_ids or [])}
+                if current_tags != existing_tags[bm.id]:
+                    logger.debug("user tags changed", extra={"beatmapset_id": beatmapset.id, "beatmap_id": bm.id})
+                    outdated.append(beatmapset)
+                    break
+
+        return outdated
+
+    async def store(self, beatmapsets: list):
+        """Upsert ranked `beatmapsets`, their beatmaps and vectors, one transaction for all of them."""
+        synced_at = int(datetime.utcnow().timestamp())
+        # a page listing the same set twice would make the upsert touch a row twice
+        beatmapsets = list({beatmapset.id: beatmapset for beatmapset in beatmapsets}.values())
+        beatmap_rows = []
+        points = []
+        set_points = []
+
+        for beatmapset in beatmapsets:
+            set_beatmap_points = []
+
+            for beatmap in beatmapset.beatmaps or []:
+                with timed("beatmap_worker", "embed"):
+                    embedding = self.compute_beatmap_embedding(beatmapset, beatmap)
+
+                beatmap_rows.append(beatmap_values(beatmapset, beatmap))
+                points.append(PointStruct(id=beatmap.id, vector=embedding, payload=beatmap_payload(beatmapset, beatmap)))
+                set_beatmap_points.append(points[-1])
+
+            if set_beatmap_points:
+                # set level point used by /beatmapsets/{id}/similar
+                set_points.append(beatmapset_point(beatmapset.id, [p.vector for p in set_beatmap_points], [p.payload for p in set_beatmap_points]))
 
-            print(f"Upserted beatmap {beatmap.id} - {beatmapset.artist} - {beatmapset.title} [{beatmap.version}]")
-
-            await session.execute(stmt)
-
-            payload = {
-                "beatmapset_id": beatmapset.id,
-                "beatmap_id": beatmap.id,
-                "title": beatmapset.title,
-                "artist": beatmapset.artist,
-                "genre": beatmapset.genre["id"] if beatmapset.genre else 0,
-                "language": beatmapset.language["id"] if beatmapset.language else 0,
-                "creator": beatmapset.creator,
-                "mode": beatmap.mode.value,
-                "bpm": beatmap.bpm,
-                "cs": beatmap.cs,
-                "ar": beatmap.ar,
-                "od": beatmap.accuracy,
-                "hp": beatmap.drain,
-                "tags": beatmapset.tags.split(),
-                "user_tags": top_tags_payload,  # just ids + counts
-                "play_count": beatmapset.play_count,
-                "favourite_count": beatmapset.favourite_count,
-                "status": beatmapset.status.value,
-                "star_rating": beatmap.difficulty_rating,
-                "length": beatmap.total_length,
-                "max_combo": beatmap.max_combo,
-                "embed_version": 1,
-            }
-            
-            points.append(PointStruct(id=beatmap.id, vector=embedding, payload=payload))
-            print(f"Prepared embedding point for beatmap {beatmap.id} - {beatmapset.artist} - {beatmapset.title} [{beatmap.version}]")
-
-        await session.commit()
-        await session.close()
-        await self.state.qdrant.upsert(
-            collection_name="beatmap_embeddings",
-            points=points
-        )
-
-        print(f"Completed processing beatmapset {beatmapset.id} - {beatmapset.artist} - {beatmapset.title}")
-
-        pass
+        map_ids = {beatmap.id: beatmapset.id for beatmapset in beatmapsets for beatmap in beatmapset.beatmaps or []}
+        backfilled_players = {}
+
+        async with self.state.get_session() as session:
+            with timed("beatmap_worker", "upsert"):
+                await session.execute(upsert(BeatmapSet, [beatmapset_values(beatmapset, synced_at) for beatmapset in beatmapsets]))
+                for start in range(0, len(beatmap_rows), UPSERT_BATCH):
+                    await session.execute(upsert(Beatmap, beatmap_rows[start:start + UPSERT_BATCH]))
+
+            # scores on these maps stored before the set was known can be resolved now
+            with timed("beatmap_worker", "backfill"):
+                for beatmapset in beatmapsets:
+                    set_map_ids = [beatmap.id for beatmap in beatmapset.beatmaps or []]
+                    for player_id in await backfill_activity_mapsets(session, beatmapset.id, set_map_ids):
+                        backfilled_players.setdefault(player_id, []).append(beatmapset.id)
+
+            with timed("beatmap_worker", "commit"):
+                await session.commit()
+
+        await cache_mapset_ids(self.state.redis, map_ids)
+        for player_id, mapset_ids in backfilled_players.items():
+            await mark_seen(self.state.redis, player_id, mapset_ids)
+        if backfilled_players:
+            logger.info("backfilled activity mapsets", extra={"beatmapsets": len(beatmapsets), "players": len(backfilled_players)})
+
+        with timed("beatmap_worker", "vectors"):
+            if points:
+                await self.state.qdrant.upsert(collection_name=BEATMAP_COLLECTION, points=points)
+                await self.state.qdrant.upsert(collection_name=BEATMAPSET_COLLECTION, points=set_points)
+
+        for beatmapset in beatmapsets:
+            logger.info("processed beatmapset", extra={"beatmapset_id": beatmapset.id, "beatmaps": len(beatmapset.beatmaps or [])})
 
     def compute_beatmap_embedding(self, beatmapset, beatmap):
         # numeric features (normalize)
@@ -211,12 +197,81 @@ class BeatmapWorker(Worker):
             TAG_WEIGHT * tag_vec,
         ])
 
-        # pad to 512 dims
-        if emb.shape[0] < 512:
-            emb = numpy.pad(emb, (0, 512 - emb.shape[0]), mode='constant')
+        # pad to the collection's vector size
+        if emb.shape[0] < BEATMAP_VECTOR_SIZE:
+            emb = numpy.pad(emb, (0, BEATMAP_VECTOR_SIZE - emb.shape[0]), mode='constant')
 
         return emb
     
+def beatmapset_values(beatmapset, synced_at: int) -> dict:
+    return {
+        "id": beatmapset.id,
+        "artist": beatmapset.artist,
+        "title": beatmapset.title,
+        "creator": beatmapset.creator,
+        "source": beatmapset.source,
+        "genre": beatmapset.genre["id"] if beatmapset.genre else 0,
+        "language": beatmapset.language["id"] if beatmapset.language else 0,
+        "tags": (beatmapset.tags or "").split(),
+        "status": beatmapset.status.value,
+        "play_count": beatmapset.play_count,
+        "favourite_count": beatmapset.favourite_count,
+        "last_synced_at": synced_at,
+    }
+
+def beatmap_values(beatmapset, beatmap) -> dict:
+    return {
+        "id": beatmap.id,
+        "beatmapset_id": beatmapset.id,
+        "difficulty_name": beatmap.version,
+        "mode": beatmap.mode.value,
+        "bpm": beatmap.bpm,
+        "cs": beatmap.cs,
+        "ar": beatmap.ar,
+        "od": beatmap.accuracy,
+        "hp": beatmap.drain,
+        "star_rating": beatmap.difficulty_rating,
+        "total_length": beatmap.total_length,
+        "hit_object_count": beatmap.hit_length,
+        "extra_metadata": {
+            "max_combo": beatmap.max_combo,
+        }
+    }
+
+def beatmap_payload(beatmapset, beatmap) -> dict:
+    top_tags_payload = {str(tag["tag_id"]): tag["count"] for tag in beatmap.top_tag_ids or []} # type: ignore // the ossapi types are wrong
+    return {
+        "beatmapset_id": beatmapset.id,
+        "beatmap_id": beatmap.id,
+        "title": beatmapset.title,
+        "artist": beatmapset.artist,
+        "genre": beatmapset.genre["id"] if beatmapset.genre else 0,
+        "language": beatmapset.language["id"] if beatmapset.language else 0,
+        "creator": beatmapset.creator,
+        "mode": beatmap.mode.value,
+        "bpm": beatmap.bpm,
+        "cs": beatmap.cs,
+        "ar": beatmap.ar,
+        "od": beatmap.accuracy,
+        "hp": beatmap.drain,
+        "tags": (beatmapset.tags or "").split(),
+        "user_tags": top_tags_payload,  # just ids + counts
+        "play_count": beatmapset.play_count,
+        "favourite_count": beatmapset.favourite_count,
+        "status": beatmapset.status.value,
+        "star_rating": beatmap.difficulty_rating,
+        "length": beatmap.total_length,
+        "max_combo": beatmap.max_combo,
+        "embed_version": 1,
+    }
+
+def upsert(table, rows: list[dict]):
+    stmt = insert(table).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.id],
+        set_={column: stmt.excluded[column] for column in rows[0]}
+    )
+
 def hash_tag(tag_id, dim=256):
     # stable integer hash
     h = int(hashlib.md5(str(tag_id).encode()).hexdigest(), 16)
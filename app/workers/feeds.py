@@ -0,0 +1,104 @@
+import asyncio
+import app.settings as settings
+from . import Worker, WorkerState
+from datetime import datetime, timedelta, timezone
+from fastapi import HTTPException
+from sqlalchemy import select
+from app.database.players import Player
+from app.util.feeds import FEED_QUEUE, store_materialized_feed
+from app.util.queues import clear, enqueue
+from app.util.search import get_search_profile
+from app.util.seen import get_seen
+from app.util.weighting import FeedProfile
+from app.logger import worker_logger
+
+logger = worker_logger.getChild("feeds")
+
+class FeedWorker(Worker):
+    """Precomputes the discovery feed of one player for their main mode."""
+    def __init__(self, state: WorkerState):
+        super().__init__(FEED_QUEUE, state)
+
+    async def process(self, item_id):
+        # imported here, the api package pulls in every router
+        from app.api.discovery import rank_discovery_feed
+
+        async with self.state.get_session() as session:
+            player = await session.get(Player, int(item_id))
+
+            if not player or not player.main_mode:
+                return
+
+            try:
+                ranked = await rank_discovery_feed(
+                    session=session,
+                    qdrant=self.state.qdrant,
+                    target_player_id=player.id,
+                    mode=player.main_mode,
+                    search=get_search_profile("feed_materialized"),
+                    seen=await get_seen(self.state.redis, session, player.id),
+                    profile=FeedProfile(operation="feed_materialized"),
+                )
+            except HTTPException as e:
+                if e.status_code != 404:
+                    raise
+
+                # no activity yet, the api will rank it live once there is some
+                logger.info("skipping feed", extra={"player_id": player.id, "reason": e.detail})
+                return
+
+        await store_materialized_feed(self.state.redis, player.id, player.main_mode, ranked)
+        logger.info("materialized feed", extra={"player_id": player.id, "mapsets": len(ranked)})
+
+class FeedScheduler:
+    """
+    Once a day at FEED_MATERIALIZE_HOUR (utc), queues every player synced in the
+    last FEED_ACTIVE_DAYS for the feed workers. Runs next to the workers, any
+    number of processes can run one; only the first to claim the day enqueues.
+    """
+    def __init__(self, state: WorkerState):
+        self.state = state
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(seconds_until_hour(settings.FEED_MATERIALIZE_HOUR))
+            try:
+                await self.schedule()
+            except Exception:
+                # feeds stay a day older, `python main.py materialize` catches up
+                logger.exception("failed to schedule feeds")
+
+    async def schedule(self, force: bool = False) -> int:
+        """Queue active players, returns how many. `force` skips the once-a-day claim."""
+        redis = self.state.redis
+        now = datetime.now(timezone.utc)
+
+        # a forced run doesn't claim the day, the nightly run still happens
+        if not force:
+            claimed = await redis.set(f"pandemonium:feed_schedule:{now:%Y-%m-%d}", 1, nx=True, ex=60 * 60 * 48)
+            if not claimed:
+                return 0
+
+        cutoff = int((now - timedelta(days=settings.FEED_ACTIVE_DAYS)).timestamp())
+
+        async with self.state.get_session() as session:
+            result = await session.execute(
+                select(Player.id).where(Player.last_synced_at >= cutoff, Player.main_mode.is_not(None))
+            )
+            player_ids = result.scalars().all()
+
+        # whatever is left from the previous run is superseded by this one
+        await clear(redis, FEED_QUEUE)
+        await enqueue(redis, FEED_QUEUE, player_ids)
+
+        logger.info("queued feeds for materialization", extra={"players": len(player_ids)})
+        return len(player_ids)
+
+def seconds_until_hour(hour: int) -> float:
+    now = datetime.now(timezone.utc)
+    target = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+
+    if target <= now:
+        target += timedelta(days=1)
+
+    return (target - now).total_seconds()
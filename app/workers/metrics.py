@@ -0,0 +1,29 @@
+import asyncio
+import app.settings as settings
+from . import WorkerState
+from prometheus_client import start_http_server
+from app.util.metrics import refresh_queue_depths
+from app.logger import worker_logger
+
+logger = worker_logger.getChild("metrics")
+
+class MetricsExporter:
+    """
+    Serves the metrics of a worker-only process on WORKER_METRICS_PORT and
+    keeps its queue depth gauges fresh. Processes that also run the api
+    don't need one, its /metrics covers the workers.
+    """
+    def __init__(self, state: WorkerState):
+        self.state = state
+
+    async def run(self):
+        start_http_server(settings.WORKER_METRICS_PORT)
+        logger.info("serving worker metrics", extra={"port": settings.WORKER_METRICS_PORT})
+
+        while True:
+            try:
+                await refresh_queue_depths(self.state.redis)
+            except Exception:
+                # a restart would try to bind the port again, keep serving stale gauges
+                logger.exception("failed to refresh queue depths")
+            await asyncio.sleep(settings.METRICS_REFRESH_INTERVAL)
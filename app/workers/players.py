@@ -1,16 +1,24 @@
 import ossapi
 from . import Worker, WorkerState
-from datetime import datetime
-from app.database.players import Player, PlayerActivity, PlayerActivityType
+from datetime import datetime, timezone
+from app.database.players import Player, PlayerActivityType, upsert_activities
+from app.util.auth import forget_principal
+from app.util.mapsets import cache_mapset_ids, resolve_mapset_ids
+from app.util.metrics import timed
+from app.util.queues import BEATMAP_QUEUE, PLAYER_QUEUE, enqueue
+from app.util.seen import mark_seen
+from app.logger import worker_logger
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from qdrant_client.http.models import PointStruct
 from ossapi import Mod
-from typing import Any
+from typing import Any, Optional
+
+logger = worker_logger.getChild("players")
 
 class PlayerWorker(Worker):
     def __init__(self, state: WorkerState):
-        super().__init__("pandemonium:player_queue", state)
+        super().__init__(PLAYER_QUEUE, state)
 
     async def process(self, item_id):
         """
@@ -20,110 +28,131 @@ class PlayerWorker(Worker):
         - updates the PlayerActivity table (scores, favorites, pinned)
         """
         osu = self.state.osu
-        session = await self.state.get_session()
-        pool = await self.state.get_redis_pool()
+        redis = self.state.redis
         activities = []
 
-        player = await osu.user(item_id, mode="osu")
-        print(f"Processing player: {player.username} (ID: {player.id})")
+        # closed on failures too, the worker loop carries on with the next player
+        async with self.state.get_session() as session:
+            with timed("player_worker", "fetch_user"):
+                player = await osu.user(item_id, mode="osu")
+            logger.debug("processing player", extra={"player_id": player.id})
+
+            if player.is_bot:
+                logger.info("skipping bot player", extra={"player_id": player.id})
+                return
+
+            player_values = {
+                "id": player.id,
+                "username": player.username,
+                "country": player.country.code,
+                "main_mode": player.playmode,
+                "pp": player.statistics.pp if hasattr(player, "statistics") else 0.0,
+                "rank": player.statistics.global_rank if hasattr(player, "statistics") else 0,
+                "country_rank": player.statistics.country_rank if hasattr(player, "statistics") else 0,
+                "joined_at": int(player.join_date.timestamp()) if player.join_date else None,
+                "last_synced_at": int(datetime.utcnow().timestamp()),
+            }
 
-        if player.is_bot:
-            print(f"Skipping bot player: {player.username} (ID: {player.id})")
-            return
+            stmt = insert(Player).values(**player_values)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Player.id],
+                set_=player_values
+            )
 
-        player_values = {
-            "id": player.id,
-            "username": player.username,
-            "country": player.country.code,
-            "main_mode": player.playmode,
-            "pp": player.statistics.pp if hasattr(player, "statistics") else 0.0,
-            "rank": player.statistics.global_rank if hasattr(player, "statistics") else 0,
-            "country_rank": player.statistics.country_rank if hasattr(player, "statistics") else 0,
-            "joined_at": int(player.join_date.timestamp()) if player.join_date else None,
-            "last_synced_at": int(datetime.utcnow().timestamp()),
-        }
-
-        stmt = insert(Player).values(**player_values)
-        stmt = stmt.on_conflict_do_update(
-            index_elements=[Player.id],
-            set_=player_values
-        )
-
-        await session.execute(stmt)
+            with timed("player_worker", "upsert_player"):
+                await session.execute(stmt)
+                await session.commit()
+
+            # the main mode may have changed, authentication reads it from the principal
+            await forget_principal(redis, player.id)
+
+            activities = []
+
+            def make_activity(type_str, map_id=None, mapset_id=None, value={}):
+                # a favourite's created_at is when it first showed up, upserts keep it
+                now = datetime.utcnow()
+                return {
+                    "player_id": player.id,
+                    "type": type_str,
+                    "map_id": map_id,
+                    "mapset_id": mapset_id,
+                    "value": value,
+                    "created_at": now,
+                    "synced_at": now,
+                }
 
-        activities = []
+            with timed("player_worker", "fetch_favourites"):
+                favourites = await osu.user_beatmaps(player.id, type="favourite")
 
-        def make_activity(type_str, map_id=None, mapset_id=None, value={}):
-            return {
-                "player_id": player.id,
-                "type": type_str,
-                "map_id": map_id,
-                "mapset_id": mapset_id,
-                "value": value,
-                "created_at": datetime.utcnow()
-            }
+            for favourite in favourites:
+                activities.append(make_activity(
+                    PlayerActivityType.FAVOURITE.value,
+                    mapset_id=favourite.id,
+                ))
 
-        for favourite in await osu.user_beatmaps(player.id, type="favourite"):
-            activities.append(make_activity(
-                PlayerActivityType.FAVOURITE.value,
-                mapset_id=favourite.id,
-            ))
 
+            for mode in ["osu"]: # standard only for now -- , "taiko", "fruits", "mania"
+                await self.process_player(player, mode, activities)
 
-        for mode in ["osu"]: # standard only for now -- , "taiko", "fruits", "mania"
-            await self.process_player(player, mode, activities)
-            
-        # batch upsert
-        for act in activities:
-            # enqueue for beatmap processing if mapset_id is present
-            if act["mapset_id"]:
-                qname = "pandemonium:beatmap_queue"
-                member = str(act["mapset_id"]) if act["mapset_id"] is not None else None
-                if member is not None:
-                    found = False
-                    try:
-                        pos = await pool.lpos(qname, member)
-                        if pos is not None:
-                            found = True
-                    except Exception:
-                        # LPOS may not be supported by older redis clients/servers; fallback to LRANGE
-                        existing = await pool.lrange(qname, 0, -1)
-                        if member in existing:
-                            found = True
-
-                    if not found:
-                        print(f"Enqueuing beatmapset {member} for processing due to player activity.")
-                        await pool.rpush(qname, member)
-                    else:
-                        print(f"Beatmapset {member} already enqueued, skipping")
-
-            stmt = insert(PlayerActivity).values(**act)
-            stmt = stmt.on_conflict_do_update(
-                index_elements=[PlayerActivity.player_id, PlayerActivity.type, PlayerActivity.map_id, PlayerActivity.mapset_id],
-                set_={"value": act["value"], "created_at": act["created_at"]}
-            )
-            await session.execute(stmt)
+            with timed("player_worker", "resolve"):
+                await self.resolve_mapsets(activities)
 
-        await session.commit()
-        await session.close()
-        await pool.close() # close
-        
-        pass
+            with timed("player_worker", "enqueue"):
+                await self.enqueue_mapsets(activities)
+
+            with timed("player_worker", "upsert_activity"):
+                await upsert_activities(session, activities)
+                await session.commit()
+
+        # keep the seen bitmap in step, feeds and similar maps skip these sets
+        with timed("player_worker", "seen"):
+            await mark_seen(redis, player.id, [act["mapset_id"] for act in activities if act["mapset_id"]])
+
+        logger.info("processed player", extra={"player_id": player.id, "activities": len(activities)})
+
+    async def enqueue_mapsets(self, activities: list):
+        """Queue the sets of `activities` for `BeatmapWorker`, unless they're already queued."""
+        await enqueue(self.state.redis, BEATMAP_QUEUE, dict.fromkeys(act["mapset_id"] for act in activities if act["mapset_id"]))
+
+    async def resolve_mapsets(self, activities: list):
+        """Fill in mapset_id for scores the api returned without their beatmap.
+
+        Whatever is still unknown stays NULL until BeatmapWorker stores the set.
+        """
+        redis = self.state.redis
+
+        known = {act["map_id"]: act["mapset_id"] for act in activities if act["map_id"] and act["mapset_id"]}
+        await cache_mapset_ids(redis, known)
+
+        unresolved = [act for act in activities if act["map_id"] and not act["mapset_id"]]
+        if not unresolved:
+            return
+
+        async with self.state.get_session() as session:
+            resolved = await resolve_mapset_ids(redis, session, [act["map_id"] for act in unresolved])
+
+        for act in unresolved:
+            act["mapset_id"] = resolved.get(act["map_id"])
 
     async def process_player(self, player: ossapi.User, mode: str, activities: list):
         osu = self.state.osu
         
-        def make_activity(type_str, map_id=None, mapset_id=None, value={}):
+        def make_activity(type_str, map_id=None, mapset_id=None, value={}, played_at=None):
             return {
                 "player_id": player.id,
                 "type": type_str,
                 "map_id": map_id,
                 "mapset_id": mapset_id,
                 "value": value,
-                "created_at": datetime.utcnow()
+                "created_at": played_at or datetime.utcnow(),
+                "synced_at": datetime.utcnow(),
             }
 
-        for top_score in await osu.user_scores(player.id, type="best", limit=200, mode=mode):
+        with timed("player_worker", "fetch_scores"):
+            top_scores = await osu.user_scores(player.id, type="best", limit=200, mode=mode)
+            recent_scores = await osu.user_scores(player.id, type="recent", limit=100, mode=mode)
+
+        for top_score in top_scores:
             activities.append(make_activity(
                 PlayerActivityType.SCORE.value,
                 map_id=top_score.beatmap_id,
@@ -134,10 +163,11 @@ class PlayerWorker(Worker):
                     "pp": top_score.pp,
                     "rank": top_score.rank.value,
                     "mods": self._serialize_mods(top_score.mods),
-                }
+                },
+                played_at=self._played_at(top_score),
             ))
 
-        for recent_score in await osu.user_scores(player.id, type="recent", limit=100, mode=mode):
+        for recent_score in recent_scores:
             activities.append(make_activity(
                 PlayerActivityType.SCORE.value,
                 map_id=recent_score.beatmap_id,
@@ -148,9 +178,17 @@ class PlayerWorker(Worker):
                     "pp": recent_score.pp,
                     "rank": recent_score.rank.value,
                     "mods": self._serialize_mods(recent_score.mods),
-                }
+                },
+                played_at=self._played_at(recent_score),
             ))
 
+    def _played_at(self, score) -> Optional[datetime]:
+        """When `score` was set, as naive utc like the rest of player_activity."""
+        ended_at = getattr(score, "ended_at", None)
+        if ended_at is None:
+            return None
+        return ended_at.astimezone(timezone.utc).replace(tzinfo=None)
+
     def _serialize_mods(self, mods: Any):
         if not mods:
             return []
@@ -0,0 +1,5 @@
+"""Measurement tooling: benchmarks, evaluations and local stand-ins.
+
+Nothing in here is imported by the application. Run modules with
+`python -m bench.<module>`.
+"""
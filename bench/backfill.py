@@ -0,0 +1,176 @@
+"""Catalogue ingest throughput, per set through the queue vs the search backfill.
+
+Uses the same local stand-ins as `bench.e2e` (see there), and runs these
+passes over a synthetic catalogue, each on an empty database:
+
+1. `BeatmapWorker` drains a queue of every set, one beatmapset call per set
+2. `CatalogueBackfill` walks the listing, one search call per page. The
+   `--compact-ratio` share of sets the listing returns without genre,
+   language and user tags get queued, draining that queue is part of the
+   backfill's time and api calls
+3. the backfill stops after half the pages and a second run resumes it,
+   which has to end up with every set stored and no page fetched twice
+4. a run after the backfill caught up re-reads only the last page, and
+   one after more sets got ranked picks those up
+
+Both report sets/s and osu! api calls. `--osu-latency` puts the api's round
+trip back in, the backfill's advantage mostly comes from making fewer calls:
+
+    python -m bench.backfill --dsn postgresql+asyncpg://postgres@localhost/pandemonium_bench --osu-latency 0.2
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import app.settings as settings
+
+from datetime import timedelta
+from sqlalchemy import func, select
+from app.database.beatmaps import BeatmapSet
+from app.logger import setup_logging
+from app.util.queues import enqueue
+from app.workers.backfill import CatalogueBackfill
+from app.workers.beatmaps import BeatmapWorker
+from bench.e2e import LocalState, commit_sha, reset, run_worker_stage
+from bench.synthetic import SEARCH_PAGE_SIZE, FakeOssapi, make_catalogue
+
+
+async def stored_sets(state: LocalState) -> int:
+    async with state.get_session() as session:
+        return await session.scalar(select(func.count()).select_from(BeatmapSet))
+
+
+async def run_backfill(state: LocalState, max_pages: int | None = None, restart: bool = False) -> tuple[dict, float, int]:
+    calls = state.fake_osu.calls
+    started = time.perf_counter()
+    checkpoint = await CatalogueBackfill(state).run(restart=restart, max_pages=max_pages)
+    return checkpoint, time.perf_counter() - started, state.fake_osu.calls - calls
+
+
+def rank_more(catalogue, count: int, seed: int):
+    """Add `count` sets ranked after everything in `catalogue`."""
+    more = make_catalogue(count, seed=seed + 1, first_id=max(catalogue.mapsets) + 1)
+    ranked_date = max(mapset.ranked_date for mapset in catalogue.mapsets.values()) + timedelta(days=1)
+
+    for mapset in more.mapsets.values():
+        mapset.ranked_date = ranked_date
+
+    catalogue.mapsets.update(more.mapsets)
+    catalogue.beatmaps.update(more.beatmaps)
+    catalogue.popularity.update(more.popularity)
+
+
+async def run(args) -> dict:
+    catalogue = make_catalogue(args.mapsets, seed=args.seed)
+    osu = FakeOssapi(catalogue, seed=args.seed, latency=args.osu_latency, compact_ratio=args.compact_ratio)
+    results = {}
+
+    async with LocalState(args, osu) as state:
+        await reset(state)
+        await enqueue(state.redis, BeatmapWorker(state).queue_name, list(catalogue.mapsets))
+        queue = await run_worker_stage(state, "beatmaps", args.worker_concurrency)
+        results["queue"] = {
+            "sets": queue["items"],
+            "sets_per_sec": queue["items_per_sec"],
+            "seconds": queue["seconds"],
+            "osu_api_calls": queue["osu_api_calls"],
+            "stored": await stored_sets(state),
+            "concurrency": args.worker_concurrency,
+        }
+
+        await reset(state)
+        checkpoint, elapsed, calls = await run_backfill(state)
+        # the sets the listing couldn't give us go through the workers
+        refetch = await run_worker_stage(state, "beatmaps", args.worker_concurrency)
+        results["backfill"] = {
+            "sets": checkpoint["sets"],
+            "sets_per_sec": round(checkpoint["sets"] / (elapsed + refetch["seconds"]), 1),
+            "seconds": round(elapsed + refetch["seconds"], 2),
+            "listing_seconds": round(elapsed, 2),
+            "osu_api_calls": calls + refetch["osu_api_calls"],
+            "pages": checkpoint["pages"],
+            "queued": checkpoint["queued"],
+            "stored": await stored_sets(state),
+        }
+
+        await reset(state)
+        pages = -(-len(catalogue.mapsets) // SEARCH_PAGE_SIZE)
+        paused, _, first_calls = await run_backfill(state, max_pages=max(pages // 2, 1))
+        resumed, _, second_calls = await run_backfill(state)
+        await run_worker_stage(state, "beatmaps", args.worker_concurrency)
+        results["resume"] = {
+            "paused_after_pages": paused["pages"],
+            "paused_done": paused["done"],
+            "done": resumed["done"],
+            "pages": resumed["pages"],
+            "listing_calls": first_calls + second_calls,
+            "stored": await stored_sets(state),
+        }
+
+        # caught up: only the last page is read again, then newly ranked sets
+        _, _, idle_calls = await run_backfill(state)
+        rank_more(catalogue, args.ranked_later, args.seed)
+        before = await stored_sets(state)
+        later, _, _ = await run_backfill(state)
+        await run_worker_stage(state, "beatmaps", args.worker_concurrency)
+        results["catch_up"] = {
+            "idle_listing_calls": idle_calls,
+            "ranked_later": args.ranked_later,
+            "stored": await stored_sets(state) - before,
+            "done": later["done"],
+        }
+
+    for name in ("queue", "backfill"):
+        result = results[name]
+        print(f"  {name:<10} {result['sets']:>6} sets  {result['sets_per_sec']:>8.1f} sets/s  "
+              f"{result['osu_api_calls']:>6} api calls  {result['stored']} stored"
+              + (f"  ({result['queued']} queued for a full fetch)" if "queued" in result else ""))
+
+    resume, catch_up = results["resume"], results["catch_up"]
+    resume_ok = resume["done"] and not resume["paused_done"] and resume["stored"] == results["backfill"]["stored"] \
+        and resume["listing_calls"] == results["backfill"]["pages"]
+    catch_up_ok = catch_up["idle_listing_calls"] == 1 and catch_up["stored"] == catch_up["ranked_later"] and catch_up["done"]
+    print(f"  resume     paused after {resume['paused_after_pages']} pages, {resume['pages']} pages in total, "
+          f"{resume['stored']} stored, {resume['listing_calls']} listing calls: {'ok' if resume_ok else 'MISMATCH'}")
+    print(f"  catch up   {catch_up['idle_listing_calls']} listing calls when idle, {catch_up['stored']} of "
+          f"{catch_up['ranked_later']} newly ranked sets stored: {'ok' if catch_up_ok else 'MISMATCH'}")
+
+    return {
+        "commit": commit_sha(),
+        "params": {key: value for key, value in vars(args).items() if key not in ("dsn", "redis_url", "output", "verbose")},
+        "resume_ok": resume_ok,
+        "catch_up_ok": catch_up_ok,
+        **results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", required=True, help="asyncpg dsn of a scratch database, its schema is dropped")
+    parser.add_argument("--qdrant-url", help="local qdrant server, in memory if not given")
+    parser.add_argument("--redis-url", help="local redis (the db is flushed), fakeredis if not given")
+    parser.add_argument("--mapsets", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--osu-latency", type=float, default=0.0, help="seconds added to every fake osu! api call")
+    parser.add_argument("--compact-ratio", type=float, default=0.25, help="share of listing entries missing genre, language and user tags")
+    parser.add_argument("--ranked-later", type=int, default=20, help="sets ranked after the backfill caught up")
+    parser.add_argument("--worker-concurrency", type=int, default=4, help="beatmap workers draining the queue")
+    parser.add_argument("--verbose", action="store_true", help="show the application's logs (LOG_LEVEL, LOG_FORMAT)")
+    parser.add_argument("-o", "--output", help="write the results here as json")
+    args = parser.parse_args()
+
+    if args.verbose:
+        setup_logging()
+
+    # the rate limit pause isn't what's being measured
+    settings.BACKFILL_PAGE_INTERVAL = 0
+
+    results = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nwrote {args.output}")
+
+    sys.exit(0 if results["resume_ok"] and results["catch_up_ok"] else 1)
@@ -0,0 +1,334 @@
+"""End to end benchmark of the workers and the api on synthetic data.
+
+Everything runs in one process against local stand-ins: the osu! api is
+`bench.synthetic.FakeOssapi`, qdrant runs in memory unless `--qdrant-url`
+points at a local server, redis is fakeredis unless `--redis-url` is
+given, and postgres is the scratch database behind `--dsn` (its schema is
+dropped and recreated, don't point it at anything you care about).
+
+The run goes through the same steps a deployment does:
+
+1. `BeatmapWorker` ingests the whole catalogue
+2. `PlayerWorker` syncs every player (and queues the sets they played)
+3. `BeatmapWorker` drains that queue, mostly hitting the up to date check
+4. the api endpoints are hit over ASGI, the feed is ranked live
+5. `FeedWorker` materializes every feed
+6. the feed is hit again, now served from the materialized copy
+
+Workers report items/s, endpoints p50/p95/p99 latency. The results are
+written as json so runs on different commits can be compared:
+
+    python -m bench.e2e --dsn postgresql+asyncpg://postgres@localhost/pandemonium_bench -o before.json
+    git checkout some-branch
+    python -m bench.e2e --dsn postgresql+asyncpg://postgres@localhost/pandemonium_bench -o after.json --compare before.json
+
+Note that in memory qdrant searches by brute force, pass `--qdrant-url`
+for search latencies that mean something.
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import time
+import httpx
+import numpy
+
+from datetime import datetime, timezone
+from qdrant_client import AsyncQdrantClient
+from sqlalchemy import text
+from app.api.state import APIState
+from app.database import Base, create_engine, create_sessionmaker
+from app.database.embeddings import COLLECTIONS, bootstrap_collection
+from app.logger import setup_logging
+from app.util import create_http_client, generate_session_token
+from app.util.queues import dequeue, enqueue, finish
+from app.workers.beatmaps import BeatmapWorker
+from app.workers.feeds import FeedWorker
+from app.workers.players import PlayerWorker
+from bench.synthetic import FakeOssapi, make_catalogue
+
+QUEUE_STAGES = {
+    "beatmaps": BeatmapWorker,
+    "players": PlayerWorker,
+    "beatmaps_resync": BeatmapWorker,
+    "feeds": FeedWorker,
+}
+
+
+class LocalState(APIState):
+    """An `APIState` on the local stand-ins. The workers use it too, they only need its pools."""
+
+    def __init__(self, args, osu: FakeOssapi) -> None:
+        super().__init__()
+        self.args = args
+        self.fake_osu = osu
+
+    async def init(self):
+        if self._initialized:
+            return
+
+        self.engine = create_engine(
+            pool_size=self.limits.pg_pool_size,
+            max_overflow=self.limits.pg_max_overflow,
+            dsn=self.args.dsn,
+        )
+        self.session_factory = create_sessionmaker(self.engine)
+
+        if self.args.redis_url:
+            from redis import asyncio as aioredis
+            self.redis = aioredis.Redis.from_url(self.args.redis_url, decode_responses=True)
+        else:
+            try:
+                import fakeredis
+            except ImportError:
+                sys.exit("fakeredis is not installed, install it or pass --redis-url")
+            self.redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+
+        if self.args.qdrant_url:
+            self.qdrant = AsyncQdrantClient(url=self.args.qdrant_url)
+        else:
+            self.qdrant = AsyncQdrantClient(location=":memory:")
+
+        self.osu = self.fake_osu
+        self.http = create_http_client()
+        self._initialized = True
+
+
+async def reset(state: LocalState):
+    """Start from an empty database, redis and set of collections."""
+    async with state.engine.begin() as conn:
+        await conn.execute(text("DROP SCHEMA public CASCADE"))
+        await conn.execute(text("CREATE SCHEMA public"))
+        # the player_activity partitions are created by an after_create listener
+        await conn.run_sync(Base.metadata.create_all)
+
+    await state.redis.flushdb()
+
+    for collection_name in COLLECTIONS:
+        if await state.qdrant.collection_exists(collection_name):
+            await state.qdrant.delete_collection(collection_name)
+        await bootstrap_collection(state.qdrant, collection_name)
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict:
+    p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99]) if latencies else (0, 0, 0)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0,
+        "p50_ms": round(p50 * 1000, 2),
+        "p95_ms": round(p95 * 1000, 2),
+        "p99_ms": round(p99 * 1000, 2),
+    }
+
+
+async def run_worker_stage(state: LocalState, name: str, concurrency: int) -> dict:
+    """Drain the stage's queue with `concurrency` workers sharing the state, like `main.py` runs them."""
+    worker = QUEUE_STAGES[name](state)
+    latencies = []
+    errors = 0
+
+    async def drain():
+        nonlocal errors
+        # the same queue bookkeeping as `Worker.run`, minus its idle polling
+        while (popped := await dequeue(state.redis, worker.queue_name, worker.worker_id)) is not None:
+            item_id, _ = popped
+            started = time.perf_counter()
+            error = None
+            try:
+                await worker.process(item_id)
+            except Exception as e:
+                errors += 1
+                error = e
+                print(f"{name}: {item_id} failed: {e!r}", file=sys.stderr)
+            latencies.append(time.perf_counter() - started)
+            await finish(state.redis, worker.queue_name, worker.worker_id, item_id, latencies[-1], error)
+
+    calls = state.fake_osu.calls
+    started = time.perf_counter()
+    await asyncio.gather(*(drain() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    result = summarize(latencies, errors, elapsed)
+    return {
+        "items": result.pop("requests"),
+        "items_per_sec": result.pop("rps"),
+        "seconds": round(elapsed, 2),
+        "osu_api_calls": state.fake_osu.calls - calls,
+        "concurrency": concurrency,
+        **result,
+    }
+
+
+async def run_endpoint(client: httpx.AsyncClient, make_request, requests: int, concurrency: int, warmup: int) -> dict:
+    """Send `requests` requests built by `make_request(i) -> (method, url, kwargs)`."""
+    for i in range(warmup):
+        method, url, kwargs = make_request(i)
+        await client.request(method, url, **kwargs)
+
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        nonlocal errors
+        method, url, kwargs = make_request(i)
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+async def run_endpoints(state: LocalState, args, catalogue, player_ids: list[int], names: list[str]) -> dict:
+    # imported here, the api package builds its app on import
+    import app.api
+
+    application = app.api.init()
+    application.state.api = state  # ASGITransport doesn't run the lifespan
+
+    tokens = {
+        player_id: generate_session_token(player_id)
+        for player_id in player_ids
+    }
+
+    rng = random.Random(args.seed)
+    beatmap_ids = list(catalogue.beatmaps)
+    mapset_ids = list(catalogue.mapsets)
+
+    def auth(i):
+        return {"Authorization": f"Bearer {tokens[player_ids[i % len(player_ids)]]}"}
+
+    builders = {
+        "feed_discovery": lambda i: ("GET", "/feed/discovery", {"headers": auth(i)}),
+        "beatmap_similar": lambda i: ("GET", f"/beatmaps/{rng.choice(beatmap_ids)}/similar", {"headers": auth(i)}),
+        "beatmapset_similar": lambda i: ("GET", f"/beatmapsets/{rng.choice(mapset_ids)}/similar", {"headers": auth(i)}),
+        "beatmap_similar_batch": lambda i: ("POST", "/beatmaps/similar:batch", {
+            "headers": auth(i),
+            "json": {"ids": rng.sample(beatmap_ids, min(args.batch_size, len(beatmap_ids)))},
+        }),
+    }
+
+    results = {}
+    transport = httpx.ASGITransport(app=application)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for name in names:
+            endpoint = name.removesuffix("_materialized")
+            results[name] = await run_endpoint(client, builders[endpoint], args.requests, args.concurrency, args.warmup)
+            print(f"  {name:<28} p50 {results[name]['p50_ms']:>8.2f}ms  p95 {results[name]['p95_ms']:>8.2f}ms  "
+                  f"p99 {results[name]['p99_ms']:>8.2f}ms  {results[name]['rps']:>7.1f} req/s  {results[name]['errors']} errors")
+
+    return results
+
+
+def commit_sha() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    catalogue = make_catalogue(args.mapsets, seed=args.seed)
+    osu = FakeOssapi(catalogue, seed=args.seed, latency=args.osu_latency)
+    player_ids = list(range(1, args.players + 1))
+    workers = {}
+    endpoints = {}
+
+    async with LocalState(args, osu) as state:
+        await reset(state)
+
+        async def stage(name, queue_items):
+            if queue_items is not None:
+                worker = QUEUE_STAGES[name](state)
+                await enqueue(state.redis, worker.queue_name, queue_items)
+            workers[name] = await run_worker_stage(state, name, args.worker_concurrency)
+            print(f"  {name:<28} {workers[name]['items']:>6} items  {workers[name]['items_per_sec']:>8.1f} items/s  "
+                  f"p95 {workers[name]['p95_ms']:>8.2f}ms  {workers[name]['errors']} errors")
+
+        print("workers")
+        await stage("beatmaps", list(catalogue.mapsets))
+        await stage("players", player_ids)
+        # PlayerWorker queued every set its players touched, already stored by now
+        await stage("beatmaps_resync", None)
+
+        print("endpoints (feed ranked live)")
+        endpoints.update(await run_endpoints(state, args, catalogue, player_ids, [
+            "feed_discovery", "beatmap_similar", "beatmapset_similar", "beatmap_similar_batch",
+        ]))
+
+        print("workers")
+        await stage("feeds", player_ids)
+
+        print("endpoints (feed materialized)")
+        endpoints.update(await run_endpoints(state, args, catalogue, player_ids, ["feed_discovery_materialized"]))
+
+    return {
+        "commit": commit_sha(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "params": {
+            key: value for key, value in vars(args).items()
+            if key not in ("dsn", "redis_url", "output", "compare", "verbose")
+        },
+        "workers": workers,
+        "endpoints": endpoints,
+    }
+
+
+def compare(old: dict, new: dict):
+    """Print how every metric moved between two result files."""
+    print(f"\ncompared to {(old.get('commit') or 'unknown')[:10]} ({old.get('timestamp')})")
+
+    for section, metrics in (("workers", ["items_per_sec", "p95_ms"]), ("endpoints", ["p50_ms", "p95_ms", "p99_ms", "rps"])):
+        for name, result in new[section].items():
+            previous = old.get(section, {}).get(name)
+            if previous is None:
+                continue
+
+            changes = []
+            for metric in metrics:
+                before, after = previous.get(metric), result.get(metric)
+                if before:
+                    changes.append(f"{metric} {before} -> {after} ({(after - before) / before * 100:+.1f}%)")
+            print(f"  {name:<28} {', '.join(changes)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", required=True, help="asyncpg dsn of a scratch database, its schema is dropped")
+    parser.add_argument("--qdrant-url", help="local qdrant server, in memory if not given")
+    parser.add_argument("--redis-url", help="local redis (the db is flushed), fakeredis if not given")
+    parser.add_argument("--players", type=int, default=100)
+    parser.add_argument("--mapsets", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--osu-latency", type=float, default=0.0, help="seconds added to every fake osu! api call")
+    parser.add_argument("--worker-concurrency", type=int, default=4, help="workers per stage, sharing one state")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight per endpoint")
+    parser.add_argument("--warmup", type=int, default=10, help="untimed requests per endpoint")
+    parser.add_argument("--batch-size", type=int, default=20, help="beatmap ids per similar:batch request")
+    parser.add_argument("--verbose", action="store_true", help="show the application's logs (LOG_LEVEL, LOG_FORMAT)")
+    parser.add_argument("-o", "--output", help="write the results here as json")
+    parser.add_argument("--compare", help="results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    if args.verbose:
+        setup_logging()
+
+    results = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nwrote {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
@@ -0,0 +1,200 @@
+"""EXPLAIN ANALYZE of the hot query shapes, before and after the covering index migration.
+
+Migrates a scratch database to the revision before `bd9121e9e840`, seeds it,
+explains every query, then upgrades to head and explains them again. The
+queries are built by the same code the api and workers use where it is
+reusable, and mirror it where it is inline.
+
+Everything in the target database is dropped first, never point this at
+real data:
+
+    python -m bench.explain --dsn postgresql+psycopg2://postgres@localhost/pandemonium_bench --players 5000
+"""
+import argparse
+import time
+import app.settings as settings
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import Connection, cast, create_engine, func, literal_column, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import JSONB
+from app.database.beatmaps import Beatmap, BeatmapSet
+from app.database.groups import Group, user_groups
+from app.database.players import Player, PlayerActivity
+from app.util.weighting import get_feed_weights, mapset_weights_query
+
+BEFORE_REVISION = "d2c3f219bc90"
+
+
+def alembic_config(dsn: str) -> Config:
+    config = Config()
+    config.set_main_option("script_location", "alembic")
+    config.set_main_option("sqlalchemy.url", dsn)
+    return config
+
+
+def seed(conn: Connection, players: int, activities: int, mapsets: int, difficulties: int):
+    """Synthetic catalogue and activity, written with generate_series so it works on either schema."""
+    params = {"players": players, "activities": activities, "mapsets": mapsets, "difficulties": difficulties}
+
+    conn.execute(text("""
+        INSERT INTO beatmapsets (id, artist, title, creator, source, genre, language, tags, status,
+                                 play_count, favourite_count, last_synced_at)
+        SELECT s, 'artist ' || s, 'title ' || s, 'mapper ' || (s % 997), '', s % 10, s % 14,
+               json_build_array('tag' || (s % 50), 'tag' || (s % 311), 'tag' || (s % 1009)),
+               1, s * 10, s % 500, 1700000000
+        FROM generate_series(1, :mapsets) s
+    """), params)
+
+    conn.execute(text("""
+        INSERT INTO beatmaps (id, beatmapset_id, difficulty_name, mode, bpm, cs, ar, od, hp, star_rating,
+                              total_length, hit_object_count, approved_date, extra_metadata)
+        SELECT s * 100 + d, s, 'difficulty ' || d, 'osu', 120 + s % 120, 4, 9, 8, 5, 1 + d + (s % 100) / 100.0,
+               90 + s % 200, 300 + d * 100, 1700000000, json_build_object('max_combo', 500 + d * 200)
+        FROM generate_series(1, :mapsets) s, generate_series(1, :difficulties) d
+    """), params)
+
+    conn.execute(text("""
+        INSERT INTO players (id, username, country, main_mode, pp, rank, country_rank, joined_at,
+                             last_synced_at, settings)
+        SELECT p, 'player ' || p, 'XX', CASE WHEN p % 5 = 0 THEN NULL ELSE 'osu' END::mode,
+               p % 10000, p, p, 1500000000,
+               extract(epoch from now())::int - (p % 90) * 86400, '{}'
+        FROM generate_series(1, :players) p
+    """), params)
+
+    conn.execute(text("""
+        INSERT INTO groups (id, name, description, permissions) VALUES
+            (1, 'ADMIN', '', 255), (2, 'MODERATOR', '', 63), (3, 'CURATOR', '', 5)
+    """))
+    conn.execute(text("""
+        INSERT INTO user_groups (user_id, group_id)
+        SELECT p, 1 + p % 3 FROM generate_series(1, :players) p WHERE p % 4 = 0
+    """), params)
+
+    # scores (map_id, mapset_id sometimes missing like old rows) and favourites (mapset only)
+    conn.execute(text("""
+        INSERT INTO player_activity (id, player_id, type, map_id, mapset_id, value, created_at, synced_at)
+        SELECT row_number() OVER (), p, 'score',
+               m.set_id * 100 + 1 + (p + i) % :difficulties,
+               CASE WHEN i % 10 = 0 THEN NULL ELSE m.set_id END,
+               json_build_object('mode', 0, 'score', 1000000, 'pp', (p * i) % 600,
+                                 'rank', (ARRAY['XH', 'S', 'A', 'B', 'C'])[1 + i % 5],
+                                 'mods', CASE WHEN i % 3 = 0 THEN json_build_array('HD', 'DT') ELSE json_build_array() END),
+               now() - make_interval(days => (p + i) % 400), now() - make_interval(days => i % 7)
+        FROM generate_series(1, :players) p, generate_series(1, :activities) i,
+             LATERAL (SELECT 1 + (p * 7919 + i * 104729) % :mapsets AS set_id) m
+        ON CONFLICT DO NOTHING
+    """), params)
+    conn.execute(text("""
+        INSERT INTO player_activity (id, player_id, type, map_id, mapset_id, value, created_at, synced_at)
+        SELECT (SELECT max(id) FROM player_activity) + row_number() OVER (), p, 'favourite', NULL,
+               1 + (p * 31 + i * 7727) % :mapsets, '{}', now() - make_interval(days => i), now()
+        FROM generate_series(1, :players) p, generate_series(1, greatest(:activities / 10, 1)) i
+        ON CONFLICT DO NOTHING
+    """), params)
+
+
+def query_shapes(player_id: int, mapset_ids: list[int]) -> dict:
+    cutoff = int(time.time()) - settings.FEED_ACTIVE_DAYS * 86400
+
+    return {
+        # app/util/weighting.py, every live feed ranking
+        "feed weights": mapset_weights_query(player_id, get_feed_weights()),
+        # app/util/seen.py, when the seen bitmap is missing
+        "seen fallback": (
+            select(PlayerActivity.mapset_id)
+            .where(PlayerActivity.player_id == player_id, PlayerActivity.mapset_id.is_not(None))
+            .distinct()
+        ),
+        # app/util/auth.py, principal cache misses
+        "principal": (
+            select(Player.main_mode, func.coalesce(func.bit_or(Group.permissions), 0))
+            .outerjoin(user_groups, user_groups.c.user_id == Player.id)
+            .outerjoin(Group, Group.id == user_groups.c.group_id)
+            .where(Player.id == player_id)
+            .group_by(Player.id)
+        ),
+        # app/workers/feeds.py, once a day
+        "feed schedule": select(Player.id).where(Player.last_synced_at >= cutoff, Player.main_mode.is_not(None)),
+        # app/database/beatmaps.py fetch_mapsets, both queries
+        "fetch mapsets": select(BeatmapSet).where(BeatmapSet.id.in_(mapset_ids)),
+        "fetch beatmaps": select(Beatmap).where(Beatmap.beatmapset_id.in_(mapset_ids)),
+        # tag lookups, the cast is a no-op once the column is jsonb
+        "tag lookup": select(BeatmapSet.id).where(cast(BeatmapSet.tags, JSONB).contains(literal_column("'[\"tag7\"]'::jsonb"))),
+    }
+
+
+def explain(conn: Connection, statement) -> tuple[float, str]:
+    """(execution ms, plan text) of one statement."""
+    sql = str(statement.compile(dialect=postgresql.dialect(paramstyle="named"), compile_kwargs={"literal_binds": True}))
+    lines = conn.execute(text(f"EXPLAIN (ANALYZE, BUFFERS) {sql}")).scalars().all()
+
+    # the last line is "Execution Time: 1.234 ms"
+    return float(lines[-1].split()[-2]), "\n".join(lines)
+
+
+def explain_all(conn: Connection, shapes: dict, repeat: int, verbose: bool) -> dict[str, float]:
+    timings = {}
+
+    for name, statement in shapes.items():
+        # best of `repeat`, the first run pays for a cold cache
+        runs = [explain(conn, statement) for _ in range(repeat)]
+        best, plan = min(runs, key=lambda run: run[0])
+        timings[name] = best
+
+        if verbose:
+            print(f"--- {name} ({best:.2f} ms)\n{plan}\n")
+
+    return timings
+
+
+def main(args):
+    config = alembic_config(args.dsn)
+    engine = create_engine(args.dsn)
+
+    print(f"resetting the schema to {BEFORE_REVISION}")
+    with engine.begin() as conn:
+        # the enum types outlive a downgrade to base, start from nothing instead
+        conn.execute(text("DROP SCHEMA public CASCADE; CREATE SCHEMA public"))
+    command.upgrade(config, BEFORE_REVISION)
+
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        seed(conn, args.players, args.activities, args.mapsets, args.difficulties)
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("VACUUM ANALYZE"))
+        activity_rows = conn.execute(text("SELECT count(*) FROM player_activity")).scalar_one()
+    print(f"seeded {activity_rows} activity rows in {time.perf_counter() - started:.1f}s\n")
+
+    shapes = query_shapes(args.player, list(range(1, args.mapsets + 1, max(args.mapsets // 50, 1)))[:50])
+
+    print("===== before =====\n")
+    with engine.connect() as conn:
+        before = explain_all(conn, shapes, args.repeat, not args.quiet)
+
+    command.upgrade(config, "head")
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("VACUUM ANALYZE"))
+
+    print("===== after =====\n")
+    with engine.connect() as conn:
+        after = explain_all(conn, shapes, args.repeat, not args.quiet)
+
+    print(f"{'query':<18}{'before ms':>11}{'after ms':>10}")
+    for name in shapes:
+        print(f"{name:<18}{before[name]:>11.2f}{after[name]:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", required=True, help="sync (psycopg2) dsn of a scratch database")
+    parser.add_argument("--players", type=int, default=5000)
+    parser.add_argument("--activities", type=int, default=100, help="scores per player")
+    parser.add_argument("--mapsets", type=int, default=20000)
+    parser.add_argument("--difficulties", type=int, default=5)
+    parser.add_argument("--player", type=int, default=1234, help="player the per-player queries run for")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--quiet", action="store_true", help="only print the summary")
+    main(parser.parse_args())
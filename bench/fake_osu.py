@@ -0,0 +1,144 @@
+"""Local stand-in for the osu! oauth and /me endpoints.
+
+Serve it and point the api at it:
+
+    uvicorn bench.fake_osu:app --port 9100
+    OSU_BASE_URL=http://127.0.0.1:9100 python main.py
+
+or run it directly to benchmark the login calls against it, once through
+the shared pooled client and once with a new client per call like before:
+
+    python -m bench.fake_osu --logins 200
+"""
+import argparse
+import asyncio
+import secrets
+import threading
+import time
+import zlib
+import httpx
+import uvicorn
+
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import RedirectResponse
+
+app = FastAPI()
+app.state.fail_next = 0  # fail this many /me calls with a 503, to exercise retries
+
+TOKENS: dict[str, int] = {}
+
+def fake_user_id(code: str) -> int:
+    """The player `code` logs in as, so repeated logins collide. crc32 rather
+    than hash(), which is salted per process."""
+    return 1000 + zlib.crc32(code.encode()) % 100_000
+
+@app.get("/oauth/authorize")
+async def authorize(redirect_uri: str, state: str):
+    return RedirectResponse(f"{redirect_uri}?code={secrets.token_urlsafe(16)}&state={state}")
+
+@app.post("/oauth/token")
+async def token(request: Request):
+    body = await request.json()
+    if not body.get("code"):
+        raise HTTPException(400, "missing code")
+
+    access_token = secrets.token_urlsafe(32)
+    TOKENS[access_token] = fake_user_id(body["code"])
+
+    return {
+        "token_type": "Bearer",
+        "expires_in": 86400,
+        "access_token": access_token,
+        "refresh_token": secrets.token_urlsafe(32),
+    }
+
+@app.get("/api/v2/me")
+async def me(authorization: str = Header(...)):
+    if app.state.fail_next > 0:
+        app.state.fail_next -= 1
+        raise HTTPException(503, "try again")
+
+    user_id = TOKENS.get(authorization.removeprefix("Bearer "))
+    if user_id is None:
+        raise HTTPException(401, "invalid token")
+
+    return {
+        "id": user_id,
+        "username": f"player{user_id}",
+        "country_code": "XX",
+        "playmode": "osu",
+        "is_bot": False,
+    }
+
+
+def serve(port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+
+    while not server.started:
+        time.sleep(0.05)
+
+    return server
+
+
+async def benchmark(logins: int, concurrency: int):
+    # imported here so OSU_BASE_URL is set before the urls are built
+    from app.util import create_http_client, exchange_code_for_token, get_osu_self
+
+    async def login(client: httpx.AsyncClient):
+        tokens = await exchange_code_for_token(client, secrets.token_urlsafe(8))
+        await get_osu_self(client, tokens["access_token"])
+
+    async def run(make_client, shared: bool):
+        semaphore = asyncio.Semaphore(concurrency)
+        shared_client = make_client() if shared else None
+
+        async def one():
+            async with semaphore:
+                if shared_client is not None:
+                    await login(shared_client)
+                else:
+                    # what every login step did before: a fresh client per call
+                    async with make_client() as client:
+                        tokens = await exchange_code_for_token(client, secrets.token_urlsafe(8))
+                    async with make_client() as client:
+                        await get_osu_self(client, tokens["access_token"])
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(logins)))
+        elapsed = time.perf_counter() - started
+
+        if shared_client is not None:
+            await shared_client.aclose()
+
+        return elapsed
+
+    # make sure the retry path works before measuring anything
+    app.state.fail_next = 1
+    async with create_http_client() as client:
+        await login(client)
+
+    per_call = await run(lambda: httpx.AsyncClient(timeout=10.0), shared=False)
+    pooled = await run(create_http_client, shared=True)
+
+    print(f"{logins} logins, concurrency {concurrency}")
+    print(f"client per call: {per_call:.3f}s ({logins / per_call:.1f} logins/s)")
+    print(f"shared client:   {pooled:.3f}s ({logins / pooled:.1f} logins/s)")
+
+
+if __name__ == "__main__":
+    import os
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    os.environ["OSU_BASE_URL"] = f"http://127.0.0.1:{args.port}"
+    server = serve(args.port)
+
+    try:
+        asyncio.run(benchmark(args.logins, args.concurrency))
+    finally:
+        server.should_exit = True
@@ -0,0 +1,127 @@
+"""Recall@k of every configured search profile against exact search.
+
+Samples random points from `beatmap_embeddings`, uses their vectors as
+queries (filtered by their own mode, like the api does) and compares each
+profile's top-k against brute force results over the unquantized vectors.
+The query point itself is left out of both, it would always be the top hit.
+
+    python -m bench.recall --samples 200 -k 10 -k 50
+"""
+import argparse
+import asyncio
+import random
+import time
+import app.settings as settings
+
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import Filter, FieldCondition, MatchValue, QueryRequest
+from app.database.embeddings import BEATMAP_COLLECTION
+from app.util.search import SearchProfile, EXACT_PROFILE, get_search_profiles, describe_profile
+
+
+async def sample_points(qdrant: AsyncQdrantClient, samples: int, seed: int):
+    """`samples` points drawn uniformly from the whole collection."""
+    ids = []
+    offset = None
+
+    # ids only, the vectors are fetched for the sampled points alone
+    while True:
+        records, offset = await qdrant.scroll(
+            collection_name=BEATMAP_COLLECTION,
+            limit=10_000,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False,
+        )
+        ids.extend(r.id for r in records)
+
+        if offset is None:
+            break
+
+    sampled = random.Random(seed).sample(ids, min(samples, len(ids)))
+    points = await qdrant.retrieve(
+        collection_name=BEATMAP_COLLECTION,
+        ids=sampled,
+        with_payload=["mode"],
+        with_vectors=True,
+    )
+    return [p for p in points if p.vector is not None]
+
+
+async def run_queries(qdrant: AsyncQdrantClient, points, profile: SearchProfile, k: int, batch_size: int):
+    """Returns (result ids per sample, seconds spent querying)."""
+    results = []
+    elapsed = 0.0
+
+    for start in range(0, len(points), batch_size):
+        batch = points[start:start + batch_size]
+        requests = [
+            QueryRequest(
+                query=p.vector,
+                filter=Filter(
+                    must=[FieldCondition(key="mode", match=MatchValue(value=p.payload["mode"]))]
+                ),
+                params=profile.to_params(),
+                limit=k + 1,  # the query point comes back too
+                with_payload=False,
+            )
+            for p in batch
+        ]
+
+        started = time.perf_counter()
+        responses = await qdrant.query_batch_points(collection_name=BEATMAP_COLLECTION, requests=requests)
+        elapsed += time.perf_counter() - started
+
+        results.extend([
+            {hit.id for hit in r.points if hit.id != p.id}
+            # k + 1 hits minus the query, or the first k if it wasn't among them
+            if any(hit.id == p.id for hit in r.points)
+            else {hit.id for hit in r.points[:k]}
+            for p, r in zip(batch, responses)
+        ])
+
+    return results, elapsed
+
+
+async def evaluate(samples: int, ks: list[int], batch_size: int, seed: int):
+    qdrant = AsyncQdrantClient(url=settings.QDRANT_URL, api_key=settings.QDRANT_API_KEY)
+
+    try:
+        points = await sample_points(qdrant, samples, seed)
+        if not points:
+            print(f"no points in {BEATMAP_COLLECTION}, nothing to evaluate")
+            return
+
+        print(f"{len(points)} sampled queries\n")
+        print(f"{'profile':<22}{'k':>5}{'recall':>9}{'ms/query':>10}  params")
+
+        for k in ks:
+            truth, exact_elapsed = await run_queries(qdrant, points, EXACT_PROFILE, k, batch_size)
+            print(f"{'exact':<22}{k:>5}{1.0:>9.3f}{exact_elapsed / len(points) * 1000:>10.2f}")
+
+            for name, profile in get_search_profiles().items():
+                found, elapsed = await run_queries(qdrant, points, profile, k, batch_size)
+
+                recalls = [
+                    len(f & t) / len(t)
+                    for f, t in zip(found, truth) if t
+                ]
+                recall = sum(recalls) / len(recalls) if recalls else 0.0
+
+                print(
+                    f"{name:<22}{k:>5}{recall:>9.3f}{elapsed / len(points) * 1000:>10.2f}"
+                    f"  {describe_profile(profile)}"
+                )
+    finally:
+        await qdrant.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("-k", type=int, action="append", dest="ks")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    asyncio.run(evaluate(args.samples, args.ks or [10, 50], args.batch_size, args.seed))
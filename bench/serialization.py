@@ -0,0 +1,104 @@
+"""Serialization cost of a feed-sized response, before and after the response models.
+
+Builds transient `BeatmapSet`s (no database needed) and times turning a
+`{"success": true, "data": [...]}` response into bytes:
+
+- jsonable_encoder: what FastAPI did for the raw ORM objects
+- models: `app.api.models.mapsets_response` (pydantic + orjson)
+- models + fields: the same with `fields=id,title,artist,beatmaps.id,beatmaps.star_rating`
+
+    python -m bench.serialization --sets 50 --difficulties 6
+"""
+import argparse
+import json
+import timeit
+
+from fastapi.encoders import jsonable_encoder
+from app.api.models import mapsets_response, parse_fields
+from app.database.beatmaps import Beatmap, BeatmapSet
+
+
+def make_mapsets(sets: int, difficulties: int) -> list[BeatmapSet]:
+    mapsets = [
+        BeatmapSet(
+            id=set_id,
+            artist=f"artist {set_id}",
+            title=f"title {set_id}",
+            creator=f"mapper {set_id}",
+            source="",
+            genre=set_id % 10,
+            language=set_id % 14,
+            tags=[f"tag{t}" for t in range(12)],
+            status=1,
+            play_count=set_id * 1000,
+            favourite_count=set_id * 10,
+            last_synced_at=1_700_000_000,
+            beatmaps=[
+                Beatmap(
+                    id=set_id * 100 + d,
+                    beatmapset_id=set_id,
+                    difficulty_name=f"difficulty {d}",
+                    mode="osu",
+                    bpm=180.0,
+                    cs=4.0,
+                    ar=9.0,
+                    od=8.5,
+                    hp=5.0,
+                    star_rating=2.0 + d * 0.8,
+                    total_length=150,
+                    hit_object_count=700,
+                    approved_date=1_600_000_000,
+                    extra_metadata={"max_combo": 900},
+                )
+                for d in range(difficulties)
+            ],
+        )
+        for set_id in range(1, sets + 1)
+    ]
+
+    # transient objects get the `beatmapset` back reference set, which a
+    # loaded beatmap doesn't have and jsonable_encoder would recurse into
+    for mapset in mapsets:
+        for beatmap in mapset.beatmaps:
+            beatmap.__dict__.pop("beatmapset", None)
+
+    return mapsets
+
+
+def encoder_response(mapsets) -> bytes:
+    # FastAPI's path without a response model: jsonable_encoder, then
+    # JSONResponse.render which is json.dumps
+    content = jsonable_encoder({"success": True, "data": mapsets})
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+
+
+def run(sets: int, difficulties: int, number: int):
+    mapsets = make_mapsets(sets, difficulties)
+    include = parse_fields("id,title,artist,beatmaps.id,beatmaps.star_rating")
+
+    cases = {
+        "jsonable_encoder": lambda: encoder_response(mapsets),
+        "models": lambda: mapsets_response(mapsets).body,
+        "models + fields": lambda: mapsets_response(mapsets, include).body,
+    }
+
+    print(f"{sets} sets x {difficulties} difficulties, best of 5 x {number} runs\n")
+    print(f"{'case':<20}{'ms/response':>12}{'bytes':>10}")
+
+    baseline = None
+    for name, case in cases.items():
+        size = len(case())
+        best = min(timeit.repeat(case, number=number, repeat=5)) / number * 1000
+        baseline = baseline or best
+
+        print(f"{name:<20}{best:>12.3f}{size:>10}   {baseline / best:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sets", type=int, default=50)
+    parser.add_argument("--difficulties", type=int, default=6)
+    parser.add_argument("--number", type=int, default=50)
+    args = parser.parse_args()
+
+    run(args.sets, args.difficulties, args.number)
@@ -0,0 +1,235 @@
+"""Synthetic osu! data and a fake `OssapiAsync` serving it.
+
+The catalogue is built around a handful of "styles" (think tech, stream,
+jump, farm...). Each style prefers some genres, a bpm range and its own
+slice of the user tag vocabulary, and tag popularity is zipf distributed
+on top of that, like real top tags where a few (e.g. "aim", "streams")
+are everywhere and most are rare. Players lean towards one to three
+styles and mostly play popular sets, so their activity looks like a real
+player's rather than uniform noise.
+
+Everything is derived from `seed`, so two runs with the same parameters
+see the same data.
+"""
+import asyncio
+import bisect
+import random
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from ossapi.enums import GameMode, Grade, RankStatus
+from ossapi.models import Cursor
+
+STYLES = 12
+TAG_VOCABULARY = 400
+SEARCH_PAGE_SIZE = 50  # what /beatmapsets/search returns per page
+GRADES = [Grade.SSH, Grade.SS, Grade.SH, Grade.S, Grade.A, Grade.B, Grade.C]
+GRADE_WEIGHTS = [1, 3, 4, 12, 10, 4, 1]
+MOD_SETS = [[], [], [], ["HD"], ["HD", "DT"], ["DT"], ["HR"], ["HD", "HR"], ["NF"], ["EZ"], ["NC"], ["FL", "HD"]]
+WORDS = ["anime", "rock", "electronic", "vocaloid", "touhou", "game", "remix", "cover", "tv size", "original", "metal", "jazz"]
+
+
+def zipf_weights(n: int, exponent: float = 1.1) -> list[float]:
+    return [1 / (rank + 1) ** exponent for rank in range(n)]
+
+
+@dataclass
+class Style:
+    genres: list[int]
+    bpm: float
+    tags: list[int]          # preferred tag ids, most typical first
+
+
+@dataclass
+class Catalogue:
+    mapsets: dict[int, SimpleNamespace] = field(default_factory=dict)
+    beatmaps: dict[int, SimpleNamespace] = field(default_factory=dict)
+    styles: list[Style] = field(default_factory=list)
+    mapsets_by_style: list[list[int]] = field(default_factory=list)
+    popularity: dict[int, float] = field(default_factory=dict)
+
+
+def make_catalogue(mapsets: int, seed: int = 1, first_id: int = 1) -> Catalogue:
+    rng = random.Random(seed)
+    catalogue = Catalogue()
+    tag_weights = zipf_weights(TAG_VOCABULARY)
+
+    for _ in range(STYLES):
+        catalogue.styles.append(Style(
+            genres=rng.sample(range(1, 11), 2),
+            bpm=rng.uniform(120, 260),
+            tags=rng.choices(range(1, TAG_VOCABULARY + 1), weights=tag_weights, k=12),
+        ))
+        catalogue.mapsets_by_style.append([])
+
+    now = datetime.now(timezone.utc)
+
+    for mapset_id in range(first_id, first_id + mapsets):
+        style_index = rng.randrange(STYLES)
+        style = catalogue.styles[style_index]
+        popularity = rng.paretovariate(1.2)
+        bpm = max(60.0, rng.gauss(style.bpm, 15))
+
+        difficulties = []
+        for index in range(min(1 + int(rng.expovariate(0.35)), 12)):
+            beatmap_id = mapset_id * 100 + index
+            stars = 1.2 + index * rng.uniform(0.6, 1.1)
+            length = rng.randint(60, 300)
+
+            # mostly the style's tags, some globally popular ones on top
+            tags = rng.sample(style.tags, rng.randint(2, 5))
+            tags += rng.choices(range(1, TAG_VOCABULARY + 1), weights=tag_weights, k=rng.randint(0, 3))
+            top_tag_ids = [{"tag_id": tag, "count": max(1, int(rng.paretovariate(1.5) * 2))} for tag in dict.fromkeys(tags)]
+
+            beatmap = SimpleNamespace(
+                id=beatmap_id,
+                beatmapset_id=mapset_id,
+                version=f"difficulty {index}",
+                mode=GameMode.OSU,
+                bpm=bpm,
+                cs=round(rng.uniform(3, 5.5), 1),
+                ar=round(min(10, 5 + stars * 0.8), 1),
+                accuracy=round(min(10, 4 + stars * 0.8), 1),
+                drain=round(rng.uniform(3, 7), 1),
+                difficulty_rating=round(stars, 2),
+                total_length=length,
+                hit_length=int(length * 0.9),
+                max_combo=int(length * bpm / 60 * rng.uniform(0.8, 2.2)),
+                top_tag_ids=top_tag_ids,
+            )
+            difficulties.append(beatmap)
+            catalogue.beatmaps[beatmap_id] = beatmap
+
+        catalogue.mapsets[mapset_id] = SimpleNamespace(
+            id=mapset_id,
+            artist=f"artist {rng.randrange(mapsets // 4 + 1)}",
+            title=f"title {mapset_id}",
+            creator=f"mapper {rng.randrange(mapsets // 8 + 1)}",
+            source="",
+            genre={"id": rng.choice(style.genres)},
+            language={"id": rng.randrange(1, 14)},
+            tags=" ".join(rng.sample(WORDS, 3)),
+            status=RankStatus.RANKED,
+            play_count=int(popularity * 10_000),
+            favourite_count=int(popularity * 100),
+            last_updated=now - timedelta(days=rng.randrange(3000)),
+            beatmaps=difficulties,
+        )
+        # sets mostly stop changing once ranked, good enough for the listing order
+        catalogue.mapsets[mapset_id].ranked_date = catalogue.mapsets[mapset_id].last_updated
+        catalogue.mapsets_by_style[style_index].append(mapset_id)
+        catalogue.popularity[mapset_id] = popularity
+
+    return catalogue
+
+
+class FakeOssapi:
+    """The slice of `OssapiAsync` the workers use, answered from a `Catalogue`.
+
+    `latency` (seconds) is awaited on every call to stand in for the real
+    api's round trip, 0 measures only our own code.
+    """
+
+    def __init__(self, catalogue: Catalogue, seed: int = 1, latency: float = 0.0, unresolved_ratio: float = 0.1, compact_ratio: float = 0.0):
+        self.catalogue = catalogue
+        self.seed = seed
+        self.latency = latency
+        self.unresolved_ratio = unresolved_ratio  # scores returned without their beatmap
+        self.compact_ratio = compact_ratio        # search results without genre, language and user tags
+        self.calls = 0
+        self._listing = None  # the catalogue in search order, built on the first search
+
+    async def _call(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _rng(self, user_id, salt: str) -> random.Random:
+        return random.Random(f"{self.seed}:{user_id}:{salt}")
+
+    def _preferred_mapsets(self, user_id, count: int, salt: str) -> list[int]:
+        rng = self._rng(user_id, "styles")
+        styles = rng.sample(range(STYLES), rng.randint(1, 3))
+        pool = [mapset_id for style in styles for mapset_id in self.catalogue.mapsets_by_style[style]]
+        if not pool:
+            return []
+
+        rng = self._rng(user_id, salt)
+        weights = [self.catalogue.popularity[mapset_id] for mapset_id in pool]
+        return list(dict.fromkeys(rng.choices(pool, weights=weights, k=count)))
+
+    async def user(self, user_id, mode=None):
+        await self._call()
+        rng = self._rng(user_id, "user")
+        user_id = int(user_id)
+
+        return SimpleNamespace(
+            id=user_id,
+            username=f"player {user_id}",
+            country=SimpleNamespace(code="XX"),
+            playmode="osu",
+            is_bot=False,
+            join_date=datetime(2015, 1, 1, tzinfo=timezone.utc) + timedelta(days=rng.randrange(3000)),
+            statistics=SimpleNamespace(pp=rng.uniform(500, 12000), global_rank=rng.randrange(1, 500_000), country_rank=rng.randrange(1, 20_000)),
+        )
+
+    async def user_scores(self, user_id, type, limit=100, mode=None):
+        await self._call()
+        rng = self._rng(user_id, f"scores:{type}")
+        scores = []
+
+        for mapset_id in self._preferred_mapsets(user_id, limit, f"scores:{type}")[:limit]:
+            beatmap = rng.choice(self.catalogue.mapsets[mapset_id].beatmaps)
+            grade = rng.choices(GRADES, weights=GRADE_WEIGHTS)[0]
+
+            scores.append(SimpleNamespace(
+                beatmap_id=beatmap.id,
+                beatmap=None if rng.random() < self.unresolved_ratio else beatmap,
+                ruleset_id=0,
+                total_score=rng.randrange(100_000, 1_000_000),
+                pp=round(beatmap.difficulty_rating ** 2.6 * rng.uniform(2.5, 4.5), 2),
+                rank=grade,
+                mods=[SimpleNamespace(acronym=acronym) for acronym in rng.choice(MOD_SETS)],
+                # recent plays are from the last days, top plays from the last years
+                ended_at=datetime.now(timezone.utc) - timedelta(days=rng.uniform(0, 3 if type == "recent" else 1500)),
+            ))
+
+        return scores
+
+    async def user_beatmaps(self, user_id, type, limit=100):
+        await self._call()
+        count = self._rng(user_id, "favourites").randint(0, 40)
+        return [SimpleNamespace(id=mapset_id) for mapset_id in self._preferred_mapsets(user_id, count, "favourites")]
+
+    async def beatmapset(self, beatmapset_id):
+        await self._call()
+        return self.catalogue.mapsets[int(beatmapset_id)]
+
+    async def search_beatmapsets(self, query=None, *, category=None, sort=None, cursor=None, **filters):
+        """The ranked listing in pages of SEARCH_PAGE_SIZE, oldest ranked first
+        whatever `sort` asks for. The cursor is the last set's (ranked date, id)
+        like the real one. A `compact_ratio` share of the sets come back
+        without genre, language, tags and user tags.
+        """
+        await self._call()
+
+        if self._listing is None or len(self._listing) != len(self.catalogue.mapsets):
+            self._listing = sorted(self.catalogue.mapsets.values(), key=lambda mapset: (mapset.ranked_date, mapset.id))
+            self._listing_keys = [(mapset.ranked_date, mapset.id) for mapset in self._listing]
+
+        start = 0
+        if cursor is not None:
+            start = bisect.bisect_right(self._listing_keys, (datetime.fromisoformat(cursor.approved_date), int(cursor.id)))
+
+        page = self._listing[start:start + SEARCH_PAGE_SIZE]
+        next_cursor = None
+        if start + SEARCH_PAGE_SIZE < len(self._listing):
+            next_cursor = Cursor(approved_date=page[-1].ranked_date.isoformat(), id=page[-1].id)
+
+        page = [self._compact(mapset) if self._rng(mapset.id, "compact").random() < self.compact_ratio else mapset for mapset in page]
+        return SimpleNamespace(beatmapsets=page, cursor=next_cursor, total=len(self.catalogue.mapsets))
+
+    def _compact(self, mapset: SimpleNamespace) -> SimpleNamespace:
+        """`mapset` the way the listing can return it, missing what only the full lookup has."""
+        beatmaps = [SimpleNamespace(**{**vars(beatmap), "top_tag_ids": None}) for beatmap in mapset.beatmaps]
+        return SimpleNamespace(**{**vars(mapset), "genre": None, "language": None, "tags": None, "beatmaps": beatmaps})
@@ -1,35 +1,74 @@
+import argparse
 import uvicorn
 import threading
 import asyncio
+import os
+import signal
+import sys
+import time
 import app.settings as settings
 
+from app.workers import WorkerState
 from app.workers.beatmaps import BeatmapWorker
 from app.workers.players import PlayerWorker
-
-from app.database import async_session
+from app.workers.feeds import FeedWorker, FeedScheduler
+from app.workers.activity import ActivityCompactor
+from app.workers.backfill import CatalogueBackfill
+from app.workers.metrics import MetricsExporter
+
+from app.database.embeddings import (
+    COLLECTIONS, BEATMAPSET_COLLECTION, BEATMAPSET_BACKFILLED_KEY,
+    bootstrap_collection, check_collection, backfill_beatmapset_embeddings
+)
 from app.database.groups import populate_groups_table
+from app.util.auth import bump_groups_version
+from app.logger import main_logger as logger, setup_logging
 
-# constants for the number of threads per worker type
-BEATMAP_WORKER_THREADS = 1
-PLAYER_WORKER_THREADS = 1
+# constants for the number of concurrent workers per worker type. all
+# workers run on one event loop and share a single WorkerState
+BEATMAP_WORKERS = 1
+PLAYER_WORKERS = 1
+FEED_WORKERS = 2  # bounds how many feeds are precomputed at once
 
 
-def start_worker(worker_class):
-    """Start a worker of the specified class in its own thread+event-loop."""
-    def worker_thread():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+async def supervise(worker):
+    """Run `worker`, restarting it after a backoff whenever it fails or returns."""
+    name = type(worker).__name__
+    backoff = 1.0
+
+    while True:
+        started = time.monotonic()
+        try:
+            await worker.run()
+            logger.error("worker stopped", extra={"worker": name, "restart_in": backoff})
+        except Exception:
+            logger.exception("worker crashed", extra={"worker": name, "restart_in": backoff})
 
-        # create and initialize a WorkerState inside this thread's event loop
-        from app.workers import WorkerState
+        # one that ran fine for a while starts over from a short backoff
+        if time.monotonic() - started > settings.WORKER_RESTART_BACKOFF_MAX:
+            backoff = 1.0
 
-        state = WorkerState()
-        loop.run_until_complete(state.init())
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, settings.WORKER_RESTART_BACKOFF_MAX)
 
-        worker = worker_class(state)
-        loop.run_until_complete(worker.run())
 
-    print(f"Starting worker thread for {worker_class.__name__}")
+def start_workers(worker_classes):
+    """Start the given workers in one thread+event-loop sharing one WorkerState.
+
+    Each worker is supervised on its own, a failing one doesn't stop the
+    others. The thread only ends if the shared state itself fails.
+    """
+    async def run_workers():
+        async with WorkerState() as state:
+            await asyncio.gather(*(supervise(worker_class(state)) for worker_class in worker_classes))
+
+    def worker_thread():
+        try:
+            asyncio.run(run_workers())
+        except Exception:
+            logger.exception("worker thread died")
+
+    logger.info("starting worker thread", extra={"workers": [w.__name__ for w in worker_classes]})
 
     t = threading.Thread(target=worker_thread, daemon=True)
     t.start()
@@ -37,20 +76,87 @@ def start_worker(worker_class):
     return t
 
 
-async def main() -> int:
-    threads = []
+async def bootstrap() -> int:
+    """Create or verify everything a deployment needs. Safe to run repeatedly."""
+    async with WorkerState() as state:
+        for collection_name in COLLECTIONS:
+            created = await bootstrap_collection(state.qdrant, collection_name)
+            logger.info(f"{'created' if created else 'verified'} vector collection", extra={"collection": collection_name})
+
+            if collection_name != BEATMAPSET_COLLECTION:
+                continue
+
+            # workers only write set points for sets they process from now on,
+            # an interrupted backfill resumes on the next bootstrap
+            if created or not await state.redis.exists(BEATMAPSET_BACKFILLED_KEY):
+                count = await backfill_beatmapset_embeddings(state.qdrant)
+                await state.redis.set(BEATMAPSET_BACKFILLED_KEY, 1)
+                logger.info("backfilled beatmapset embeddings", extra={"count": count})
 
-    for _ in range(BEATMAP_WORKER_THREADS):
-        threads.append(start_worker(BeatmapWorker))
+        async with state.get_session() as session:
+            await populate_groups_table(session)
+            logger.info("populated default groups")
 
-    for _ in range(PLAYER_WORKER_THREADS):
-        threads.append(start_worker(PlayerWorker))
+        # group permissions may have changed, invalidate embedded claims
+        await bump_groups_version(state.redis)
 
     return 0
 
 
-if __name__ == "__main__":
-    asyncio.run(main())
+async def materialize() -> int:
+    """Queue every active player's feed for the feed workers right away."""
+    async with WorkerState() as state:
+        await FeedScheduler(state).schedule(force=True)
+
+    return 0
+
+
+async def compact() -> int:
+    """Apply the player_activity retention right away."""
+    async with WorkerState() as state:
+        await ActivityCompactor(state).compact(force=True)
+
+    return 0
+
+
+async def backfill(restart: bool) -> int:
+    """Store the ranked catalogue from the osu! search listing, resuming the last run unless `restart`."""
+    async with WorkerState() as state:
+        checkpoint = await CatalogueBackfill(state).run(restart=restart)
+
+    return 1 if checkpoint is None else 0
+
+
+async def check() -> int:
+    """Readiness check for the vector collection, exits non-zero if not ready."""
+    async with WorkerState() as state:
+        problems = await check_collection(state.qdrant)
+
+    for problem in problems:
+        logger.error("not ready", extra={"problem": problem})
+
+    return 1 if problems else 0
+
+
+WORKERS = (
+    [BeatmapWorker] * BEATMAP_WORKERS
+    + [PlayerWorker] * PLAYER_WORKERS
+    + [FeedWorker] * FEED_WORKERS
+    + [FeedScheduler, ActivityCompactor]
+)
+
+
+def serve() -> int:
+    """Run the workers and the api, both stop if the worker thread dies."""
+    workers = start_workers(WORKERS)
+
+    def watch_workers():
+        workers.join()
+        # uvicorn shuts down on SIGTERM, an api without workers would serve stale data
+        logger.error("worker thread exited, stopping the api")
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=watch_workers, daemon=True).start()
 
     try:
         uvicorn.run(
@@ -60,4 +166,56 @@ if __name__ == "__main__":
             reload=False
         )
     except KeyboardInterrupt:
-        print("Shutting down workers...")
\ No newline at end of file
+        logger.info("shutting down workers")
+
+    return 0 if workers.is_alive() else 1
+
+
+def workers_only() -> int:
+    """Run the workers without the api, metrics are served by MetricsExporter instead."""
+    start_workers(WORKERS + [MetricsExporter]).join()
+
+    # the workers never return on their own
+    logger.error("worker thread exited")
+    return 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="pandemonium")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="serve",
+        choices=["serve", "workers", "bootstrap", "check", "materialize", "compact", "backfill"],
+        help="serve (default) runs the workers and api, workers runs only the workers, bootstrap prepares a deployment, check verifies it, "
+             "materialize queues active players' feeds now instead of waiting for the nightly run, "
+             "compact applies the player activity retention now, backfill stores the whole ranked catalogue"
+    )
+    parser.add_argument("--restart", action="store_true", help="backfill: start over instead of resuming the last run")
+    args = parser.parse_args()
+    setup_logging()
+
+    if args.command == "bootstrap":
+        sys.exit(asyncio.run(bootstrap()))
+
+    if args.command == "check":
+        sys.exit(asyncio.run(check()))
+
+    if args.command == "materialize":
+        sys.exit(asyncio.run(materialize()))
+
+    if args.command == "compact":
+        sys.exit(asyncio.run(compact()))
+
+    if args.command == "backfill":
+        sys.exit(asyncio.run(backfill(args.restart)))
+
+    # fail fast instead of letting workers and requests find out one by one
+    if asyncio.run(check()) != 0:
+        logger.error("run `python main.py bootstrap` before serving")
+        sys.exit(1)
+
+    if args.command == "workers":
+        sys.exit(workers_only())
+
+    sys.exit(serve())
@@ -0,0 +1,69 @@
+"""Smoke tests against the local stand-ins in `bench/`.
+
+Redis is fakeredis (with lupa for the queue scripts), qdrant runs in
+memory and osu! is `bench.fake_osu`. Postgres isn't needed, the handlers
+under test get no session and `fetch_mapsets` is replaced by a stub.
+"""
+import os
+
+# read by app.settings on import
+os.environ.setdefault("JWT_SECRET", "test-secret")
+
+import json
+import pytest
+import httpx
+
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from app.util import auth
+from app.util.auth import principal_key
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")  # EVALSHA for the queue scripts
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeAsyncRedis(decode_responses=True)
+
+
+@pytest.fixture(autouse=True)
+def clear_auth_caches():
+    auth._principals.clear()
+    auth._groups_version = None
+    yield
+    auth._principals.clear()
+    auth._groups_version = None
+
+
+async def no_session():
+    yield None
+
+
+@asynccontextmanager
+async def api_client(state):
+    """An http client on a fresh api app serving `state`, without its lifespan."""
+    import app.api
+    from app.api.state import get_read_session, get_session
+
+    application = app.api.init()
+    application.state.api = state
+    application.dependency_overrides[get_session] = no_session
+    application.dependency_overrides[get_read_session] = no_session
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=application), base_url="http://test") as client:
+        yield client
+
+
+async def add_player(redis, player_id: int, permissions: int = 0, main_mode: str = "osu"):
+    """Cache a principal, so authenticating `player_id` needs no database."""
+    principal = {"id": player_id, "effective_permissions": permissions, "main_mode": main_mode}
+    await redis.set(principal_key(player_id, 0), json.dumps(principal))
+
+
+def stub_mapsets(mapset_ids):
+    return [SimpleNamespace(id=mapset_id, beatmaps=[]) for mapset_id in mapset_ids]
+
+
+async def fake_fetch_mapsets(session, mapset_ids):
+    return stub_mapsets(mapset_ids)
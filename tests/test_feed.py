@@ -0,0 +1,58 @@
+import asyncio
+import pytest
+
+from types import SimpleNamespace
+from app.api import discovery
+from app.api.discovery import store_feed_snapshot
+from tests.conftest import add_player, api_client, fake_fetch_mapsets
+
+PLAYER_ID = 7
+
+
+@pytest.fixture(autouse=True)
+def no_database(monkeypatch):
+    monkeypatch.setattr(discovery, "fetch_mapsets", fake_fetch_mapsets)
+
+
+def auth_headers() -> dict:
+    from app.util import generate_session_token
+    return {"Authorization": f"Bearer {generate_session_token(PLAYER_ID)}"}
+
+
+def test_cursor_pages_through_the_snapshot(redis):
+    async def main():
+        await add_player(redis, PLAYER_ID)
+        snapshot_id = await store_feed_snapshot(redis, PLAYER_ID, [1, 2, 3, 4, 5], generated_at=123)
+
+        async with api_client(SimpleNamespace(redis=redis)) as client:
+            page = await client.get(
+                "/feed/discovery", params={"cursor": f"{snapshot_id}:2", "limit": 2}, headers=auth_headers()
+            )
+            assert page.status_code == 200, page.text
+            body = page.json()
+            assert [mapset["id"] for mapset in body["data"]] == [3, 4]
+            assert body["cursor"] == f"{snapshot_id}:4"
+            assert body["generated_at"] == 123
+
+            last = await client.get(
+                "/feed/discovery", params={"cursor": body["cursor"], "limit": 2}, headers=auth_headers()
+            )
+            assert [mapset["id"] for mapset in last.json()["data"]] == [5]
+            assert last.json()["cursor"] is None
+
+    asyncio.run(main())
+
+
+def test_expired_and_malformed_cursors(redis):
+    async def main():
+        await add_player(redis, PLAYER_ID)
+
+        async with api_client(SimpleNamespace(redis=redis)) as client:
+            expired = await client.get("/feed/discovery", params={"cursor": "gone:10"}, headers=auth_headers())
+            assert expired.status_code == 410
+
+            malformed = await client.get("/feed/discovery", params={"cursor": "nonsense"}, headers=auth_headers())
+            assert malformed.status_code == 400
+
+    asyncio.run(main())
+
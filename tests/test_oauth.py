@@ -0,0 +1,47 @@
+import asyncio
+import httpx
+import jwt
+import app.settings as settings
+
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+from app.util import JWT_ALGORITHM, create_http_client
+from app.util.queues import PLAYER_QUEUE, dequeue, enqueue
+from bench import fake_osu
+from tests.conftest import api_client
+
+
+def test_login_issues_a_token_and_syncs_the_player_first(redis):
+    async def main():
+        player_id = fake_osu.fake_user_id("code")
+        # a crawl is already waiting, with the player somewhere in it
+        await enqueue(redis, PLAYER_QUEUE, [1, player_id, 2])
+
+        http = create_http_client(transport=httpx.ASGITransport(app=fake_osu.app))
+        state = SimpleNamespace(redis=redis, http=http)
+
+        async with http, api_client(state) as client:
+            login = await client.get("/oauth/login")
+            assert login.status_code == 307
+            oauth_state = parse_qs(urlparse(login.headers["location"]).query)["state"][0]
+
+            # /me fails once, the login retries it
+            fake_osu.app.state.fail_next = 1
+            callback = await client.get("/oauth/callback", params={"code": "code", "state": oauth_state})
+            assert callback.status_code == 200, callback.text
+
+            # the state is single use
+            replayed = await client.get("/oauth/callback", params={"code": "code", "state": oauth_state})
+            assert replayed.status_code == 400
+
+        data = callback.json()["data"]
+        assert data["player"]["id"] == player_id
+        claims = jwt.decode(data["token"], settings.JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        assert claims["sub"] == str(player_id)
+
+        order = []
+        while (popped := await dequeue(redis, PLAYER_QUEUE, "worker")) is not None:
+            order.append(int(popped[0]))
+        assert order == [player_id, 1, 2]
+
+    asyncio.run(main())
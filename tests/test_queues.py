@@ -0,0 +1,72 @@
+import asyncio
+import json
+import time
+
+from app.util.queues import (
+    PLAYER_QUEUE, bump, dequeue, enqueue, finish, heartbeat, in_flight_key, queue_status,
+)
+
+
+async def drain(redis, queue=PLAYER_QUEUE) -> list[str]:
+    """Process everything waiting, returns the items in the order they came."""
+    items = []
+    while (popped := await dequeue(redis, queue, "worker")) is not None:
+        items.append(popped[0])
+        await finish(redis, queue, "worker", popped[0], 0.0)
+    return items
+
+
+def test_enqueue_dedupes_and_keeps_order(redis):
+    async def main():
+        assert await enqueue(redis, PLAYER_QUEUE, [1, 2, 3]) == 3
+        assert await enqueue(redis, PLAYER_QUEUE, [2, 4]) == 1
+        assert (await queue_status(redis, PLAYER_QUEUE))["depth"] == 4
+        assert await drain(redis) == ["1", "2", "3", "4"]
+
+    asyncio.run(main())
+
+
+def test_front_moves_a_waiting_item_ahead_without_processing_it_twice(redis):
+    async def main():
+        await enqueue(redis, PLAYER_QUEUE, [1, 2, 3])
+
+        # already waiting, so not added, but still served first
+        assert await enqueue(redis, PLAYER_QUEUE, [3], front=True) == 0
+        assert await enqueue(redis, PLAYER_QUEUE, [4], front=True) == 1
+        assert (await queue_status(redis, PLAYER_QUEUE))["depth"] == 4
+
+        assert await drain(redis) == ["3", "4", "1", "2"]
+
+    asyncio.run(main())
+
+
+def test_bump_an_item_on_the_priority_list_moves_it_once(redis):
+    async def main():
+        await enqueue(redis, PLAYER_QUEUE, [1, 2])
+        await enqueue(redis, PLAYER_QUEUE, [3, 4], front=True)
+
+        assert await bump(redis, PLAYER_QUEUE, [4, 2, 5]) == (2, 1)
+        assert await drain(redis) == ["4", "2", "5", "3", "1"]
+
+    asyncio.run(main())
+
+
+def test_heartbeat_requeues_items_of_dead_workers(redis):
+    async def main():
+        await heartbeat(redis, PLAYER_QUEUE, "alive", time.time())
+        await enqueue(redis, PLAYER_QUEUE, [1, 2, 3])
+
+        assert (await dequeue(redis, PLAYER_QUEUE, "alive"))[0] == "1"
+        # a worker that never heartbeats, like one killed mid item
+        assert (await dequeue(redis, PLAYER_QUEUE, "gone"))[0] == "2"
+
+        await heartbeat(redis, PLAYER_QUEUE, "alive", time.time())
+
+        in_flight = await redis.hgetall(in_flight_key(PLAYER_QUEUE))
+        assert {item: json.loads(raw)["worker"] for item, raw in in_flight.items()} == {"1": "alive"}
+        assert await drain(redis) == ["2", "3"]
+
+        await finish(redis, PLAYER_QUEUE, "alive", "1", 0.1)
+        assert (await queue_status(redis, PLAYER_QUEUE))["in_flight"] == []
+
+    asyncio.run(main())
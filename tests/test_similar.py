@@ -0,0 +1,92 @@
+import asyncio
+import numpy
+import pytest
+
+from types import SimpleNamespace
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import PointStruct
+from app.api import beatmaps
+from app.database.embeddings import (
+    BEATMAP_COLLECTION, BEATMAPSET_COLLECTION, BEATMAP_VECTOR_SIZE, backfill_beatmapset_embedding, vector_params
+)
+from tests.conftest import api_client, fake_fetch_mapsets
+
+
+@pytest.fixture(autouse=True)
+def no_database(monkeypatch):
+    monkeypatch.setattr(beatmaps, "fetch_mapsets", fake_fetch_mapsets)
+
+
+def vector(*weights) -> list[float]:
+    v = numpy.zeros(BEATMAP_VECTOR_SIZE)
+    v[:len(weights)] = weights
+    return v.tolist()
+
+
+def point(beatmap_id, mapset_id, v, mode="osu", tags=None) -> PointStruct:
+    return PointStruct(id=beatmap_id, vector=v, payload={
+        "beatmap_id": beatmap_id,
+        "beatmapset_id": mapset_id,
+        "mode": mode,
+        "star_rating": 5.0,
+        "bpm": 180,
+        "user_tags": tags or {},
+    })
+
+
+async def make_qdrant() -> AsyncQdrantClient:
+    qdrant = AsyncQdrantClient(location=":memory:")
+    await qdrant.create_collection(BEATMAP_COLLECTION, vectors_config=vector_params())
+    await qdrant.upsert(BEATMAP_COLLECTION, points=[
+        point(1, 10, vector(1, 0), tags={"streams": 5}),
+        point(2, 10, vector(1, 0.05)),                             # same set as the query
+        point(3, 20, vector(1, 0.1), tags={"streams": 5}),
+        point(4, 20, vector(1, 0.15)),
+        point(5, 30, vector(1, 0.3)),
+        point(6, 40, vector(1, 0.1), mode="taiko"),                # other mode
+        point(7, 50, vector(0, 1)),
+    ])
+    return qdrant
+
+
+def test_batch_similar_ranks_each_beatmap_and_lists_missing(redis):
+    async def main():
+        qdrant = await make_qdrant()
+
+        async with api_client(SimpleNamespace(redis=redis, qdrant=qdrant)) as client:
+            response = await client.post("/beatmaps/similar:batch", json={"ids": [1, 7, 999], "limit": 2})
+            assert response.status_code == 200, response.text
+            body = response.json()
+
+            assert body["missing"] == [999]
+            assert [mapset["id"] for mapset in body["data"]["1"]] == [20, 30]
+            assert 50 not in [mapset["id"] for mapset in body["data"]["7"]]
+
+            ignored = await client.post("/beatmaps/similar:batch", json={"ids": [1], "limit": 2, "ignore": [20]})
+            assert [mapset["id"] for mapset in ignored.json()["data"]["1"]] == [30, 50]
+
+        await qdrant.close()
+
+    asyncio.run(main())
+
+
+def test_similar_sets_backfill_a_missing_set_point(redis):
+    async def main():
+        qdrant = await make_qdrant()
+        await qdrant.create_collection(BEATMAPSET_COLLECTION, vectors_config=vector_params())
+        for mapset_id in (20, 30, 40, 50):
+            await backfill_beatmapset_embedding(qdrant, mapset_id)
+
+        async with api_client(SimpleNamespace(redis=redis, qdrant=qdrant)) as client:
+            # set 10 has difficulty points but no set point yet
+            response = await client.get("/beatmapsets/10/similar", params={"limit": 2})
+            assert response.status_code == 200, response.text
+            assert [mapset["id"] for mapset in response.json()["data"]] == [20, 30]
+            assert await qdrant.retrieve(BEATMAPSET_COLLECTION, ids=[10])
+
+            ignored = await client.get("/beatmapsets/10/similar", params={"limit": 2, "ignore": "20"})
+            assert [mapset["id"] for mapset in ignored.json()["data"]] == [30, 50]
+
+        await qdrant.close()
+
+    asyncio.run(main())